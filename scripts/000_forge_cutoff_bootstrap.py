@@ -95,12 +95,19 @@ def _hide_legacy_cutoff_ui():
         pass
 
 
+def _patches():
+    try:
+        return import_module("scripts.forge_cutoff.patches")
+    except ModuleNotFoundError:
+        return import_module("forge_cutoff.patches")
+
+
 def _install_adapter_and_tokenmap():
+    # 各モジュールは import 時に patches へ登録する（取り付けは Enable に連動）
     try:
-        m = import_module("scripts.forge_cutoff.adapter_finalcond")
+        import_module("scripts.forge_cutoff.adapter_finalcond")
     except ModuleNotFoundError:
-        m = import_module("forge_cutoff.adapter_finalcond")
-    m.try_install()
+        import_module("forge_cutoff.adapter_finalcond")
 
     try:
         import_module("scripts.030_forge_cutoff_tokenmap")
@@ -108,13 +115,61 @@ def _install_adapter_and_tokenmap():
         import_module("030_forge_cutoff_tokenmap")
 
 
+def _install_cond_cache_key():
+    """
+    StableDiffusionProcessing.cached_params に cutoff 設定の指紋を足す。
+    Target 等を変えただけでも conditioning キャッシュが外れ、次の生成で再エンコードされる。
+    """
+    try:
+        from modules import processing
+    except Exception:
+        return
+    K = getattr(processing, "StableDiffusionProcessing", None)
+    if K is None or not hasattr(K, "cached_params"):
+        return
+    if getattr(K.cached_params, "__cutoff_wrapped__", False):
+        return
+    try:
+        vctx = import_module("scripts.forge_cutoff.context_volatile")
+    except ModuleNotFoundError:
+        vctx = import_module("forge_cutoff.context_volatile")
+
+    _orig_cp = K.cached_params
+
+    # Enable OFF 時は元に戻す（キーから指紋が消えるので、ON/OFF の切替でも再エンコードされる）
+    def _cp_wrapped(self, *args, **kwargs):
+        base = _orig_cp(self, *args, **kwargs)
+        try:
+            return tuple(base) + (("sd-forge-cutoff",) + vctx.encode_fingerprint(),)
+        except Exception:
+            return base
+
+    setattr(_cp_wrapped, "__cutoff_wrapped__", True)
+    setattr(_cp_wrapped, "__cutoff_orig__", _orig_cp)
+    K.cached_params = _cp_wrapped
+    log.debug("[ForgeCutoffPoC] cutoff settings folded into conditioning cache key")
+
+
+def _uninstall_cond_cache_key():
+    try:
+        from modules import processing
+    except Exception:
+        return
+    K = getattr(processing, "StableDiffusionProcessing", None)
+    cp = getattr(K, "cached_params", None) if K is not None else None
+    if cp is not None and getattr(cp, "__cutoff_wrapped__", False):
+        K.cached_params = cp.__cutoff_orig__
+
+
 if _detect_forge():
     _install_dummy_hijack_modules()
     _disable_a1111_unet_hook()
     _hide_legacy_cutoff_ui()
     try:
         _install_adapter_and_tokenmap()
-        # ※ get_conds_with_caching 前座リフレッシュは完全削除（ユーザー手動リフレッシュ方針）
+        _patches().register("cond_cache_key", _install_cond_cache_key, _uninstall_cond_cache_key)
+        # 現在の Enable に合わせて取り付け（以降は Settings の onchange で切替）
+        _patches().sync_from_opts()
     except Exception as e:
         log.exception("bootstrap install failed: %s", e)
 else:
@@ -128,10 +183,17 @@ try:
         def _force_enable_off_once(_app=None, *_a, **_k):
             try:
                 shared.opts.cutoff_forge_enable = False
+                _patches().apply(False)
                 log.info("force cutoff_forge_enable = False at app start")
             except Exception:
                 pass
         script_callbacks.on_app_started(_force_enable_off_once)
+        # モデル読み込みごとにテキストエンジンへ TE1 / TE2 のタグを付ける
+        try:
+            _eng = import_module("scripts.forge_cutoff.engines")
+        except ModuleNotFoundError:
+            _eng = import_module("forge_cutoff.engines")
+        script_callbacks.on_model_loaded(_eng.register_model)
         globals()["_cutoff_registered"] = True
 except Exception:
     pass
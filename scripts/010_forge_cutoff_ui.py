@@ -6,6 +6,26 @@ try:
     from scripts.forge_cutoff import context_volatile as vctx
 except Exception:
     from forge_cutoff import context_volatile as vctx
+try:
+    from scripts.forge_cutoff import adapter_finalcond as afc
+except Exception:
+    from forge_cutoff import adapter_finalcond as afc
+try:
+    from scripts.forge_cutoff import metrics
+except Exception:
+    from forge_cutoff import metrics
+try:
+    from scripts.forge_cutoff import precompute
+except Exception:
+    from forge_cutoff import precompute
+try:
+    from scripts.forge_cutoff import patches
+except Exception:
+    from forge_cutoff import patches
+
+# 先回りのきっかけになる設定（トークンマップ／ダミーに効くもの）
+_PRECOMPUTE_KEYS = ("targets", "exclude_tokens", "processing_targets", "source_expand_n", "apply_te1", "apply_te2")
+_PROMPT_IDS = {"txt2img_prompt": "txt2img", "img2img_prompt": "img2img"}
 
 def _runtime_defaults():
     # セッション既定（永続しない）
@@ -18,13 +38,67 @@ def _runtime_defaults():
         exclude_tokens="",
         processing_targets="",
         source_expand_n=1,
-#        decay_mode="off",
-#        decay_strength=0.5,
+        decay_mode="off",
+        decay_strength=0.5,
 #        teaware_mode="off",
         sanity=False,
         cut_ratio=50,
     )
 
+# ui() が返すコンポーネントの順（= API の alwayson_scripts の args の順）
+_ARG_KEYS = ("strength", "targets", "source_expand_n", "exclude_tokens", "processing_targets",
+             "decay_mode", "decay_strength", "apply_te1", "apply_te2", "method", "sanity", "cut_ratio")
+_CHOICES = {"method": ("Lerp", "Nlerp", "Slerp"), "decay_mode": ("off", "linear", "cosine")}
+
+def _coerce(key, val):
+    """API から来た値を既定値と同じ型に揃える（不正な値は None = 無視）。"""
+    default = _runtime_defaults().get(key)
+    try:
+        if isinstance(default, bool):
+            if isinstance(val, str):
+                return val.strip().lower() in ("1", "true", "yes", "on")
+            return bool(val)
+        if isinstance(default, int):
+            return int(val)
+        if isinstance(default, float):
+            v = float(val)
+            return max(0.0, min(1.0, v)) if key in ("strength", "decay_strength") else v
+        v = "" if val is None else str(val)
+        if key in _CHOICES:
+            m = {c.lower(): c for c in _CHOICES[key]}
+            return m.get(v.strip().lower())
+        return v
+    except (TypeError, ValueError):
+        return None
+
+def _job_overrides(args, defaults=()):
+    """
+    process の args（ui() のコンポーネント値、または API の alwayson_scripts args）からこのジョブの設定を作る。
+    args[0] が dict なら {"targets": ..., "strength": ...} のキー指定として扱う（書いたキーだけが上書き）。
+    配列のときは defaults（ui() のコンポーネントの初期値）と同じ値を「指定なし」とみなす。
+    API で省略した args は WebUI がこの初期値で埋めるので、区別できない以上セッション設定に任せる。
+    何も無ければ None（セッション設定のまま）。
+    """
+    if not args:
+        return None
+    if isinstance(args[0], dict):
+        items = args[0].items()
+        defaults = ()
+    else:
+        items = zip(_ARG_KEYS, args)
+    base = dict(zip(_ARG_KEYS, defaults or ()))
+    out = {}
+    for key, val in items:
+        if key not in _ARG_KEYS:
+            continue
+        v = _coerce(key, val)
+        if v is None:
+            continue
+        if key in base and v == _coerce(key, base[key]):
+            continue
+        out[key] = v
+    return out or None
+
 def _push_runtime(cfg):
     """UI側stateから context_volatile に反映（セッション限定）。"""
     try:
@@ -32,6 +106,36 @@ def _push_runtime(cfg):
     except Exception:
         pass
 
+def _finish_job(p) -> bool:
+    """このジョブの設定スナップショットと process_cond メモを片付ける（何度呼んでも良い）。片付けたら True。"""
+    if not getattr(p, "_cutoff_forge_job", False):
+        return False
+    p._cutoff_forge_job = False
+    afc.reset_memo()
+    vctx.end_job()
+    return True
+
+def _close_hook(p):
+    """
+    p.close を包み、例外・中断で postprocess が呼ばれなくても _finish_job を通す。
+    WebUI は txt2img / img2img / API とも with closing(p) で、ジョブと同じスレッドから close を呼ぶ。
+    """
+    orig = getattr(p, "close", None)
+    if orig is None or getattr(orig, "__cutoff_close_hook__", False):
+        return
+
+    def _close(*a, **kw):
+        try:
+            _finish_job(p)
+        except Exception:
+            pass
+        return orig(*a, **kw)
+    _close.__cutoff_close_hook__ = True
+    try:
+        p.close = _close
+    except Exception:
+        pass
+
 class Script(scripts.Script):
     def title(self):
         return "Cutoff (sd-forge-cutoff)"
@@ -39,6 +143,39 @@ class Script(scripts.Script):
     def show(self, is_img2img):
         return scripts.AlwaysVisible
 
+    def process(self, p, *args):
+        # 前のジョブが例外・中断で postprocess を通らなかった場合に備え、このスレッドのスナップショットを先に捨てる
+        vctx.end_job()
+        # override_settings（run_callbacks=False）で Enable が切り替わっても onchange は来ないので、ここで合わせる
+        patches.sync_from_opts()
+        if not patches.is_enabled():
+            return
+        # ジョブ開始：設定をスナップショットし、前ジョブの process_cond メモを持ち越さない
+        # args（UI の値 / API のリクエストごとの値）はこのジョブのスレッドだけに効く（セッション設定は書き換えない）
+        p._cutoff_forge_job = True
+        _close_hook(p)
+        vctx.begin_job(_job_overrides(args, getattr(self, "_arg_defaults", ())))
+        afc.reset_memo()
+        precompute.note_steps(getattr(p, "steps", 20))
+
+    def after_component(self, component, **kwargs):
+        # プロンプト欄の編集で先回りを予約する（デバウンスは precompute 側）
+        tab = _PROMPT_IDS.get(kwargs.get("elem_id"))
+        if tab is None:
+            return
+        try:
+            component.change(lambda text, _tab=tab: precompute.schedule(text, _tab),
+                             inputs=[component], outputs=[], show_progress=False, queue=False)
+        except Exception:
+            pass
+
+    def postprocess(self, p, processed, *args):
+        # ジョブ終了：合成済み cond / ダミーを解放（Enable OFF で始まったジョブには何もしない）
+        if not _finish_job(p):
+            return
+        # 計測スナップショットを書き出す（Settings でファイルが指定されている場合のみ）
+        metrics.export_from_opts()
+
     def ui(self, is_img2img):
         with gr.Accordion("forge-Cutoff", open=False):
             # セッション用の初期状態
@@ -53,15 +190,15 @@ class Script(scripts.Script):
 
             # 2) Target tokens（その下）
             tokens = gr.Textbox(
-                label="Target tokens (comma separated)",
+                label="Target tokens (comma separated; \"|\" separates groups)",
                 value=_runtime_defaults()["targets"],
-                placeholder="red, blue, green, etc...",
+                placeholder="red, blue, green, etc...  /  blue | red",
             )
 
-            # 3) WARNING（その下）
+            # 3) NOTE（その下）
             gr.Markdown(
-                "**⚠️WARNING!!⚠️:** Changing **Target tokens** without modifying the prompt **will not** take effect because of the conditioning cache in Forge. "
-                "To refresh, **adjust the batch size** or **briefly switch checkpoints and switch back**."
+                "**Note:** Changes to **Target tokens** and the Advanced token options take effect on the next generation; "
+                "the conditioning cache is refreshed automatically."
             )
 
             # --- Advanced options (4〜9) をアコーディオンに格納 ---
@@ -84,14 +221,14 @@ class Script(scripts.Script):
                     lines=1, label="Processing targets (CSV)"
                     )
 
-#                # 6) Distance decay ---
-#                with gr.Row():
-#                    decay_mode = gr.Dropdown(choices=["off", "linear", "cosine"],
-#                                             value=_runtime_defaults()["decay_mode"],
-#                                             label="Distance decay")
-#                    decay_strength = gr.Slider(minimum=0.0, maximum=1.0, step=0.05,
-#                                               value=_runtime_defaults()["decay_strength"],
-#                                               label="Decay strength")
+                # 6) Distance decay ---
+                with gr.Row():
+                    decay_mode = gr.Dropdown(choices=["off", "linear", "cosine"],
+                                             value=_runtime_defaults()["decay_mode"],
+                                             label="Distance decay")
+                    decay_strength = gr.Slider(minimum=0.0, maximum=1.0, step=0.05,
+                                               value=_runtime_defaults()["decay_strength"],
+                                               label="Decay strength")
 
 #                # 7) TE-aware ---
 #                teaware = gr.Dropdown(choices=["off", "safe_and"],
@@ -110,7 +247,7 @@ class Script(scripts.Script):
                     )
                     method = gr.Radio(
                         label="Interpolation",
-                        choices=["Lerp", "Slerp"],
+                        choices=["Lerp", "Nlerp", "Slerp"],
                         value=_runtime_defaults()["method"],
                     )
                 
@@ -134,20 +271,25 @@ class Script(scripts.Script):
                         Neutralizes **only** the parts **listed here** (filters the scope). Leave empty to target the whole prompt.  
                         You **must** enter tokens that are actually affected by the Target tokens. If the listed items aren’t under the Target’s influence, no neutralization will be found and the output will look similar to **Enable=off**.
 
+                        **Distance decay (off / linear / cosine) & Decay strength**  
+                        Neutralizes tokens **close to a Source token** most strongly and eases off with distance.  
+                        Each neutralized token gets α × Decay strength × (1 − distance) for linear, or a cosine falloff instead, kept within 0.15–1.0 (distance is relative to the spread of the Source tokens).
+
                         **Apply to TE1 / TE2**  
                         Choose which text encoder to apply to.  
                         - **TE1** — layout / composition–oriented (turning this ON can further suppress pose/layout shifts).  
                         - **TE2** — detail / color–oriented (the main battleground for color bleed; usually recommended ON).
 
-                        **Interpolation (Lerp / Slerp)**  
+                        **Interpolation (Lerp / Nlerp / Slerp)**  
                         How the neutralization is mixed.  
                         - **Slerp** — more robust for stronger effects (recommended).  
+                        - **Nlerp** — keeps the vector length like Slerp without the trigonometry. About as costly as Slerp (not a speed option) and measurably different from it (mean relative error ≈ 2.7e-2 vs Slerp).  
                         - **Lerp** — lighter and linear; use when you want a milder effect.
 
                         > **Tips**
                         > - If the effect feels weak, try **Strength 0.6–0.7** or list **multiple Processing targets**.  
                         > - If nothing changes, check **compatibility between the Target color and the part** (e.g., if the umbrella has no `pink`, it won’t help).  
-                        > - Reminder: with the same prompt, changing **Target tokens only** **will not** trigger re-computation. Refresh by tweaking **Batch size ±1**, or **temporarily switch checkpoints and switch back**.
+                        > - Changing **Target tokens** (or Exclude / Processing / Source expansion / Apply TE1/TE2) re-encodes the prompt automatically on the next generation.
                         </div>"""
                     )        
 
@@ -173,6 +315,8 @@ class Script(scripts.Script):
                 def _f(stv, val):
                     stv[key] = val
                     _push_runtime(stv)
+                    if key in _PRECOMPUTE_KEYS:
+                        precompute.schedule()
                     return stv
                 return _f
 
@@ -192,8 +336,8 @@ class Script(scripts.Script):
             excl.change(          _upd_state("exclude_tokens"),   inputs=[st, excl],         outputs=[st], show_progress=False)
             ponly.change(         _upd_state("processing_targets"), inputs=[st, ponly],      outputs=[st], show_progress=False)
             src_n.change(         _upd_state("source_expand_n"),  inputs=[st, src_n],        outputs=[st], show_progress=False)
-#            decay_mode.change(    _upd_state("decay_mode"),       inputs=[st, decay_mode],   outputs=[st], show_progress=False)
-#            decay_strength.change(_upd_state("decay_strength"),   inputs=[st, decay_strength], outputs=[st], show_progress=False)
+            decay_mode.change(    _upd_state("decay_mode"),       inputs=[st, decay_mode],   outputs=[st], show_progress=False)
+            decay_strength.change(_upd_state("decay_strength"),   inputs=[st, decay_strength], outputs=[st], show_progress=False)
 #            teaware.change(       _upd_state("teaware_mode"),     inputs=[st, teaware],      outputs=[st], show_progress=False)
 
             # ----------------------------------------------
@@ -211,8 +355,8 @@ class Script(scripts.Script):
                         exclude_tokens    = excl.value,
                         processing_targets= ponly.value,
                         source_expand_n   = int(src_n.value),
-#                        decay_mode        = decay_mode.value,
-#                        decay_strength    = float(decay_strength.value),
+                        decay_mode        = decay_mode.value,
+                        decay_strength    = float(decay_strength.value),
 #                        teaware_mode      = teaware.value,
                         sanity            = bool(sanity.value),
                         cut_ratio         = int(cut_ratio.value),
@@ -223,4 +367,9 @@ class Script(scripts.Script):
                     pass
             _init_sync()
 
-        return []
\ No newline at end of file
+        # 値は process の args として渡る（API の alwayson_scripts でもこの順；dict 1 個でも可）
+        comps = [strength, tokens, src_n, excl, ponly, decay_mode, decay_strength,
+                 apply_te1, apply_te2, method, sanity, cut_ratio]
+        # API で省略された args を埋める値（= 初期値；ui-config.json の既定を含む）。process で「指定なし」の判定に使う
+        self._arg_defaults = tuple(getattr(c, "value", None) for c in comps)
+        return comps
\ No newline at end of file
@@ -1,6 +1,13 @@
 # Settingsタブに sd-forge-cutoff のグローバル設定を追加（Quicksettingsからも参照可能）
 import gradio as gr
 from modules import shared
+try:
+    from scripts.forge_cutoff import metrics, patches
+except Exception:
+    from forge_cutoff import metrics, patches
+
+def _apply_metrics_opts():
+    metrics.configure_from_opts()
 
 def on_ui_settings():
     section = ("sd-forge-cutoff", "sd-forge-cutoff")
@@ -8,6 +15,68 @@ def on_ui_settings():
     # Enable: 既定 OFF（Quicksettingsに残す唯一の永続設定）
     shared.opts.add_option("cutoff_forge_enable", shared.OptionInfo(
         default=False, label="Enable (sd-forge-cutoff)", section=section))
+    # ON/OFF に合わせてパッチを付け外しする（OFF 中は Forge 本体の関数そのまま）
+    try:
+        shared.opts.onchange("cutoff_forge_enable", patches.sync_from_opts)
+    except Exception:
+        pass
+
+    # ダミーエンコード LRU の容量（MB）。0 で無制限
+    shared.opts.add_option("cutoff_forge_dummy_cache_mb", shared.OptionInfo(
+        default=256, label="Dummy encoding cache size (MB, 0 = unlimited)", section=section))
+
+    # ダミーエンコードのディスクキャッシュ（safetensors；ワーカ再起動後もエンコードせずに温まる）
+    shared.opts.add_option("cutoff_forge_dummy_disk_cache", shared.OptionInfo(
+        default=False, label="Persist dummy encodings on disk (safetensors)", section=section))
+    shared.opts.add_option("cutoff_forge_dummy_disk_mb", shared.OptionInfo(
+        default=1024, label="Dummy disk cache size (MB, 0 = unlimited)", section=section))
+    shared.opts.add_option("cutoff_forge_dummy_disk_dir", shared.OptionInfo(
+        default="", label="Dummy disk cache directory (empty = <extension>/cache/dummies)", section=section))
+
+    # UI の編集から少し待ってトークンマップ／ダミーを先に作っておく（Generate から最初のステップまでを短縮）
+    shared.opts.add_option("cutoff_forge_precompute", shared.OptionInfo(
+        default=True, label="Precompute token maps in the background while editing", section=section))
+    shared.opts.add_option("cutoff_forge_precompute_dummies", shared.OptionInfo(
+        default=True, label="Also precompute dummy encodings when idle (runs the text encoders)", section=section))
+    shared.opts.add_option("cutoff_forge_precompute_delay_ms", shared.OptionInfo(
+        default=600, label="Precompute delay after the last edit (ms)", section=section))
+
+    # ダミーはターゲットを含むチャンクだけエンコードする（他のチャンクは元の cond と同一なので補間も省く）
+    shared.opts.add_option("cutoff_forge_dummy_changed_chunks_only", shared.OptionInfo(
+        default=True, label="Encode only the dummy chunks that contain targets", section=section))
+
+    # 補間カーネルを torch.compile する（CUDA のみ。初回はコンパイル待ちが入る）
+    shared.opts.add_option("cutoff_forge_torch_compile", shared.OptionInfo(
+        default=False, label="Compile the blend kernel with torch.compile (CUDA only)", section=section))
+
+    # Victim 行 pad の保持 dtype（auto = cond と同じ。fp16/bf16 で保持し、合成は fp32 で計算）
+    shared.opts.add_option("cutoff_forge_pad_dtype", shared.OptionInfo(
+        default="auto", label="Pad rows storage dtype (computed in fp32 when reduced)", section=section,
+        component=gr.Radio, component_args={"choices": ["auto", "float16", "bfloat16"]}))
+
+    # ログの詳細度（既定 WARNING。DEBUG で encode / process_cond ごとの行を出す）
+    shared.opts.add_option("cutoff_forge_log_level", shared.OptionInfo(
+        default="WARNING", label="Log level", section=section,
+        component=gr.Radio, component_args={"choices": ["WARNING", "INFO", "DEBUG"]}))
+
+    # ステージ別タイマー／カウンタ
+    shared.opts.add_option("cutoff_forge_metrics", shared.OptionInfo(
+        default=True, label="Collect per-stage timings and counters", section=section))
+
+    # torch.profiler の record_function 範囲（cutoff::<stage>）を張る
+    shared.opts.add_option("cutoff_forge_profiler_ranges", shared.OptionInfo(
+        default=False, label="Emit torch.profiler ranges (cutoff::<stage>)", section=section))
+
+    # ジョブ終了ごとに計測スナップショットを書き出すファイル（.prom/.txt = Prometheus, それ以外 = JSON；空 = 書き出さない）
+    shared.opts.add_option("cutoff_forge_metrics_file", shared.OptionInfo(
+        default="", label="Metrics export file (.json, or .prom for Prometheus text; empty = off)", section=section))
+
+    for key in ("cutoff_forge_log_level", "cutoff_forge_metrics", "cutoff_forge_profiler_ranges"):
+        try:
+            shared.opts.onchange(key, _apply_metrics_opts)
+        except Exception:
+            pass
+    _apply_metrics_opts()
 
     return []
 
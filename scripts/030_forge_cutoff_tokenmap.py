@@ -1,11 +1,19 @@
-# 毎回（キャッシュ無し）サブ列一致→行インデックスを抽出し、
+# サブ列一致→行インデックスを抽出し、
 # ・Source行（従来の rows） … 互換のため保持
 # ・Victim行（= 非ターゲット領域） … 中立化の適用対象（Exclude/Processing targets を反映）
-# ・dummy_text（= Target を PAD トークン "_" に置換した文字列）
-# を enc_tag ごとに揮発ストアへ保存する。
+# ・dummy_positions（= Target 一致トークンの位置。ダミーはこの位置を PAD トークン "_" に差し替えたトークン列）
+# を不変コンテキストにまとめ、このエンコード結果（出力テンソルの anchor）に紐づけて揮発ストアへ保存する。
+# 単語→BPE バリアントはトークナイザごと、行マップはプロンプト＋設定ごとに LRU で再利用する。
+# 行集合は長さ S の bool 配列（NumPy）で扱う：照合→±N 拡張→Exclude/Processing→コンテキスト→process_cond のマスクまで
+# Target を "|" で区切るとグループになる（例 "blue | red"）。グループ g の Source 行は、g 以外のターゲットだけを
+# PAD にしたダミーへ補間する（g の色は残し、他グループの色の滲みだけを消す）。区切りが無ければ従来どおり1グループ
 
 import logging
-from typing import List, Tuple, Set
+import threading
+import weakref
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
 
 log = logging.getLogger("forge_cutoff")
 if not log.handlers:
@@ -13,12 +21,11 @@ if not log.handlers:
     h.setFormatter(logging.Formatter("[ForgeCutoffPoC] %(levelname)s: %(message)s"))
     log.addHandler(h)
 
-log.setLevel(logging.INFO)  # 常時出力（INFO）
+log.setLevel(logging.WARNING)  # 詳細度は Settings の cutoff_forge_log_level（metrics.set_log_level）
 
 def _dbg(msg, *args):
-    """Always-on informational logs (no toggle)"""
     try:
-        log.info(msg, *args)
+        log.debug(msg, *args)
     except Exception:
         pass
 
@@ -26,6 +33,30 @@ try:
     from scripts.forge_cutoff import context_volatile as vctx
 except Exception:
     from forge_cutoff import context_volatile as vctx
+try:
+    from scripts.forge_cutoff.token_automaton import TokenAutomaton
+except Exception:
+    from forge_cutoff.token_automaton import TokenAutomaton
+try:
+    from scripts.forge_cutoff.lru import LRU
+except Exception:
+    from forge_cutoff.lru import LRU
+try:
+    from scripts.forge_cutoff import metrics
+except Exception:
+    from forge_cutoff import metrics
+try:
+    from scripts.forge_cutoff import patches
+except Exception:
+    from forge_cutoff import patches
+try:
+    from scripts.forge_cutoff import engines
+except Exception:
+    from forge_cutoff import engines
+try:
+    from scripts.forge_cutoff import precompute
+except Exception:
+    from forge_cutoff import precompute
 
 def _rt(key, default=None):
     try:
@@ -37,8 +68,34 @@ def _norm_words_csv(s: str) -> List[str]:
     import re
     return [w.strip() for w in re.split(r"[,，\s]+", s or "") if w.strip()]
 
+def _target_groups(s: str) -> List[List[str]]:
+    """Target 欄を "|" で区切ったグループ（各グループは単語のリスト；空のグループは捨てる）。"|" を区切るのは Target 欄だけ。"""
+    import re
+    groups = [_norm_words_csv(g.lower()) for g in re.split(r"[|｜]", s or "")]
+    return [g for g in groups if g]
+
+def _target_words(canon: str) -> List[str]:
+    """正規化済みの Target（_canon_targets）の全グループの単語。"""
+    return [w for g in _target_groups(canon) for w in g]
+
 def _canon_targets(s: str) -> str:
-    return ",".join(_norm_words_csv(s or "")).lower()
+    return "|".join(",".join(g) for g in _target_groups(s))
+
+def _map_settings(targets, exclude, processing, expand_n) -> Tuple[str, List[str], List[str], List[str], int]:
+    """
+    Cutoff 設定の生の値を行マップ用に正規化する：(canon, Target の単語, Exclude, Processing, ±N)。
+    生成（_wrapped）・precompute・tools/profile_corpus.py で共通（同じ値なら同じ行マップになるように）。
+    """
+    canon = _canon_targets(str(targets or ""))
+    return (canon, _target_words(canon),
+            _norm_words_csv(str(exclude or "").lower()),
+            _norm_words_csv(str(processing or "").lower()),
+            int(expand_n or 1))
+
+def _runtime_map_settings() -> Tuple[str, List[str], List[str], List[str], int]:
+    """ランタイム設定（ジョブのスナップショット）から _map_settings。"""
+    return _map_settings(_rt("targets", ""), _rt("exclude_tokens", ""),
+                         _rt("processing_targets", ""), _rt("source_expand_n", 1))
 
 def _flat_chunks(chunks) -> Tuple[List[int], int]:
     ids: List[int] = []
@@ -49,6 +106,7 @@ def _flat_chunks(chunks) -> Tuple[List[int], int]:
     return ids, S_total
 
 def _find_subseq_all(hay: List[int], needle: List[int]) -> List[Tuple[int, int]]:
+    # 単一パターンの素朴照合（参照実装）。本番経路は _compile_matcher のオートマトンを使う
     hits = []
     if not hay or not needle:
         return hits
@@ -60,7 +118,30 @@ def _find_subseq_all(hay: List[int], needle: List[int]) -> List[Tuple[int, int]]
             hits.append((i, i+n))
     return hits
 
+# L1: 単語 → BPE バリアント（トークナイザ単位。checkpoint 切替で新トークナイザになれば別エントリ）
+_VARIANTS_MAX_TOKENIZERS = 4
+_variants_cache: Dict[int, Tuple[object, Dict[str, List[List[int]]]]] = {}
+
 def _encode_variants(tokenizer, word: str) -> List[List[int]]:
+    tid = id(tokenizer)
+    ent = _variants_cache.get(tid)
+    if ent is None or ent[0]() is not tokenizer:
+        try:
+            ref = weakref.ref(tokenizer)
+        except TypeError:
+            return _encode_variants_uncached(tokenizer, word)
+        if len(_variants_cache) >= _VARIANTS_MAX_TOKENIZERS:
+            _variants_cache.pop(next(iter(_variants_cache)))
+        ent = (ref, {})
+        _variants_cache[tid] = ent
+    words = ent[1]
+    v = words.get(word)
+    if v is None:
+        v = _encode_variants_uncached(tokenizer, word)
+        words[word] = v
+    return v
+
+def _encode_variants_uncached(tokenizer, word: str) -> List[List[int]]:
     variants = [word, " " + word, word.lower(), " " + word.lower()]
     outs: List[List[int]] = []
     for v in variants:
@@ -82,75 +163,250 @@ def _encode_variants(tokenizer, word: str) -> List[List[int]]:
             uniq.append(ids)
     return uniq
 
-def _build_dummy_text(text: str, words: List[str]) -> str:
-    import re
-    s = text or ""
-    for w in words:
-        if not w:
-            continue
-        pat = r'(?i)\b' + re.escape(w) + r'\b'
-        s = re.sub(pat, "_", s)
-    return s
+# 句境界セパレータ（',', ';', ' and', ' with', ' of'）
+_SEPS = [",", " ,", ";", " ;", " and", " with", " of"]
 
-def _collect_segment_bounds(tokenizer, ids_text: List[int]) -> List[Tuple[int, int]]:
+# 設定（単語集合）ごとにオートマトンを一度だけ構築して使い回す
+_MATCHER_CACHE_MAX = 8
+_matcher_cache: Dict[tuple, Tuple[object, TokenAutomaton]] = {}
+
+def _compile_matcher(tokenizer, words_targets: List[str], words_excl: List[str], words_ponly: List[str],
+                     groups: Sequence[Sequence[str]] = ()) -> TokenAutomaton:
     """
-    句境界のヒューリスティック検出。BPE列上で ',', ';', ' and ', ' with ', ' of ' に一致する位置を境界として
-    セグメント [beg, end) のリストを返す。見つからない場合は全体を単一セグメントにする。
+    Target / Exclude / Processing / セパレータの全バリアントを一つのオートマトンに載せる。
+    ラベルは "target" / "exclude" / "processing" / "sep"。groups（2つ以上）を渡すと ("group", i) も載せる。
     """
-    bounds = [0]
-    seps = [",", " ,", ";", " ;", " and", " with", " of"]
-    for sep in seps:
-        try:
-            ids_sep_vars = _encode_variants(tokenizer, sep)
-        except Exception:
-            ids_sep_vars = []
-        for ids_sep in ids_sep_vars:
-            for st, ed in _find_subseq_all(ids_text, ids_sep):
-                bounds.append(ed)  # セパレータの直後から新セグメント
-    bounds = sorted(set([b for b in bounds if 0 <= b <= len(ids_text)]))
+    groups = tuple(tuple(g) for g in groups) if len(groups) > 1 else ()
+    key = (id(tokenizer), tuple(words_targets), tuple(words_excl), tuple(words_ponly), groups)
+    ent = _matcher_cache.get(key)
+    if ent is not None and ent[0]() is tokenizer:
+        return ent[1]
+    ac = TokenAutomaton()
+    labeled = [("target", words_targets), ("exclude", words_excl), ("processing", words_ponly), ("sep", _SEPS)]
+    labeled += [(("group", i), g) for i, g in enumerate(groups)]
+    for label, words in labeled:
+        for w in words:
+            try:
+                variants = _encode_variants(tokenizer, w)
+            except Exception:
+                variants = []
+            for ids in variants:
+                ac.add(ids, label)
+    ac.build()
+    if len(_matcher_cache) >= _MATCHER_CACHE_MAX:
+        _matcher_cache.pop(next(iter(_matcher_cache)))
+    _matcher_cache[key] = (_ref(tokenizer), ac)  # id() の再利用は弱参照で検出
+    return ac
+
+def _ref(obj):
+    try:
+        return weakref.ref(obj)
+    except TypeError:
+        return lambda: obj
+
+def _segments_from_sep_hits(sep_hits: List[Tuple[int, int]], n: int) -> List[Tuple[int, int]]:
+    """セパレータのヒット [st, ed) から、セグメント [beg, end) のリストを作る。"""
+    bounds = [0] + [ed for _st, ed in sep_hits]  # セパレータの直後から新セグメント
+    bounds = sorted(set([b for b in bounds if 0 <= b <= n]))
     segs: List[Tuple[int, int]] = []
-    if not bounds or bounds[0] != 0:
-        bounds = [0] + bounds
     for i in range(len(bounds)):
         a = bounds[i]
-        b = bounds[i+1] if i+1 < len(bounds) else len(ids_text)
+        b = bounds[i+1] if i+1 < len(bounds) else n
         if a < b:
             segs.append((a, b))
     return segs
 
-def _expand_source_hits_with_segments(hits: List[Tuple[int,int]], N: int, segs: List[Tuple[int,int]]) -> Set[int]:
+def _collect_segment_bounds(tokenizer, ids_text: List[int], sep_hits=None) -> List[Tuple[int, int]]:
     """
-    ヒット範囲を±Nだけ拡張。ただし所属セグメントを越えない。
+    句境界のヒューリスティック検出。BPE列上で ',', ';', ' and ', ' with ', ' of ' に一致する位置を境界として
+    セグメント [beg, end) のリストを返す。見つからない場合は全体を単一セグメントにする。
+    sep_hits（オートマトンの "sep" ヒット）が渡されればそれを使い、再照合しない。
     """
-    out: Set[int] = set()
+    if sep_hits is None:
+        sep_hits = _compile_matcher(tokenizer, [], [], []).search_grouped(ids_text).get("sep", [])
+    return _segments_from_sep_hits(sep_hits, len(ids_text))
+
+def _mask_from_ranges(starts, ends, n: int) -> np.ndarray:
+    """区間 [starts[i], ends[i]) の和集合を長さ n の bool 配列にする（差分の累積和；区間ごとのループ無し）。"""
+    st = np.clip(np.asarray(starts, dtype=np.int64), 0, n)
+    ed = np.clip(np.asarray(ends, dtype=np.int64), 0, n)
+    keep = st < ed
+    delta = np.zeros(n + 1, dtype=np.int32)
+    np.add.at(delta, st[keep], 1)
+    np.add.at(delta, ed[keep], -1)
+    return np.cumsum(delta[:n]) > 0
+
+def _expand_source_hits_with_segments(hits: List[Tuple[int,int]], N: int, segs: List[Tuple[int,int]],
+                                      n: int) -> np.ndarray:
+    """
+    ヒット範囲を±Nだけ拡張した行（長さ n の bool 配列）。ただし所属セグメントを越えない。
+    """
+    if not hits:
+        return np.zeros(n, dtype=bool)
+    h = np.asarray(hits, dtype=np.int64).reshape(-1, 2)
+    a, b = h[:, 0], h[:, 1]
     if N <= 0:
-        for a, b in hits:
-            out.update(range(a, b))
-        return out
-    for (a, b) in hits:
-        sa, sb = None, None
-        for (x, y) in segs:
-            if a >= x and b <= y:
-                sa, sb = x, y
-                break
-        if sa is None:
-            sa, sb = 0, len(segs) and segs[-1][1] or (b + N)
-        la = max(sa, a - N)
-        rb = min(sb, b + N)
-        out.update(range(la, rb))
-    return out
+        return _mask_from_ranges(a, b, n)
+    # 所属セグメント：開始位置で二分探索し、ヒットが丸ごと収まるものだけ採用
+    if segs:
+        sg = np.asarray(segs, dtype=np.int64).reshape(-1, 2)
+        k = np.searchsorted(sg[:, 0], a, side="right") - 1
+        kc = np.clip(k, 0, len(sg) - 1)
+        inside = (k >= 0) & (b <= sg[kc, 1])
+        sa = np.where(inside, sg[kc, 0], 0)
+        sb = np.where(inside, sg[kc, 1], int(sg[-1, 1]))
+    else:
+        sa = np.zeros_like(a)
+        sb = b + N
+    return _mask_from_ranges(np.maximum(sa, a - N), np.minimum(sb, b + N), n)
+
+def _rows_from_hits(hits: List[Tuple[int, int]], n: int) -> np.ndarray:
+    if not hits:
+        return np.zeros(n, dtype=bool)
+    h = np.asarray(hits, dtype=np.int64).reshape(-1, 2)
+    return _mask_from_ranges(h[:, 0], h[:, 1], n)
+
+GroupRows = Tuple[Tuple[int, ...], np.ndarray]
+
+def _token_map(tokenizer, ids_text: List[int], S_total: int, words_targets: List[str],
+               words_excl: List[str], words_ponly: List[str], expand_n: int,
+               groups: Sequence[Sequence[str]] = ()) -> Tuple[np.ndarray, np.ndarray, List[Tuple[int, int]], Tuple[GroupRows, ...]]:
+    """
+    トークン列から (Source行, Victim行, ターゲットヒット [st, ed) の一覧, グループ) を求める（L2 本体）。
+    Source / Victim は長さ S_total の bool 配列。
+    グループ（groups が2つ以上の時だけ）は (ダミーで PAD にする位置, 補間する行) の組：
+    そのグループだけの Source 行を、他グループのヒット位置だけ PAD にしたダミーへ補間する。
+    複数グループの Source が重なる行はどのダミーにも寄せない（保護）。
+    """
+    # 全カテゴリを一度の走査で照合（BPE部分列一致；Aho–Corasick）
+    found = {}
+    if tokenizer is not None and ids_text:
+        matcher = _compile_matcher(tokenizer, words_targets, words_excl, words_ponly, groups)
+        found = matcher.search_grouped(ids_text)
+
+    # ターゲット一致
+    hits: List[Tuple[int,int]] = found.get("target", [])
+    n = max(0, int(S_total))
+
+    # 句境界ヒューリスティック ＋ Source拡張（±N; セグメント越境禁止）
+    if expand_n > 0 and ids_text and tokenizer is not None and hits:
+        segs = _collect_segment_bounds(tokenizer, ids_text, sep_hits=found.get("sep", []))
+        expand = lambda h: _expand_source_hits_with_segments(h, expand_n, segs, n)
+    else:
+        expand = lambda h: _rows_from_hits(h, n)
+    rows_source = expand(hits)
+
+    # Exclude / Processing targets を反映（BPE一致）：中立化してよい範囲
+    scope = np.ones(n, dtype=bool)
+    if tokenizer is not None and ids_text:
+        if words_ponly:
+            rows_pt = _rows_from_hits(found.get("processing", []), n)
+            if rows_pt.any():
+                scope &= rows_pt
+        if words_excl:
+            scope &= ~_rows_from_hits(found.get("exclude", []), n)
+
+    # Victim行 = [0..S_total-1] \ Source行（の中立化してよい範囲）
+    rows_victim = ~rows_source & scope
+
+    out_groups: List[GroupRows] = []
+    if len(groups) > 1 and hits:
+        ghits = [found.get(("group", i), []) for i in range(len(groups))]
+        gsrc = [expand(h) for h in ghits]
+        cover = np.sum(gsrc, axis=0)
+        hit_all = _rows_from_hits(hits, n)
+        for h, src in zip(ghits, gsrc):
+            rows = src & (cover == 1) & scope
+            pad_at = hit_all & ~_rows_from_hits(h, n)
+            if rows.any() and pad_at.any():
+                out_groups.append((tuple(np.flatnonzero(pad_at).tolist()), rows))
+
+    return rows_source, rows_victim, hits, tuple(out_groups)
+
+# L2: (engine, emphasis, text, targets, exclude, processing, expand_n) → 完成済みの行マップ
+# value = (engine 弱参照, rows, rows_victim（bool 配列・書き換え不可）, dummy_positions, hits_total, groups, S_total)
+_prompt_cache = LRU(max_items=64)
+
+def prompt_cache_stats():
+    return _prompt_cache.stats()
+
+metrics.register_source("prompt_cache", prompt_cache_stats)
+
+def _has_victims(m) -> bool:
+    """_map_line の結果に補間する行があるか（グループのダミーへ寄せる行も含む）。"""
+    return m is not None and m[3] > 0 and (bool(m[1].any()) or bool(m[4]))
+
+def _map_line(engine, text: str, captured, enc_tag: str, canon: str, words_targets: List[str],
+              words_excl: List[str], words_ponly: List[str], expand_n: int):
+    """
+    1プロンプト分の (rows, rows_victim, dummy_positions, hits_total, groups) を返す（rows / rows_victim は bool 配列）。失敗時は None。
+    """
+    emph = str(getattr(getattr(engine, "emphasis", None), "name", "") or "")
+    pkey = (id(engine), emph, text, canon, tuple(words_excl), tuple(words_ponly), expand_n)
+    ent = _prompt_cache.get(pkey)
+    if ent is not None and ent[0]() is engine:
+        # 同じプロンプト・同じ設定：トークナイズも照合も省略
+        metrics.incr("prompt_cache_hit")
+        _ref_engine, rows_source, rows_victim, dummy_positions, hits_total, groups, S_total = ent
+        _dbg("[cutoff:L2] enc=%s S_total=%d hits=%d targets=%s -> source_rows=%d victim_rows=%d groups=%d (cached)",
+             enc_tag, S_total, hits_total, canon, int(rows_source.sum()), int(rows_victim.sum()), len(groups))
+        return rows_source, rows_victim, dummy_positions, hits_total, groups
 
-def _match_words_rows(tokenizer, ids_text: List[int], words: List[str]) -> Set[int]:
-    out: Set[int] = set()
-    if not words:
-        return out
-    for w in words:
-        needles = _encode_variants(tokenizer, w)
-        for nd in needles:
-            for st, ed in _find_subseq_all(ids_text, nd):
-                out.update(range(st, ed))
+    try:
+        # 本体の __call__ が作ったチャンクを再利用（取れなかった時だけ再トークナイズ）
+        tl = captured.get(text)
+        if tl is None:
+            metrics.incr("retokenize")
+            with metrics.stage("tokenize"):
+                tl = engine.tokenize_line(text)
+        chunks, _tc = tl
+        ids_text, S_total = _flat_chunks(chunks)
+        tokenizer = getattr(engine, "tokenizer", None)
+    except Exception as e:
+        # 失敗時はコンテキストを作らない（process_cond 側で見つからず skip）
+        _dbg("[cutoff:L2] tokenize failed enc=%s: %s", enc_tag, e)
+        return None
+
+    metrics.incr("prompt_cache_miss")
+    with metrics.stage("match"):
+        rows_source, rows_victim, hits, groups = _token_map(
+            tokenizer, ids_text, S_total, words_targets, words_excl, words_ponly, expand_n,
+            _target_groups(canon))
+    hits_total = len(hits)
+    # キャッシュ・コンテキストで共有するので書き換え不可にしておく
+    for a in (rows_source, rows_victim) + tuple(g[1] for g in groups):
+        a.flags.writeable = False
+
+    # ダミーは文字列を書き換えず、このチャンクのターゲット一致位置だけを PAD に差し替えて作る（長さは常に一致）
+    dummy_positions = tuple(np.flatnonzero(_rows_from_hits(hits, S_total)).tolist())
+
+    _prompt_cache.put(pkey, (_ref(engine), rows_source, rows_victim, dummy_positions, hits_total, groups, S_total))
+
+    _dbg("[cutoff:L2] enc=%s S_total=%d hits=%d targets=%s -> source_rows=%d victim_rows=%d groups=%d",
+         enc_tag, S_total, hits_total, canon, int(rows_source.sum()), int(rows_victim.sum()), len(groups))
+    return rows_source, rows_victim, dummy_positions, hits_total, groups
+
+def _precompute_maps(engine, lines: List[str]):
+    """
+    precompute 用：現在の設定で lines の行マップを作り prompt cache に載せる（生成時の _map_line がそのまま当たる）。
+    戻り値 {line: (rows, rows_victim, dummy_positions, hits_total, groups) or None}
+    """
+    tag = engines.tag_of(engine)
+    canon, words_targets, words_excl, words_ponly, expand_n = _runtime_map_settings()
+    if tag is None or not canon:
+        return {}
+    out = {}
+    for line in lines:
+        captured = {line: engine.tokenize_line(line)}
+        out[line] = _map_line(engine, line, captured, tag.enc, canon,
+                              words_targets, words_excl, words_ponly, expand_n)
     return out
 
+precompute.set_mapper(_precompute_maps)
+
+# tokenize_line の横取り先（スレッドローカル；_wrapped の間だけ dict が入る）
+_tls = threading.local()
+
 def _install():
     try:
         import backend.text_processing.classic_engine as ce
@@ -167,120 +423,104 @@ def _install():
         return True
 
     _orig = C.__call__
+    # 元の関数はクラスに持たせる（モジュールが二重に読まれても正しく戻せるように）。None = 継承していた
+    setattr(C, "__cutoff_orig_call__", C.__dict__.get("__call__"))
+
+    # _orig 内部の tokenize_line 結果を横取りする（スコープ中のスレッドだけ記録）
+    _orig_tl = getattr(C, "tokenize_line", None)
+    if callable(_orig_tl) and not getattr(_orig_tl, "__cutoff_capture__", False):
+        def _tl_capture(self, line, *a, **k):
+            res = _orig_tl(self, line, *a, **k)
+            cap = getattr(_tls, "capture", None)
+            if cap is not None:
+                cap[line] = res
+            return res
+        setattr(_tl_capture, "__cutoff_capture__", True)
+        setattr(_tl_capture, "__wrapped__", _orig_tl)   # 横取りせずにトークナイズしたい側（ダミー）が使う
+        setattr(C, "__cutoff_orig_tokenize_line__", C.__dict__.get("tokenize_line"))
+        C.tokenize_line = _tl_capture  # type: ignore
 
     def _wrapped(self, texts):
-        out = _orig(self, texts)
-
-        # --- Cutoff EnableがOFFなら完全に何もしない（ログも出さない） ---
+        prev_cap = getattr(_tls, "capture", None)
+        _tls.capture = {}
         try:
-            from modules.shared import opts as _opts
-            enabled = bool(getattr(_opts, "cutoff_forge_enable", False))
+            out = _orig(self, texts)
+            captured = _tls.capture
+        finally:
+            _tls.capture = prev_cap
+
+        # Enable OFF 時はこのラッパごと外す（patches.apply）ので、ここでは有効判定をしない
+
+        # どのエンコーダか（モデル読み込み時の登録簿から。S からは推定しない）
+        series = out[0] if (isinstance(out, tuple) and len(out) >= 1) else out  # Tensor [B,S,H]
+        tag = engines.tag_of(self)
+        if tag is None:
+            metrics.skip("unknown_engine")
+            return out
+        try:
+            engines.note_width(self, int(series.shape[-1]))
         except Exception:
-            enabled = False
-        if not enabled:
+            pass
+        # ダミーをトークン列から作るため、このエンジンのチャンクを残しておく（ターゲット設定時のみ）
+        if _rt("targets", ""):
             try:
-                # 念のため揮発ストアを空に
-                vctx.clear()
+                for line, tl in captured.items():
+                    vctx.put_chunks(self, line, tl[0])
             except Exception:
                 pass
+        # cond の anchor（先頭列）を作るのは連結先頭のエンジンだけ。他のエンジン（SDXL の G）の列は
+        # process_cond 側で同じ行マップを使うので、ここでの照合は不要
+        if tag.index != 0:
+            return out
+        enc_tag = tag.enc
+        if not (_rt("apply_te1", False) or _rt("apply_te2", True)):
+            metrics.skip("enc_disabled")
             return out
-
-        # どのエンコーダか（S から推定 → 後段で enc_tag をキーに整合）
-        try:
-            series = out[0] if (isinstance(out, tuple) and len(out) >= 1) else out  # Tensor [B,S,H]
-            S = int(series.shape[-2])
-            enc_tag = "TE1" if S <= 77 else "TE2"
-        except Exception:
-            enc_tag = "TE1"
 
         # ランタイム設定（セッション限定）
-        targets_raw = str(_rt("targets", "") or "")
-        excl_raw    = str(_rt("exclude_tokens", "") or "")
-        ponly_raw   = str(_rt("processing_targets", "") or "")
-        expand_n    = int(_rt("source_expand_n", 1) or 1)
-
-        canon = _canon_targets(targets_raw)
-        words_targets = _norm_words_csv(canon)
-        words_excl    = _norm_words_csv(excl_raw.lower())
-        words_ponly   = _norm_words_csv(ponly_raw.lower())
-
-        # 入力テキスト（Forge 実測で texts_len=1）
-        text0 = ""
+        canon, words_targets, words_excl, words_ponly, expand_n = _runtime_map_settings()
+
+        if not canon:
+            metrics.skip("no_targets")
+            return out
+
+        # バッチ内の全プロンプト（重複は1回だけ）について行マップを作る
         try:
-            text0 = (texts[0] if texts else "") or ""
+            lines = [str(t or "") for t in (texts or [])]
         except Exception:
-            pass
-
-        rows_sorted: List[int] = []
-        rows_victim_sorted: List[int] = []
-        hits_total = 0
-        dummy_text = ""
+            lines = []
+        maps = {}
+        with metrics.stage("tokenmap"):
+            for line in dict.fromkeys(lines):
+                if line:
+                    maps[line] = _map_line(self, line, captured, enc_tag, canon,
+                                           words_targets, words_excl, words_ponly, expand_n)
+
+        # ターゲットが無いプロンプト（negative 等）は中立化の基準が無いので紐づけない
+        if not any(_has_victims(m) for m in maps.values()):
+            metrics.skip("no_hits")
+            return out
 
-        if canon and text0:
-            try:
-                chunks, _tc = self.tokenize_line(text0)
-                ids_text, S_total = _flat_chunks(chunks)
-                tokenizer = getattr(self, "tokenizer", None)
-            except Exception as e:
-                _dbg("[cutoff:L2] tokenize failed enc=%s: %s", enc_tag, e)
-                # 失敗時は状態だけクリアして返す
-                vctx.set_rows(enc_tag=enc_tag, rows=[], targets_canon=canon)
-                vctx.set_rows_victim(enc_tag=enc_tag, rows_victim=[])
-                vctx.set_dummy_text(enc_tag=enc_tag, dummy_text="")
-                return out
-
-            # ターゲット一致（BPE部分列一致）
-            hits: List[Tuple[int,int]] = []
-            rows_source: Set[int] = set()
-            if tokenizer is not None and ids_text:
-                for w in words_targets:
-                    needles = _encode_variants(tokenizer, w)
-                    hit_local = 0
-                    for nd in needles:
-                        hs = _find_subseq_all(ids_text, nd)
-                        if hs:
-                            hits.extend(hs)
-                        for st, ed in hs:
-                            for r in range(st, ed):
-                                rows_source.add(r)
-                        hit_local += len(hs)
-                    hits_total += hit_local
-
-            # 句境界ヒューリスティック ＋ Source拡張（±N; セグメント越境禁止）
-            if expand_n > 0 and ids_text and tokenizer is not None and hits:
-                segs = _collect_segment_bounds(tokenizer, ids_text)
-                rows_source = _expand_source_hits_with_segments(hits, expand_n, segs)
-
-            rows_sorted = sorted(rows_source)
-
-            # Victim行（初期） = [0..S_total-1] \ Source行
-            if S_total > 0:
-                all_rows = set(range(S_total))
-                rows_victim = set(all_rows - rows_source)
-            else:
-                rows_victim = set()
-
-            # Exclude / Processing targets を反映（BPE一致）
-            if tokenizer is not None and ids_text:
-                rows_excl  = _match_words_rows(tokenizer, ids_text, words_excl) if words_excl else set()
-                rows_pt    = _match_words_rows(tokenizer, ids_text, words_ponly) if words_ponly else set()
-                if rows_pt:
-                    rows_victim = rows_victim.intersection(rows_pt)
-                if rows_excl:
-                    rows_victim = rows_victim - rows_excl
-
-            rows_victim_sorted = sorted(rows_victim)
-
-            # dummy_text の素朴生成（文字列置換）
-            dummy_text = _build_dummy_text(text0, words_targets)
-
-            _dbg("[cutoff:L2] enc=%s S_total=%d hits=%d targets=%s -> source_rows=%d victim_rows=%d",
-                 enc_tag, S_total, hits_total, canon, len(rows_sorted), len(rows_victim_sorted))
-
-        # 揮発ストアへ保存
-        vctx.set_rows(enc_tag=enc_tag, rows=rows_sorted, targets_canon=canon)
-        vctx.set_rows_victim(enc_tag=enc_tag, rows_victim=rows_victim_sorted)
-        vctx.set_dummy_text(enc_tag=enc_tag, dummy_text=dummy_text)
+        # サンプルごとのエンコード結果に紐づけて揮発ストアへ保存（別ジョブ・negative の上書きを受けない）
+        try:
+            anchors = vctx.anchor_keys(series)
+        except Exception as e:
+            _dbg("[cutoff:L2] anchor failed enc=%s: %s", enc_tag, e)
+            metrics.skip("anchor_failed")
+            return out
+        S_out = int(series.shape[-2])
+        ctxs = {}
+        for b, line in enumerate(lines[:len(anchors)]):
+            m = maps.get(line)
+            if not _has_victims(m):
+                continue
+            ctx = ctxs.get(line)
+            if ctx is None:
+                rows_source, rows_victim, dummy_positions, _hits, groups = m
+                ctx = vctx.make_context(enc_tag, S_out, canon, rows_source, rows_victim, line, dummy_positions, groups)
+                ctxs[line] = ctx
+            vctx.bind(anchors[b], ctx)
+        metrics.incr("contexts_bound", len(ctxs))
 
         return out
 
@@ -289,4 +529,27 @@ def _install():
     _dbg("patched ClassicTextProcessingEngine.__call__ for token mapping (victim & dummy)")
     return True
 
-_install()
+def _uninstall():
+    """__call__ / tokenize_line を元に戻し、揮発ストアを空にする。"""
+    try:
+        import backend.text_processing.classic_engine as ce
+    except Exception:
+        return False
+    C = getattr(ce, "ClassicTextProcessingEngine", None)
+    if C is None or not C.__dict__.get("__cutoff_tokenmap_wrapped__", False):
+        return True
+    for name, saved in (("__call__", "__cutoff_orig_call__"), ("tokenize_line", "__cutoff_orig_tokenize_line__")):
+        if saved not in C.__dict__:
+            continue
+        orig = C.__dict__[saved]
+        if orig is None:
+            delattr(C, name)
+        else:
+            setattr(C, name, orig)
+        delattr(C, saved)
+    setattr(C, "__cutoff_tokenmap_wrapped__", False)
+    vctx.clear()
+    _dbg("restored ClassicTextProcessingEngine.__call__ / tokenize_line")
+    return True
+
+patches.register("tokenmap", _install, _uninstall)
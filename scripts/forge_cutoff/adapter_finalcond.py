@@ -1,5 +1,8 @@
-﻿import logging, threading
-from typing import List, Tuple, Set
+﻿import copy, logging, threading, types, weakref
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+import numpy as np
 
 from modules.shared import opts
 try:
@@ -8,22 +11,40 @@ except Exception:
     from forge_cutoff import context_volatile as vctx
 
 try:
-    from scripts.forge_cutoff import context_volatile as vctx
+    from scripts.forge_cutoff.lru import LRU
 except Exception:
-    from forge_cutoff import context_volatile as vctx
+    from forge_cutoff.lru import LRU
+
+try:
+    from scripts.forge_cutoff import metrics
+except Exception:
+    from forge_cutoff import metrics
+
+try:
+    from scripts.forge_cutoff import patches
+except Exception:
+    from forge_cutoff import patches
+
+try:
+    from scripts.forge_cutoff import engines
+except Exception:
+    from forge_cutoff import engines
+try:
+    from scripts.forge_cutoff import dummy_store
+except Exception:
+    from forge_cutoff import dummy_store
 
 log = logging.getLogger("forge_cutoff")
 if not log.handlers:
     h = logging.StreamHandler()
     h.setFormatter(logging.Formatter("[ForgeCutoffPoC] %(levelname)s: %(message)s"))
     log.addHandler(h)
-log.setLevel(logging.INFO)  # 常時出力する方針に変更（WARNINGからINFOへ）
+log.setLevel(logging.WARNING)  # 詳細度は Settings の cutoff_forge_log_level（metrics.set_log_level）
 
-# ---- Always-on debug (now informational) ----
+# ---- debug log（毎ステップの行は DEBUG。集計は metrics 側） ----
 def _dbg(msg, *args):
-    """Always print informational logs (no toggle)"""
     try:
-        log.info(msg, *args)
+        log.debug(msg, *args)
     except Exception:
         pass
 
@@ -36,76 +57,253 @@ def _is_tensor(x):
     except Exception:
         return False
 
-def _enc_tag_from_S(S: int) -> str:
-    # 既存挙動は維持（将来: より堅牢な識別へ差し替え可）
-    return "TE1" if S <= 77 else "TE2"
-
 def _apply_for_enc(enc: str) -> bool:
     # セッション限定の apply_te1/apply_te2 を参照
     if enc == "TE1":
         return bool(vctx.get_runtime("apply_te1", False))
     return bool(vctx.get_runtime("apply_te2", True))
 
+def _active_spans(H: int):
+    """
+    cond [.., H] のうち適用対象のエンジン列範囲 [(tag, engine, c0, c1)]。
+    エンジン登録簿の列配置が H と合わない（未知のモデル等）なら空。
+    """
+    lay = engines.spans()
+    if not lay or lay[-1][3] != int(H):
+        return []
+    return [sp for sp in lay if _apply_for_enc(sp[0].enc)]
+
 def _select_rows_sanity(S: int) -> List[int]:
     ratio = int(vctx.get_runtime("cut_ratio", 50) or 50)
     ratio = max(0, min(50, ratio))
     k = int(S * ratio / 100.0)
     return list(range(max(0, S - k), S)) if k > 0 else []
 
-def _apply_rows_inplace(series, rows: List[int], method: str, alpha, pad_sel=None):
+def _alpha_rows(alpha, K: int, ref):
+    """alpha（単一値 / [K] の配列・テンソル）を [K,1] にブロードキャストできるテンソルへ。"""
+    import torch
+    if isinstance(alpha, (list, tuple)):
+        return torch.as_tensor(alpha, device=ref.device, dtype=ref.dtype).view(-1, 1)
+    if _is_tensor(alpha):
+        return alpha.to(device=ref.device, dtype=ref.dtype).reshape(-1, 1) if alpha.dim() >= 1 else alpha.view(1, 1)
+    # 単一値（互換）：float に正規化
+    try:
+        aval = float(alpha)
+    except Exception:
+        aval = 0.6
+    aval = max(0.0, min(1.0, aval))
+    return torch.tensor(aval, device=ref.device, dtype=ref.dtype).view(1, 1)
+
+def _rowdot(x, y):
+    """行ごとの内積 [K,1]。bmm（[K,1,H]×[K,H,1] の小さな行列積の束）は CPU で遅いので vecdot（1 パスの縮約）。"""
+    import torch
+    vecdot = getattr(torch.linalg, "vecdot", None)
+    if vecdot is not None:
+        return vecdot(x, y, dim=-1).unsqueeze(-1)
+    return (x * y).sum(dim=-1, keepdim=True)
+
+def _row_geometry(sel, pad_sel, eps: float = 1e-7):
+    """行ごとのノルム |sel|, |pad| と cos ω（いずれも [K,1]）。[K,H] の中間テンソルは作らない。"""
+    import torch
+    ns = torch.linalg.vector_norm(sel, dim=-1, keepdim=True).clamp_(min=eps)      # [K,1]
+    np_ = torch.linalg.vector_norm(pad_sel, dim=-1, keepdim=True).clamp_(min=eps)  # [K,1]
+    dot = _rowdot(sel, pad_sel)                                                    # [K,1]
+    return ns, np_, (dot / (ns * np_)).clamp_(-1.0, 1.0)
+
+# sin ω がこれ未満（ほぼ平行／反平行）の行は Slerp の代わりに Lerp 係数
+_SLERP_NEAR = 1e-4
+
+def _slerp_coeffs_where(sel, pad_sel, a, eps: float = 1e-7):
+    """
+    Slerp を行ごとの係数 [K,1] に畳み込む：mixed = c1 * sel + c2 * pad_sel
+      o = sel/|sel|, p = pad/|pad| として (t1*o + t2*p) * |sel| = t1*sel + t2*(|sel|/|pad|)*pad
+    ほぼ平行の行は torch.where で Lerp 係数に切り替える（両方の枝を全行で計算する：torch.compile 用）。
+    """
+    import torch
+    ns, np_, cos = _row_geometry(sel, pad_sel, eps)
+    omega = torch.acos(cos)
+    sin_omega = torch.sin(omega).clamp_(min=eps)
+    near = sin_omega < _SLERP_NEAR
+    c1 = torch.where(near, 1.0 - a, torch.sin((1.0 - a) * omega) / sin_omega)
+    c2 = torch.where(near, a, torch.sin(a * omega) / sin_omega * (ns / np_))
+    return c1, c2
+
+def _slerp_coeffs(sel, pad_sel, a, eps: float = 1e-7):
+    """
+    _slerp_coeffs_where と同じ係数を、行ごとに必要な枝だけで求める（eager 用）。
+    全行を Lerp 係数で初期化し、ほぼ平行でない行だけを抜き出して acos / sin を計算して書き戻す。
+    sin ω は cos ω から sqrt(1-cos²) で判定するので、三角関数は Slerp の行の分だけ。
+    """
+    import torch
+    ns, np_, cos = _row_geometry(sel, pad_sel, eps)
+    a = a.expand_as(cos)
+    c1 = 1.0 - a
+    c2 = a.clone(memory_format=torch.contiguous_format)
+    sin_omega = (1.0 - cos * cos).clamp_(min=0.0).sqrt_()
+    far = torch.nonzero(sin_omega.view(-1) >= _SLERP_NEAR).view(-1)
+    if far.numel():
+        omega = torch.acos(cos.index_select(0, far))
+        s = torch.sin(omega)
+        af = a.index_select(0, far)
+        c1.index_copy_(0, far, torch.sin((1.0 - af) * omega) / s)
+        c2.index_copy_(0, far, torch.sin(af * omega) / s * (ns / np_).index_select(0, far))
+    return c1, c2
+
+def _nlerp_coeffs(sel, pad_sel, a, eps: float = 1e-7):
+    """
+    Nlerp（正規化線形補間）の係数 [K,1]：m = (1-a)*o + a*p を |m| で割って |sel| を掛ける（Slerp と同じくノルムを保つ）。
+    |m|² = (1-a)² + a² + 2a(1-a)cos ω なので、acos / sin も [K,H] の中間テンソルも要らない。
+    [K,H] のパスは Slerp と同じ（ノルム 2 本・内積 1 本・合成 2 本）なので、速さはほぼ Slerp と同じ。差は [K,1] の係数計算だけで、
+    そこは少ない演算で済ませる：α が単一値なら Python の float で畳み込み、cos のクランプ・分岐（torch.where）は無し。
+    |m| は _SLERP_NEAR で下から抑える（反平行で a≈0.5 の行も出力のノルムは |sel| 以下で連続）。
+    """
+    import torch
+    ns = torch.linalg.vector_norm(sel, dim=-1, keepdim=True).clamp_(min=eps)      # [K,1]
+    np_ = torch.linalg.vector_norm(pad_sel, dim=-1, keepdim=True).clamp_(min=eps)  # [K,1]
+    cos = _rowdot(sel, pad_sel).div_(ns * np_)                                     # [K,1]
+    ratio = ns.div_(np_)                                                           # |sel|/|pad|
+    if _is_tensor(a) and a.numel() == 1:
+        a = float(a)
+    b = 1.0 - a
+    inv = cos.mul_(2.0 * a * b).add_(a * a + b * b).clamp_(min=_SLERP_NEAR * _SLERP_NEAR).rsqrt_()
+    return inv * b, ratio.mul_(inv).mul_(a)
+
+def _blend_fused(sel, pad_sel, a):
+    """torch.compile 用の関数版（Slerp）。係数計算と合成が1カーネルに融合される。"""
+    c1, c2 = _slerp_coeffs_where(sel, pad_sel, a)
+    return c1 * sel + c2 * pad_sel
+
+# torch.compile 済みカーネル（Settings で有効化；CUDA のみ。失敗したら以後は eager）
+_compiled = {"fn": None, "failed": False}
+
+def _compiled_blend():
+    if _compiled["failed"]:
+        return None
+    try:
+        if not bool(getattr(opts, "cutoff_forge_torch_compile", False)):
+            return None
+    except Exception:
+        return None
+    if _compiled["fn"] is None:
+        try:
+            import torch
+            _compiled["fn"] = torch.compile(_blend_fused, dynamic=True)
+        except Exception as e:
+            _dbg("[cutoff:pc] torch.compile unavailable (%s); eager blend", e)
+            _compiled["failed"] = True
+            return None
+    return _compiled["fn"]
+
+def _blend_rows(sel, pad_sel, a, method: str):
     """
-    rows で指定された行に対して一括適用する。
-    alpha は単一値でも行ごとの配列でも良い（[K] / [1,K,1] / 単一値）。
+    sel / pad_sel: [K,H]、a: [K,1] or [1,1]。sel を上書きして補間結果 [K,H] を返す
+    （sel はマスク抽出したコピーなので in-place で良い）。
+    """
+    if method == "Slerp":
+        fn = _compiled_blend() if sel.is_cuda else None
+        if fn is not None:
+            try:
+                return fn(sel, pad_sel, a)
+            except Exception as e:
+                _dbg("[cutoff:pc] compiled blend failed (%s); fallback to eager", e)
+                _compiled["failed"] = True
+        c1, c2 = _slerp_coeffs(sel, pad_sel, a)
+        return sel.mul_(c1).addcmul_(pad_sel, c2)
+    if method == "Nlerp":
+        c1, c2 = _nlerp_coeffs(sel, pad_sel, a)
+        return sel.mul_(c1).addcmul_(pad_sel, c2)
+    return sel.lerp_(pad_sel, a)
+
+def _apply_mask_inplace(series, mask, method: str, alpha, pad_rows=None):
+    """
+    mask [B,S]（bool）で指定された行に対して一括適用する（サンプルごとに別の行集合で良い）。
+    pad_rows は mask の True 順（b→s の行優先）に並んだ [K,H]。None ならサンプルごとの平均へ。
+    alpha は単一値でも [K] の配列でも良い。
     """
     import torch
-    if not (_is_tensor(series) and series.dim() == 3) or not rows:
+    if not (_is_tensor(series) and series.dim() == 3) or mask is None:
         return
 
     with torch.inference_mode():
-        B, S, H = int(series.shape[0]), int(series.shape[1]), int(series.shape[2])
-        row_idx = torch.as_tensor(rows, device=series.device, dtype=torch.long)
-        sel     = series[:, row_idx, :]                    # [B,K,H]
-
-        # フォールバック（従来互換）：pad_selが無い場合のみ平均へ（ここで一度だけ計算）
-        if pad_sel is None:
-            pad_vec = series.mean(dim=1, keepdim=True)     # [B,1,H]
-            pad_sel = pad_vec.expand(-1, row_idx.numel(), -1)
-
-        # alpha を [B,K,1] にブロードキャストできるテンソルへ
-        if isinstance(alpha, (list, tuple)):
-            a = torch.as_tensor(alpha, device=series.device, dtype=sel.dtype).view(1, -1, 1)
-        elif _is_tensor(alpha):
-            a = alpha
-            if a.dim() == 1:  # [K] → [1,K,1]
-                a = a.view(1, -1, 1)
-        else:
-            # 単一値（互換）：float に正規化
-            try:
-                aval = float(alpha)
-            except Exception:
-                aval = 0.6
-            aval = max(0.0, min(1.0, aval))
-            a = torch.tensor(aval, device=series.device, dtype=sel.dtype).view(1, 1, 1)
-        # [B,K,1] に拡張
-        a = a.expand(sel.shape[0], sel.shape[1], 1)
-
-        if method == "Slerp":
-            eps = 1e-7
-            o = sel / torch.clamp(sel.norm(dim=-1, keepdim=True), min=eps)
-            p = pad_sel / torch.clamp(pad_sel.norm(dim=-1, keepdim=True), min=eps)
-            dot = torch.clamp((o * p).sum(dim=-1, keepdim=True), -1.0, 1.0)
-            omega = torch.acos(dot)
-            sin_omega = torch.sin(omega).clamp(min=eps)
-            near = (sin_omega < 1e-4).float()
-            t1 = torch.sin((1 - a) * omega) / sin_omega
-            t2 = torch.sin(a * omega) / sin_omega
-            mixed = t1 * o + t2 * p
-            mixed = mixed * torch.clamp(sel.norm(dim=-1, keepdim=True), min=eps)
-            mixed = near * ((1.0 - a) * sel + a * pad_sel) + (1.0 - near) * mixed
-        else:
-            mixed = (1.0 - a) * sel + a * pad_sel
+        sel = series[mask]                                  # [K,H]
+        K = int(sel.shape[0])
+        if K == 0:
+            return
 
-        series[:, row_idx, :] = mixed
+        # フォールバック（従来互換）：pad が無い場合のみ平均へ（ここで一度だけ計算）
+        if pad_rows is None:
+            pad_rows = series.mean(dim=1, keepdim=True).expand_as(series)[mask]
+
+        # 低精度で保持した pad（fp16/bf16）と、ノルム・内積を使う Slerp / Nlerp は fp32 で計算して元の dtype へ戻す
+        # （fp16 のままだと cos ω が ±1 付近で丸まり acos の誤差が大きい）
+        if pad_rows.dtype != sel.dtype or (method != "Lerp" and sel.dtype in (torch.float16, torch.bfloat16)):
+            sel32 = sel.float()
+            out = _blend_rows(sel32, pad_rows.float(), _alpha_rows(alpha, K, sel32), method)
+            series[mask] = out.to(series.dtype)
+            return
+
+        a = _alpha_rows(alpha, K, sel)
+        series[mask] = _blend_rows(sel, pad_rows, a, method)   # sel は in-place 更新
+
+def _apply_rows_inplace(series, rows, method: str, alpha, pad_sel=None):
+    """
+    rows（行番号の列、または bool 配列 [S]）で指定された行に対して、全サンプル一括で適用する（互換ラッパ）。
+    alpha は単一値でも行ごとの配列でも良い（[K] / [1,K,1] / 単一値）。pad_sel は [1 or B,K,H]。
+    行ごとの alpha / pad_sel は rows の並び（呼び出し側の順序）に対応する。重複した行は最初の 1 つだけ使う。
+    """
+    import torch
+    if not (_is_tensor(series) and series.dim() == 3) or rows is None:
+        return
+    rows = np.asarray(rows)
+    order = None
+    if rows.dtype == np.bool_:
+        rows = np.flatnonzero(rows)
+    else:
+        raw = rows.astype(np.int64).reshape(-1)
+        # マスクは行の昇順で並ぶ → 呼び出し側の並びから昇順への添字（各行の最初の出現）で alpha / pad を揃える
+        rows, order = np.unique(raw, return_index=True)
+        if rows.size != raw.size:
+            _dbg("[cutoff:apply] duplicate rows ignored: %d", int(raw.size - rows.size))
+        if np.array_equal(order, np.arange(raw.size)):
+            order = None
+    if rows.size == 0:
+        return
+
+    B, S, H = int(series.shape[0]), int(series.shape[1]), int(series.shape[2])
+    row_idx = torch.from_numpy(rows).to(series.device)
+    mask = torch.zeros((B, S), dtype=torch.bool, device=series.device)
+    mask[:, row_idx] = True
+
+    sel = None if order is None else torch.from_numpy(order).to(series.device)
+    pad_rows = None
+    if pad_sel is not None:
+        if sel is not None:
+            pad_sel = pad_sel.index_select(1, sel)
+        pad_rows = pad_sel.expand(B, -1, -1).reshape(-1, H)
+    if isinstance(alpha, (list, tuple)) or (_is_tensor(alpha) and alpha.dim() >= 1):
+        alpha = _alpha_rows(alpha, len(rows), series).reshape(-1)
+        if sel is not None:
+            alpha = alpha.index_select(0, sel)
+        alpha = alpha.repeat(B)
+    _apply_mask_inplace(series, mask, method, alpha, pad_rows)
+
+def _lookup_contexts(series) -> List[object]:
+    """
+    cond [B,S,H] の各サンプルの内容（anchor）から、それをエンコードした時のコンテキストを引く。
+    見つからないサンプル（negative / ターゲット無し / 設定変更後）は None。
+    """
+    try:
+        keys = vctx.anchor_keys(series)
+    except Exception as e:
+        _dbg("[cutoff:pc] anchor failed: %s; skip", e)
+        return []
+    found = {}
+    out = []
+    for k in keys:
+        if k not in found:
+            found[k] = vctx.lookup(k)
+        out.append(found[k])
+    return out
 
 # ---- 再入防止（thread-local） ----
 _tls = threading.local()
@@ -116,47 +314,582 @@ def _enter():
 def _leave():
     setattr(_tls, "inside_cutoff", False)
 
-# ---------- helper: 既存の CTPE を使って dummy_text をエンコード ----------
-def _encode_dummy_same_engine(dummy_text: str, enc_tag: str, expect_H: int):
+# ---- 生成1回分のメモ（process_cond はステップ毎・cond/uncond 毎に呼ばれるため） ----
+# 段1: 元 cond テンソル（同一オブジェクト）＋設定 → 合成済みテンソル（O(1) で返す）
+# 段2: コンテキスト列ごとの Victim マスク＋ダミー（Victim 行だけ抽出済み）→ 元テンソルが毎ステップ作り直されても再エンコードしない
+# 段3: コンテキストごとの Victim 行だけの pad [Kb,H]（UNet のデバイス・保持 dtype に載せたまま）
+#      バッチ構成（cond/uncond・Hires）が変わって段2が外れても、ダミー全体の転送・抽出はやり直さない
+# ジョブはスレッド単位で走るのでメモもスレッドローカル。ジョブ境界で reset_memo() により破棄する
+_PC_MEMO_MAX = 8
+_PAD_ROWS_MAX = 32
+_memo_tls = threading.local()
+
+def _memos() -> Tuple["OrderedDict[tuple, tuple]", "OrderedDict[tuple, object]", "OrderedDict[tuple, object]"]:
+    m = getattr(_memo_tls, "memos", None)
+    if m is None:
+        m = (OrderedDict(), OrderedDict(), OrderedDict())
+        _memo_tls.memos = m
+    return m
+
+def _settings_fingerprint() -> Tuple[object, ...]:
+    # ジョブの設定スナップショットの版（設定を読み直さずに済む）。ジョブごとの上書きも含む
+    return vctx.get_runtime_key()
+
+def _memo_key(src, batch_size, device) -> tuple:
+    return (id(src), int(batch_size), str(device), str(getattr(src, "dtype", "")), _settings_fingerprint())
+
+def _memo_get(key: tuple, src):
+    pc_memo = _memos()[0]
+    ent = pc_memo.get(key)
+    if ent is None or ent[0] is not src:
+        return None
+    pc_memo.move_to_end(key)
+    return ent[1]
+
+def _memo_put(key: tuple, src, blended):
+    pc_memo = _memos()[0]
+    # src を保持して id() の再利用を防ぐ
+    pc_memo[key] = (src, blended)
+    pc_memo.move_to_end(key)
+    while len(pc_memo) > _PC_MEMO_MAX:
+        pc_memo.popitem(last=False)
+
+def _pad_get(key: tuple):
+    pad_memo = _memos()[1]
+    ent = pad_memo.get(key)
+    if ent is not None:
+        pad_memo.move_to_end(key)
+    return ent
+
+def _pad_put(key: tuple, pad_sel):
+    pad_memo = _memos()[1]
+    pad_memo[key] = pad_sel
+    pad_memo.move_to_end(key)
+    while len(pad_memo) > _PC_MEMO_MAX:
+        pad_memo.popitem(last=False)
+
+def reset_memo():
+    """ジョブ境界で呼ぶ。このスレッドの合成済み cond / ダミーのメモを破棄する。"""
+    for m in _memos():
+        m.clear()
+
+# ---- ダミーエンコードの LRU（画像・バッチ・Hires・API ジョブをまたいで再利用） ----
+# key = (model hash, engine, ダミーのトークン列, 倍率列) / value = エンコード済み series
+# checkpoint が変わったら全破棄。容量は Settings の cutoff_forge_dummy_cache_mb（MB）
+# この下にディスク段（dummy_store；Settings で有効化）があり、メモリで外れた時だけ見る
+_dummy_cache = LRU(max_items=256, max_bytes=256 << 20)
+_dummy_cache_model = {"key": None}
+
+def _checkpoint_hash(sd_model) -> str:
+    """チェックポイントの内容ハッシュ（無ければ ""）。ディスク段のキーはこれがある時だけ使う。"""
+    info = getattr(sd_model, "sd_checkpoint_info", None)
+    for k in ("sha256", "shorthash", "hash"):
+        v = getattr(info, k, None) if info is not None else None
+        if v:
+            return str(v)
+    return str(getattr(sd_model, "sd_model_hash", None) or "")
+
+def _model_key(sd_model) -> str:
+    h = _checkpoint_hash(sd_model)
+    if h:
+        return h
+    # ハッシュが無い時はプロセス内でだけ通用する名前（ディスク段には使わない）
+    info = getattr(sd_model, "sd_checkpoint_info", None)
+    return str(getattr(info, "filename", None) or id(sd_model))
+
+def _te_patch_fingerprint(sd_model) -> tuple:
     """
-    Forge の既存 CTPE を用いて dummy_text をエンコード。
-    SDXL の場合は CLIP-L と CLIP-G を dim=2 で連結し、H 次元 (expect_H) を一致させる。
+    テキストエンコーダに当たっているパッチ（LoRA / extra networks）の指紋。
+    Forge の ModelPatcher：lora_patches のキー（ファイル・強度）と patches の件数と強度。
+    patches_uuid はクローンのたびに変わり、プロセスをまたぐと一致しないので使わない（ディスク段のキーにもなる）。
     """
-    if not dummy_text:
-        return None
     try:
-        from modules import shared
-        if not hasattr(shared, "sd_model") or shared.sd_model is None:
-            return None
+        patcher = sd_model.forge_objects.clip.patcher
+    except Exception:
+        return ()
+    out = []
+    lp = getattr(patcher, "lora_patches", None)
+    if lp:
+        out.append(tuple(sorted(repr(k) for k in lp.keys())))
+    p = getattr(patcher, "patches", None)
+    if p:
+        try:
+            out.append((len(p), round(sum(float(e[0]) for v in p.values() for e in v), 6)))
+        except Exception:
+            out.append((len(p),))
+    op = getattr(patcher, "object_patches", None)
+    if op:
+        out.append(tuple(sorted(str(k) for k in op.keys())))
+    return tuple(out)
+
+def _encoder_state(eng, sd_model) -> tuple:
+    """ダミーの出力を変える、トークン列以外のエンコーダ側の状態（CLIP skip・強調の実装・TE パッチ）。"""
+    emph = str(getattr(getattr(eng, "emphasis", None), "name", "") or "")
+    return (getattr(eng, "clip_skip", None), emph, _te_patch_fingerprint(sd_model))
+
+def _dummy_cache_sync(model_key: str):
+    if _dummy_cache_model["key"] != model_key:
+        _dummy_cache.clear()
+        _dummy_cache_model["key"] = model_key
+    try:
+        mb = int(getattr(opts, "cutoff_forge_dummy_cache_mb", 256))
+        _dummy_cache.max_bytes = max(0, mb) << 20
+    except Exception:
+        pass
 
-        eng_l = getattr(shared.sd_model, "text_processing_engine_l", None)
-        eng_g = getattr(shared.sd_model, "text_processing_engine_g", None)
+def dummy_cache_stats():
+    """hits / misses / evictions / items / bytes"""
+    return _dummy_cache.stats()
 
-        def _series(o):
-            return o[0] if (isinstance(o, tuple) and len(o) >= 1) else o
+metrics.register_source("dummy_cache", dummy_cache_stats)
 
-        ser_l = _series(eng_l([dummy_text])) if eng_l is not None else None
-        ser_g = _series(eng_g([dummy_text])) if eng_g is not None else None
+# ---------- helper: 既存の CTPE を使ってダミーをトークン列からエンコード ----------
+# engine → PAD（"_"）のトークン ID
+_pad_ids: "weakref.WeakKeyDictionary[object, int]" = weakref.WeakKeyDictionary()
 
-        # まず L/G 連結（SDXL 通常ケース）
-        if ser_l is not None and ser_g is not None:
-            import torch
-            cat = torch.cat([ser_l, ser_g], dim=2)  # H 次元で連結
-            if int(cat.shape[2]) == expect_H:
-                return cat
+def _pad_token_id(eng) -> int:
+    pid = _pad_ids.get(eng)
+    if pid is None:
+        try:
+            ids = eng.tokenize(["_"])[0]
+            pid = int(ids[0]) if len(ids) == 1 else int(eng.id_pad)
+        except Exception:
+            pid = int(getattr(eng, "id_pad", getattr(eng, "id_end", 0)))
+        _pad_ids[eng] = pid
+    return pid
 
-        # 片翼だけで H が一致するならそれを使用（保険）
-        if ser_l is not None and int(ser_l.shape[2]) == expect_H:
-            return ser_l
-        if ser_g is not None and int(ser_g.shape[2]) == expect_H:
-            return ser_g
+def _tokenize_line_raw(eng, text: str):
+    """tokenmap の横取り（tokenize_line のラッパ）を通さずにトークナイズする。"""
+    fn = getattr(getattr(type(eng), "tokenize_line", None), "__wrapped__", None)
+    return fn(eng, text) if fn is not None else eng.tokenize_line(text)
 
-        # どれも一致しなければ None（→ 平均フォールバックへ）
-        return None
+def _same_tokenization(a, b) -> bool:
+    """a と b の tokenize_line が同じチャンクを返すか（SDXL の L / G は同じ CLIP BPE・同じチャンク長）。"""
+    keys = ("id_start", "id_end", "chunk_length", "comma_token", "comma_padding_backtrack")
+    if any(getattr(a, k, None) != getattr(b, k, None) for k in keys):
+        return False
+    ta, tb = getattr(a, "tokenizer", None), getattr(b, "tokenizer", None)
+    return type(ta) is type(tb) and getattr(ta, "vocab_size", None) == getattr(tb, "vocab_size", None)
+
+def _line_chunks(eng, text: str):
+    """
+    eng で text をトークナイズしたチャンク。エンコード時に横取りした分があればそれを、
+    追い出されていれば同じトークナイズの別エンジン（L / G）の分を使い、どちらにも無い時だけ1回トークナイズして両方へ載せる。
+    埋め込み（fixes）を含むチャンクはエンジンごとの埋め込みを指すので共有しない。
+    """
+    chunks = vctx.get_chunks(eng, text)
+    if chunks is not None:
+        return chunks
+    others = [sp[1] for sp in engines.spans() if sp[1] is not eng and _same_tokenization(eng, sp[1])]
+    for other in others:
+        chunks = vctx.get_chunks(other, text)
+        if chunks is not None and not any(ch.fixes for ch in chunks):
+            metrics.incr("chunks_shared")
+            vctx.put_chunks(eng, text, chunks)
+            return chunks
+    metrics.incr("retokenize")
+    with metrics.stage("tokenize"):
+        chunks = _tokenize_line_raw(eng, text)[0]
+    vctx.put_chunks(eng, text, chunks)
+    if not any(ch.fixes for ch in chunks):
+        for other in others:
+            vctx.put_chunks(other, text, chunks)
+    return chunks
+
+def _dummy_chunks(eng, ctx, positions=None):
+    """
+    エンコード時に横取りした eng のチャンクで、ターゲット一致位置（positions；既定は ctx.dummy_positions）だけ
+    PAD に差し替えたものを返す。倍率（強調構文）・埋め込み（fixes）は元のまま。再トークナイズしないので長さは元と一致する。
+    """
+    chunks = _line_chunks(eng, ctx.text)
+    pad_id = _pad_token_id(eng)
+    if positions is None:
+        positions = ctx.dummy_positions
+    out = []
+    off = 0
+    k = 0
+    for ch in chunks:
+        n = len(ch.tokens)
+        toks = list(ch.tokens)
+        while k < len(positions) and positions[k] < off + n:
+            toks[positions[k] - off] = pad_id
+            k += 1
+        dup = copy.copy(ch)
+        dup.tokens = toks
+        out.append(dup)
+        off += n
+    return out
+
+def _process_chunks(eng, chunks):
+    """チャンクの列を1回の process_tokens でエンコードし [len(chunks),77,H] を返す（チャンクごとに独立な系列）。"""
+    emb = getattr(eng, "embeddings", None)
+    if emb is not None:
+        emb.fixes = [ch.fixes for ch in chunks]
+    return eng.process_tokens([ch.tokens for ch in chunks], [ch.multipliers for ch in chunks])
+
+def _raw_tokens(eng, chunks):
+    """process_tokens と同じく、各チャンクの最初の id_end より後ろを id_pad にしたトークン [N,77]（G は PAD が別）。"""
+    import torch
+    rows = [list(ch.tokens) for ch in chunks]
+    id_end, id_pad = getattr(eng, "id_end", None), getattr(eng, "id_pad", None)
+    if id_end is not None and id_pad is not None and id_end != id_pad:
+        for r in rows:
+            if id_end in r:
+                i = r.index(id_end)
+                r[i + 1:] = [id_pad] * (len(r) - i - 1)
+    return torch.asarray(rows)
+
+def _encode_chunk_lists(eng, lists):
+    """
+    ダミーごとのチャンク列 lists を、テキストエンコーダ 1 回の forward でまとめてエンコードし、それぞれ [1,S_i,H] を返す。
+    process_tokens と同じ手順（PAD 置換 → encode_with_transformers → 強調）をここで行い、
+    ラップされた __call__・tokenize_line を通らない（tokenmap の照合・記録も走らない）。
+    強調（倍率≠1）はチャンクごとに掛ける：Original の強調は平均をバッチ全体で取り直すので、
+    元の cond と同じく 1 チャンク単位にし、一緒に積んだものによって結果が変わらないようにする。
+    """
+    import torch
+    flat = [ch for chunks in lists for ch in chunks]
+    encode = getattr(eng, "encode_with_transformers", None)
+    emph = getattr(eng, "emphasis", None)
+    if not flat:
+        zs = []
+    elif callable(encode) and callable(getattr(emph, "after_transformers", None)):
+        emb = getattr(eng, "embeddings", None)
+        if emb is not None:
+            emb.fixes = [ch.fixes for ch in flat]
+        z = encode(_raw_tokens(eng, flat))
+        metrics.incr("dummy_encoder_forwards")
+        zs = []
+        for i, ch in enumerate(flat):
+            zi = z[i:i + 1]
+            if any(float(m) != 1.0 for m in ch.multipliers):
+                emph.tokens = [list(ch.tokens)]
+                emph.multipliers = torch.asarray([ch.multipliers]).to(zi)
+                emph.z = zi
+                emph.after_transformers()
+                zi = emph.z
+            zs.append(zi)
+    else:
+        # 想定外の CTPE（process_tokens しか無い）：チャンクごとに公開経路で
+        zs = [_process_chunks(eng, [ch]) for ch in flat]
+        metrics.incr("dummy_encoder_forwards", len(flat))
+    out, k = [], 0
+    for chunks in lists:
+        out.append(torch.hstack(zs[k:k + len(chunks)]))
+        k += len(chunks)
+    return out
+
+def _encode_dummies(span, reqs):
+    """
+    span（= 登録簿の (tag, engine, c0, c1)）のエンジンだけで、reqs = [(ctx, positions, only)] のダミーをまとめてエンコードし、
+    それぞれ [1,S,c1-c0]（only（チャンク番号の列）を渡したものは [1,len(only)*77,c1-c0]）か None を返す。
+    適用しないエンジンはエンコードしない。series は LRU に載せ、同じ checkpoint・同じトークン列なら再エンコードしない。
+    メモリ LRU で外れたらディスク段（dummy_store）を見て、そこにも無いものだけを1回のエンコードに積んで両方へ載せる。
+    """
+    out = [None] * len(reqs)
+    tag, eng, c0, c1 = span
+    try:
+        from modules import shared
+        if not hasattr(shared, "sd_model") or shared.sd_model is None:
+            return out
+
+        mkey = _model_key(shared.sd_model)
+        _dummy_cache_sync(mkey)
+        # ディスク段はチェックポイントの内容ハッシュがある時だけ（id() やファイル名は別のモデルを指しうる）
+        persist = bool(_checkpoint_hash(shared.sd_model))
+        state = _encoder_state(eng, shared.sd_model)
+
+        todo: Dict[tuple, Tuple[list, List[int]]] = {}
+        for i, (ctx, positions, only) in enumerate(reqs):
+            if not positions:
+                continue
+            chunks = _dummy_chunks(eng, ctx, positions)
+            if only is not None:
+                chunks = [chunks[j] for j in only if j < len(chunks)]
+            key = (mkey, tag.name,
+                   tuple(t for ch in chunks for t in ch.tokens),
+                   tuple(float(m) for ch in chunks for m in ch.multipliers),
+                   state)
+            if key in todo:
+                todo[key][1].append(i)
+                continue
+            ser = _dummy_cache.get(key)
+            if ser is None:
+                metrics.incr("dummy_cache_miss")
+                if persist:
+                    with metrics.stage("dummy_disk_load"):
+                        ser = dummy_store.load(key)
+                if ser is not None:
+                    _dummy_cache.put(key, ser)
+            else:
+                metrics.incr("dummy_cache_hit")
+            if ser is None:
+                todo[key] = (chunks, [i])
+            else:
+                out[i] = ser
+
+        if todo:
+            with metrics.stage("dummy_encode"):
+                sers = _encode_chunk_lists(eng, [chunks for chunks, _ix in todo.values()])
+            for (key, (_chunks, ix)), ser in zip(todo.items(), sers):
+                if persist:
+                    dummy_store.save(key, ser)
+                _dummy_cache.put(key, ser)
+                for i in ix:
+                    out[i] = ser
+
+        # 列幅が合わなければ None（→ 平均フォールバックへ）
+        return [ser if ser is not None and int(ser.shape[2]) == int(c1 - c0) else None for ser in out]
     except Exception as e:
         # 失敗はデバッグ時のみ表示（WARNINGで統一）
         _dbg("[cutoff:L3] dummy encode failed: %s", e)
-        return None
+        metrics.incr("dummy_encode_failed")
+        return [None] * len(reqs)
+
+def _pad_storage_dtype(dtype):
+    """pad の保持 dtype（Settings の cutoff_forge_pad_dtype；auto = cond と同じ）。"""
+    import torch
+    try:
+        name = str(getattr(opts, "cutoff_forge_pad_dtype", "auto") or "auto")
+    except Exception:
+        name = "auto"
+    return {"float16": torch.float16, "bfloat16": torch.bfloat16}.get(name, dtype)
+
+# ---- 変更チャンクだけのダミー ----
+# ダミーがターゲットを含むチャンクだけ元と異なる。CLIP はチャンクごとに独立にエンコードされるので、
+# 変更の無いチャンクのダミー行は元の cond の行と同一＝補間しても値が変わらない。
+# そのチャンクはエンコードせず、Victim からも外す（Settings の cutoff_forge_dummy_changed_chunks_only）
+def _selective() -> bool:
+    try:
+        return bool(getattr(opts, "cutoff_forge_dummy_changed_chunks_only", True))
+    except Exception:
+        return True
+
+def _chunk_rows(spans) -> int:
+    """1チャンクの行数（BOS + chunk_length + EOS）。"""
+    eng = spans[0][1] if spans else None
+    return int(getattr(eng, "chunk_length", 75) or 75) + 2
+
+def _changed_chunks(ctx, n: int, positions=None) -> Tuple[int, ...]:
+    if positions is None:
+        positions = ctx.dummy_positions
+    return tuple(sorted({int(p) // n for p in positions}))
+
+def _ctx_variants(ctx):
+    """ctx のダミーごとの (PAD にする位置, 補間する行)。0 番は全ターゲットを PAD にしたダミー、以降は Target グループ。"""
+    return [(ctx.dummy_positions, ctx.rows_victim)] + list(getattr(ctx, "groups", ()) or ())
+
+def _ctx_victims(ctx, n: int, selective: bool, positions=None, victim=None) -> np.ndarray:
+    """ctx の Victim 行（bool [S]；既定は 0 番のダミー）。selective ならダミーが変わるチャンクの行だけに絞る。"""
+    if victim is None:
+        victim = ctx.rows_victim
+    if not selective:
+        return victim
+    keep = np.zeros(-(-int(ctx.S) // n), dtype=bool)
+    keep[list(_changed_chunks(ctx, n, positions))] = True
+    return victim & np.repeat(keep, n)[:int(ctx.S)]
+
+def _victim_pad_rows(reqs, span, S: int, dev, store_dtype, n: int, selective: bool):
+    """
+    reqs = [(ctx, vi, positions, rows)] について、ダミー vi の rows 行だけ [K,c1-c0]（span の列範囲）を dev / store_dtype で返す
+    （失敗・長さ不一致は None）。生成中は段3メモから返し、外れたダミーは _encode_dummies の1回のエンコードにまとめる。
+    行の抽出はダミーのあるデバイス側で先に行い、転送するのは Victim 行だけ。
+    selective なら変更チャンクだけをエンコードし、行番号をそのチャンク列の中の位置へ読み替える。
+    """
+    import torch
+    rows_memo = _memos()[2]
+    out = [None] * len(reqs)
+    miss = []
+    for i, (ctx, vi, _positions, _rows) in enumerate(reqs):
+        key = (ctx.uid, vi, span[0].name, span[2], span[3], str(dev), str(store_dtype), selective)
+        ent = rows_memo.get(key)
+        if ent is not None:
+            rows_memo.move_to_end(key)
+            out[i] = ent if ent is not False else None
+        else:
+            miss.append((i, key))
+    if not miss:
+        return out
+
+    # Forgeの既存CTPEで、この列範囲のエンジンだけダミーをエンコード（外れた分をまとめて1回）
+    enc = []
+    for i, _key in miss:
+        ctx, _vi, positions, _rows = reqs[i]
+        enc.append((ctx, positions, _changed_chunks(ctx, n, positions) if selective else None))
+    sers = _encode_dummies(span, enc)
+
+    for (i, key), (_ctx, _positions, only), series_pad in zip(miss, enc, sers):
+        rows = reqs[i][3]
+        expect = len(only) * n if only is not None else S
+        if series_pad is not None and int(series_pad.shape[1]) != expect:
+            # 長さ不一致は安全にフォールバック
+            _dbg("[cutoff:pc] dummy S mismatch (%d != %d); fallback to mean", int(series_pad.shape[1]), expect)
+            metrics.incr("dummy_length_mismatch")
+            series_pad = None
+        pad = None
+        if series_pad is not None:
+            if only is not None:
+                slot = np.zeros(max(only) + 1, dtype=np.int64)
+                slot[list(only)] = np.arange(len(only))
+                rows = slot[rows // n] * n + rows % n
+            idx = torch.from_numpy(np.ascontiguousarray(rows, dtype=np.int64)).to(series_pad.device)
+            pad = series_pad[0].index_select(0, idx).to(device=dev, dtype=store_dtype, non_blocking=True)  # [K,H]
+        rows_memo[key] = pad if pad is not None else False
+        out[i] = pad
+
+    while len(rows_memo) > _PAD_ROWS_MAX:
+        rows_memo.popitem(last=False)
+    return out
+
+# ---- Distance decay（Victim 行ごとの α を最寄りの Source 行からの距離で弱める） ----
+_DECAY_MIN_ALPHA = 0.15
+
+def _decay_t(ctx, rows: np.ndarray) -> np.ndarray:
+    """
+    rows（ctx の Victim 行番号；昇順）について、最寄りの Source 行までの距離を Source 行の広がりで割った t∈[0,1] を [K] で返す。
+    Source 行（昇順）に searchsorted して左右の隣だけを見る（O(K log S)）。
+    """
+    src = np.flatnonzero(ctx.rows)
+    if src.size == 0:
+        # Victim があれば Source（ヒット行）も必ずあるが、念のため減衰なし扱い
+        return np.zeros(len(rows), dtype=np.float32)
+    i = np.searchsorted(src, rows)
+    right = src[np.minimum(i, src.size - 1)]
+    left = src[np.maximum(i - 1, 0)]
+    d = np.minimum(np.abs(rows - left), np.abs(right - rows))
+    dmax = max(1, int(src[-1]) - int(src[0]))
+    return np.clip(d.astype(np.float32) / float(dmax), 0.0, 1.0)
+
+def _decay_alpha(t, alpha: float, mode: str, strength: float):
+    """t [K] → 行ごとの α [K]（linear: 1-t / cosine: (1+cos πt)/2 に α·strength を掛け、[0.15, 1] に収める）。"""
+    import math
+    import torch
+    if mode == "linear":
+        scale = 1.0 - t
+    else:
+        scale = 0.5 * (1.0 + torch.cos(t * math.pi))
+    return (scale * (float(alpha) * float(strength))).clamp_(_DECAY_MIN_ALPHA, 1.0)
+
+def _merge_full_width(parts, H: int):
+    """
+    列範囲が [0,H) を隙間なく覆う（SDXL で TE1/TE2 とも ON）なら、pad 行を列方向に連結して全幅 1 回の補間にする。
+    Slerp / Nlerp の角度・ノルムは全 2048 列で取る（従来の挙動）。一部の列範囲だけなら列範囲ごとのまま。
+    """
+    if len(parts) < 2:
+        return parts
+    import torch
+    spans = sorted(parts, key=lambda x: x[0])
+    edge = 0
+    for c0, c1, _pad in spans:
+        if c0 != edge:
+            return parts
+        edge = c1
+    if edge != H:
+        return parts
+    pads = [pad for _c0, _c1, pad in spans]
+    if all(pad is None for pad in pads):
+        return [(0, H, None)]
+    if any(pad is None for pad in pads):
+        return parts
+    return [(0, H, torch.cat(pads, dim=1))]
+
+def _prepare_victims(series, ctxs, spans):
+    """
+    サンプルごとのコンテキストから、Victim マスク [B,S] と、列範囲ごとの pad 行
+    [(c0, c1, [K,c1-c0])]（マスク順）と、Distance decay 用の t [K]（マスク順）を作る。
+    Victim 行はダミー（全ターゲット PAD / Target グループごと）で互いに重ならないので、マスクは1枚・補間は1回で済む。
+    ダミーは列範囲ごとに全コンテキスト・全グループの分をまとめて1回でエンコードし、
+    失敗/長さ不一致のものはそのサンプルの平均へ。
+    """
+    import torch
+    B, S = int(series.shape[0]), int(series.shape[1])
+    dev = series.device
+    store_dtype = _pad_storage_dtype(series.dtype)
+    n = _chunk_rows(spans)
+    selective = _selective()
+    # コンテキストの bool 配列を [B,S] に並べ、一度だけデバイスへ送る
+    mask_np = np.zeros((B, S), dtype=bool)
+    used = []
+    for b, ctx in enumerate(ctxs):
+        if ctx is None or ctx.S != S:
+            continue
+        variants = []
+        for vi, (positions, victim) in enumerate(_ctx_variants(ctx)):
+            if not victim.any():
+                continue
+            vm = _ctx_victims(ctx, n, selective, positions, victim)
+            dropped = int(victim.sum()) - int(vm.sum())
+            if dropped:
+                metrics.incr("victim_rows_unchanged_chunk", dropped)
+            if vm.any():
+                variants.append((vi, positions, np.flatnonzero(vm)))
+                mask_np[b] |= vm
+        if variants:
+            used.append((b, ctx, np.flatnonzero(mask_np[b]), variants))
+    mask = torch.from_numpy(mask_np).to(dev)
+
+    # マスク順（b→s）の t。used は b 昇順・rows は昇順なので連結すればそのままマスク順
+    t = torch.from_numpy(np.concatenate([_decay_t(ctx, rows) for _b, ctx, rows, _v in used])).to(dev) if used else None
+
+    # ダミーごとの行をマスク順へ並べ替える添字（グループが1つなら不要）
+    orders = {}
+    for b, _ctx, _rows, variants in used:
+        if len(variants) > 1:
+            order = np.argsort(np.concatenate([rv for _vi, _p, rv in variants]), kind="stable")
+            orders[b] = torch.from_numpy(order).to(dev)
+
+    reqs = [(ctx, vi, positions, rv) for _b, ctx, _rows, variants in used for vi, positions, rv in variants]
+    parts = []
+    for span in spans:
+        c0, c1 = span[2], span[3]
+        got = iter(_victim_pad_rows(reqs, span, S, dev, store_dtype, n, selective))
+        pads = []
+        for b, _ctx, _rows, variants in used:
+            seg = []
+            for _vi, _positions, rv in variants:
+                pad = next(got)
+                if pad is None:
+                    metrics.incr("pad_mean_fallback")
+                    pad = series[b, :, c0:c1].mean(dim=0, keepdim=True).expand(len(rv), -1).to(store_dtype)
+                seg.append(pad)
+            pads.append(torch.cat(seg, dim=0).index_select(0, orders[b]) if b in orders else seg[0])
+        parts.append((c0, c1, torch.cat(pads, dim=0) if pads else None))
+    return mask, _merge_full_width(parts, int(series.shape[2])), t
+
+# ---- 先回り（precompute）----
+def _load_text_encoders():
+    """Forge がテキストエンコーダを GPU から外していれば載せ直す（get_learned_conditioning と同じ手順）。"""
+    try:
+        from modules import shared
+        from backend import memory_management
+        memory_management.load_model_gpu(shared.sd_model.forge_objects.clip.patcher)
+    except Exception:
+        pass
+
+def warm_dummies(text: str, dummy_positions, groups=()) -> int:
+    """
+    生成前に text のダミー（全ターゲット PAD と Target グループごと）を適用対象のエンジンごとにエンコードし、
+    ダミー LRU（とディスク段）へ載せる。ctx はまだ無いので、_dummy_chunks が見る text / dummy_positions だけの仮の ctx を使う。
+    戻り値はエンコードできたダミー×列範囲の数。
+    """
+    import torch
+    variants = [tuple(p) for p in [dummy_positions] + [g[0] for g in (groups or ())] if p]
+    if not variants:
+        return 0
+    lay = engines.spans()
+    spans = [sp for sp in lay if _apply_for_enc(sp[0].enc)]
+    if not spans:
+        return 0
+    ctx = types.SimpleNamespace(text=text, dummy_positions=variants[0])
+    n = _chunk_rows(lay)
+    selective = _selective()
+    reqs = [(ctx, p, _changed_chunks(ctx, n, p) if selective else None) for p in variants]
+    _load_text_encoders()
+    done = 0
+    with torch.no_grad():
+        for span in spans:
+            done += sum(1 for ser in _encode_dummies(span, reqs) if ser is not None)
+    return done
 
 # ---------- patch ----------
 def try_install():
@@ -173,19 +906,27 @@ def try_install():
     if hasattr(condmod, "ConditionCrossAttn") and hasattr(condmod, "ConditionCrossAttn") and hasattr(condmod.ConditionCrossAttn, "process_cond"):
         _orig_pc = condmod.ConditionCrossAttn.process_cond
 
+        # Enable OFF 時はこのラッパごと外す（patches.apply）ので、ここでは有効判定をしない
         def _pc_wrapped(self, batch_size, device, **kwargs):
-            ret = _orig_pc(self, batch_size=batch_size, device=device, **kwargs)
-
-            try:
-                enabled = bool(getattr(opts, "cutoff_forge_enable", False))
-            except Exception:
-                enabled = False
-            if not enabled:
+            # 2ステップ目以降：同じ cond・同じ設定なら合成済みテンソルをそのまま返す
+            src = getattr(self, "cond", None)
+            mkey = _memo_key(src, batch_size, device) if _is_tensor(src) else None
+            hit = _memo_get(mkey, src) if mkey is not None else None
+            if hit is not None:
+                metrics.incr("pc_memo_hit")
+                copy_with = getattr(self, "_copy_with", None)
+                if callable(copy_with):
+                    return copy_with(hit)
+                ret = _orig_pc(self, batch_size=batch_size, device=device, **kwargs)
+                ret.cond = hit
                 return ret
 
+            ret = _orig_pc(self, batch_size=batch_size, device=device, **kwargs)
+
             series = getattr(ret, "cond", None)
             if not (_is_tensor(series) and series.dim() == 3):
                 _dbg("[cutoff:pc] cond is not 3D tensor; skip")
+                metrics.skip("not_3d")
                 return ret
 
             method = str(vctx.get_runtime("method", "Slerp") or "Slerp")
@@ -194,133 +935,94 @@ def try_install():
 
             S = int(series.shape[1])
             H = int(series.shape[2])
-            enc = _enc_tag_from_S(S)
-            if not _apply_for_enc(enc):
-                return ret
-
-            # UIとvctxのtargets一致確認
-            current_targets = str(vctx.get_runtime("targets", "") or "").lower().replace("，", ",")
-            current_canon = ",".join([w.strip() for w in current_targets.split(",") if w.strip()])
-            vctx_canon = vctx.get_targets_canon() or ""
-            if vctx_canon != current_canon:
-                _dbg("[cutoff:pc] targets mismatch (vctx=%s, ui=%s); skip once",
-                     (vctx_canon or "<empty>"), (current_canon or "<empty>"))
-                return ret
-
-            # Victim（初期）
-            rows_victim_enc = _select_rows_sanity(S) if sanity else vctx.get_rows_victim(enc)
-            if not rows_victim_enc:
-                _dbg("[cutoff:pc] enc=%s S=%d victim_rows=0 targets=%s", enc, S, vctx.get_targets_canon() or "<empty>")
+            # 適用するエンコーダの列範囲（登録簿から；S による推定はしない）
+            spans = _active_spans(H)
+            if not spans:
+                metrics.skip("enc_disabled")
                 return ret
+            enc = "+".join(sp[0].enc for sp in spans)
 
             # 再入防止
             if _already_inside():
                 _dbg("[cutoff:pc] re-entrancy detected; skip")
+                metrics.skip("reentrant")
                 return ret
 
-#            # TE-aware mode
-#            teaware = str(vctx.get_runtime("teaware_mode", "off") or "off")
-
-#            # Distance decay 設定
-#            decay_mode = str(vctx.get_runtime("decay_mode", "off") or "off")
-#            decay_strength = float(vctx.get_runtime("decay_strength", 0.5) or 0.5)
-            decay_mode, decay_strength = "off", 0.5 #常にOFF
-
-            # Source行（距離計算に使用）— vctx が未実装ならフォールバック
-            rows_source_enc = set(vctx.get_rows(enc) or [])
-
-#            # TE-aware Safe(AND) の場合、両TEの Victim 交差を採用
-#            if teaware == "safe_and":
-#                try:
-#                    v1 = set(vctx.get_rows_victim("TE1") or [])
-#                    v2 = set(vctx.get_rows_victim("TE2") or [])
-#                    rows_victim = sorted(v1.intersection(v2))
-#                except Exception:
-#                    rows_victim = rows_victim_enc  # 取得失敗時はそのまま
-#            else:
-#                # 現状どおり：この enc に対して適用
-#                rows_victim = rows_victim_enc
-
-            # --- TE-aware disabled: 常にこの enc の Victim を適用（off 相当） ---
-            rows_victim = rows_victim_enc
-
-            if not rows_victim:
-                _dbg("[cutoff:pc] victim_rows empty after TE-aware filtering; skip")
-                return ret
-
-            # ダミー（pad）を用意
-            pad_sel_all = None
-            dummy_text = vctx.get_dummy_text(enc)
+            # Distance decay 設定
+            decay_mode = str(vctx.get_runtime("decay_mode", "off") or "off")
+            decay_strength = float(vctx.get_runtime("decay_strength", 0.5) or 0.5)
 
             try:
                 _enter()
-                # Forgeの既存CTPEでダミーをエンコード（H次元を期待形に合わせる）
-                series_pad = _encode_dummy_same_engine(dummy_text, enc_tag=enc, expect_H=H) if (not sanity) else None
-
-                # 長さ不一致は安全にフォールバック
-                if series_pad is not None:
-                    try:
-                        if int(series_pad.shape[1]) != S:
-                            _dbg("[cutoff:pc] dummy S mismatch (%d != %d); fallback to mean", int(series_pad.shape[1]), S)
-                            series_pad = None
-                    except Exception:
-                        series_pad = None
-
-                import math
                 import torch
-                if series_pad is not None:
-                    if series_pad.device != series.device or series_pad.dtype != series.dtype:
-                        series_pad = series_pad.to(device=series.device, dtype=series.dtype, non_blocking=True)
-                    # 全 Victim 行の pad を一括抽出
-                    row_idx_all = torch.as_tensor(rows_victim, device=series.device, dtype=torch.long)
-                    pad_sel_all = series_pad[:, row_idx_all, :]
+
+                if sanity:
+                    # Sanity：行マップ不要。全サンプルの末尾 N% を平均へ
+                    rows_sanity = _select_rows_sanity(S)
+                    if not rows_sanity:
+                        metrics.skip("sanity_empty")
+                        return ret
+                    mask = torch.zeros((int(series.shape[0]), S), dtype=torch.bool, device=series.device)
+                    mask[:, torch.as_tensor(rows_sanity, device=series.device, dtype=torch.long)] = True
+                    parts = _merge_full_width([(sp[2], sp[3], None) for sp in spans], H)
+                    ctxs = []
+                    tdist = None
+                    alphas = {}
                 else:
-                    pad_sel_all = None  # 平均は _apply_rows_inplace 内で一度だけ計算
-
-#                # 行ごとの α_i を準備（距離減衰 Off の場合は単一αにする）
-#                use_vector_alpha = False
-#                if decay_mode == "off" or (not rows_source_enc):
-#                    # 以前どおり：単一αで一括適用（ブロードキャスト不要）
-#                    alpha_arg = float(alpha)
-#                else:
-#                    use_vector_alpha = True
-#                    # Dmax を簡便に：Source 行の最小～最大の広がり
-#                    Smin = min(rows_source_enc) if rows_source_enc else 0
-#                    Smax = max(rows_source_enc) if rows_source_enc else (S - 1)
-#                    Dmax = max(1, (Smax - Smin) or 1)
-#                    alphas_rows: List[float] = []
-#                    for i in rows_victim:
-#                        d = min((abs(i - j) for j in rows_source_enc)) if rows_source_enc else Dmax
-#                        t = max(0.0, min(1.0, d / Dmax))
-#                        if decay_mode == "linear":
-#                            scale = (1.0 - t)
-#                        else:
-#                            # cosine
-#                            scale = 0.5 * (1.0 + math.cos(math.pi * t))
-#                        a_i = float(alpha) * float(decay_strength) * float(scale)
-#                        a_i = max(0.15, min(1.0, a_i))
-#                        alphas_rows.append(a_i)
-                # 行ごとの α は常に単一値（Distance decay 無効）
-                use_vector_alpha = False
+                    # この cond（の内容）に紐づくコンテキストをサンプルごとに引く
+                    ctxs = _lookup_contexts(series)
+                    if not any(c is not None for c in ctxs):
+                        _dbg("[cutoff:pc] enc=%s S=%d no token map bound to this cond; skip", enc, S)
+                        metrics.skip("no_context")
+                        return ret
+
+                    # Victim マスクとダミーはジョブ中に変わらないので、同じコンテキスト列・同じ形ならメモを使う
+                    pkey = (tuple(c.uid if c is not None else 0 for c in ctxs), S, H,
+                            tuple((sp[2], sp[3]) for sp in spans), _selective(), str(series.device), str(series.dtype))
+                    prepared = _pad_get(pkey)
+                    if prepared is None:
+                        metrics.incr("pad_memo_miss")
+                        with metrics.stage("prepare_victims"):
+                            # 末尾の dict は Distance decay の α ベクトル（同じエントリに持たせ、メモの枠を取り合わない）
+                            prepared = _prepare_victims(series, ctxs, spans) + ({},)
+                        _pad_put(pkey, prepared)
+                    else:
+                        metrics.incr("pad_memo_hit")
+                    mask, parts, tdist, alphas = prepared
+
+                # 行ごとの α（Distance decay）。t は Victim と一緒にメモ済みなので、ここは設定ごとに1回の要素演算だけ
                 alpha_arg = float(alpha)
+                if decay_mode in ("linear", "cosine") and tdist is not None:
+                    akey = (decay_mode, alpha_arg, decay_strength)
+                    alpha_vec = alphas.get(akey)
+                    if alpha_vec is None:
+                        alpha_vec = _decay_alpha(tdist, alpha_arg, decay_mode, decay_strength)
+                        alphas[akey] = alpha_vec
+                    alpha_arg = alpha_vec
 
-                # ---- まとめて一発適用（順序非依存）----
-                if use_vector_alpha:
-                    _apply_rows_inplace(series, rows=rows_victim, method=method, alpha=alphas_rows, pad_sel=pad_sel_all)
-                else:
-                    _apply_rows_inplace(series, rows=rows_victim, method=method, alpha=alpha_arg, pad_sel=pad_sel_all)
+                # ---- 全サンプルまとめて一発適用（サンプルごとに別の Victim 行；順序非依存）----
+                # 列範囲ごとに適用（SDXL で TE1/TE2 とも ON なら _merge_full_width で全幅 1 回）
+                with metrics.stage("blend"):
+                    for c0, c1, pad_rows in parts:
+                        view = series if (c0 == 0 and c1 == H) else series[:, :, c0:c1]
+                        _apply_mask_inplace(view, mask, method=method, alpha=alpha_arg, pad_rows=pad_rows)
+                metrics.incr("pc_applied")
+
+                if log.isEnabledFor(logging.DEBUG):
+                    targets = ",".join(sorted({c.targets_canon for c in ctxs if c is not None}))
+                    _dbg("[cutoff:pc] enc=%s B=%d S=%d victim_rows=%d method=%s alpha_base=%.2f decay=%s targets=%s dummy_cache(hit/miss)=%d/%d",
+                         enc, int(series.shape[0]), S, int(mask.sum().item()), method, float(alpha), decay_mode, targets or "<empty>",
+                         _dummy_cache.hits, _dummy_cache.misses)
 
-                _dbg("[cutoff:pc] enc=%s S=%d victim_rows=%d method=%s alpha_base=%.2f decay=%s targets=%s",
-                     enc, S, len(rows_victim), method, float(alpha), "off", vctx.get_targets_canon() or "<empty>")
+                if mkey is not None:
+                    _memo_put(mkey, src, series)
             finally:
                 _leave()
-                try:
-                    del series_pad
-                except Exception:
-                    pass
 
             return ret
 
+        # 元の関数はクラスに持たせる（モジュールが二重に読まれても正しく戻せるように）。None = 継承していた
+        setattr(condmod.ConditionCrossAttn, "__cutoff_orig_pc__", condmod.ConditionCrossAttn.__dict__.get("process_cond"))
         condmod.ConditionCrossAttn.process_cond = _pc_wrapped  # type: ignore
         _dbg("patched ConditionCrossAttn.process_cond (victim-only dummy interpolation)")
     else:
@@ -329,3 +1031,26 @@ def try_install():
 
     setattr(condmod.ConditionCrossAttn, "__cutoff_wrapped__", True)
     return True
+
+def uninstall():
+    """process_cond を元に戻し、メモ・コンテキストを捨てる。"""
+    try:
+        import backend.sampling.condition as condmod
+    except Exception:
+        return False
+    K = getattr(condmod, "ConditionCrossAttn", None)
+    if K is None or not K.__dict__.get("__cutoff_wrapped__", False):
+        return True
+    orig = K.__dict__.get("__cutoff_orig_pc__")
+    if orig is None:
+        delattr(K, "process_cond")
+    else:
+        K.process_cond = orig  # type: ignore
+    delattr(K, "__cutoff_orig_pc__")
+    setattr(K, "__cutoff_wrapped__", False)
+    reset_memo()
+    vctx.clear()
+    _dbg("restored ConditionCrossAttn.process_cond")
+    return True
+
+patches.register("process_cond", try_install, uninstall)
@@ -1,26 +1,38 @@
-# 揮発ストア：都度検出した行インデックスを TE ごとに上書き保存するだけ
-# 永続化・キー・epoch なし
-
-from typing import Dict, List, Optional
-
-_state: Dict[str, object] = {
-    # rows_by_enc: {"TE1": [int...], "TE2": [int...] }  ※従来の「ターゲット行（Source近傍）」は互換のため保持
-    "rows_by_enc": {"TE1": [], "TE2": []},
-
-    # Victim 行（= 中立化の適用対象）を別に保持
-    "rows_victim_by_enc": {"TE1": [], "TE2": []},
-
-    # 現在の targets（正規化済み CSV 文字列；観測用）
-    "targets_canon": "",
-
-    # ダミープロンプト（string）。エンコードは L3 でオンデマンド
-    "dummy_text_by_enc": {"TE1": "", "TE2": ""},
-
-    # 直近の enc_tag を控える（安全のため）
-    "last_enc_tag": "",
-
-    # 追加: ランタイム設定（セッション限定；永続化しない）
-    "runtime_cfg": {
+# 揮発ストア：エンコード毎に求めた行マップを「不変のコンテキスト」として、
+# そのエンコード結果（conditioning）の内容そのものに紐づけて保存する（永続化しない）
+# ・紐づけキー（anchor）= 出力テンソル先頭数列の値。process_cond 側で同じ値の cond を引けば、
+#   別ジョブや negative prompt のエンコードが間に挟まっても取り違えない
+# ・設定（runtime_cfg）はジョブ開始時にスナップショットを取り、ジョブ中はそれだけを読む
+
+import itertools
+import re
+import threading
+import weakref
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+try:
+    from scripts.forge_cutoff.lru import LRU
+except Exception:
+    from forge_cutoff.lru import LRU
+try:
+    from scripts.forge_cutoff import metrics
+except Exception:
+    from forge_cutoff import metrics
+
+# anchor に使う列数（先頭 ANCHOR_COLS 列 × 全行）
+ANCHOR_COLS = 4
+
+_lock = threading.Lock()
+_tls = threading.local()
+_uid = itertools.count(1)
+
+# ランタイム設定（セッション限定；永続化しない）。更新はコピーして差し替える（読み手はロック不要）
+_runtime: Dict[str, object] = {
+    "cfg": MappingProxyType({
         "method": "Slerp",
         "strength": 0.5,
         "targets": "",
@@ -34,61 +46,170 @@ _state: Dict[str, object] = {
         "teaware_mode": "off",
         "sanity": False,
         "cut_ratio": 50,
-    },
+    }),
+    # runtime_cfg が書き換わるたびに +1（メモ無効化用）
+    "rev": 0,
 }
 
-def set_rows(enc_tag: str, rows: List[int], targets_canon: str):
-    enc = "TE1" if str(enc_tag or "") == "TE1" else "TE2"
-    _state["rows_by_enc"][enc] = list(rows or [])
-    _state["targets_canon"] = str(targets_canon or "")
-    _state["last_enc_tag"] = enc
 
-def set_rows_victim(enc_tag: str, rows_victim: List[int]):
-    enc = "TE1" if str(enc_tag or "") == "TE1" else "TE2"
-    _state["rows_victim_by_enc"][enc] = list(rows_victim or [])
+@dataclass(frozen=True, eq=False)
+class CutoffContext:
+    """1回のエンコード（1プロンプト）に対する行マップ。生成後は書き換えない。"""
+    uid: int
+    enc: str                       # "TE1" / "TE2"
+    S: int
+    targets_canon: str
+    rows: np.ndarray               # Source 行（ターゲット＋±N）：長さ S の bool 配列（書き換え不可）
+    rows_victim: np.ndarray        # Victim 行（中立化の適用対象）：同上
+    text: str                      # 元プロンプト（エンジンごとのチャンクを引くキー）
+    dummy_positions: Tuple[int, ...]  # ダミーで PAD に差し替えるトークン位置（ターゲット一致箇所）
+    fingerprint: Tuple[object, ...]
+    # Target グループ（"|" 区切りが2つ以上の時だけ）：(そのグループ用ダミーで PAD にする位置, 補間する行 bool [S])
+    groups: Tuple[Tuple[Tuple[int, ...], np.ndarray], ...] = ()
 
-def set_dummy_text(enc_tag: str, dummy_text: str):
-    enc = "TE1" if str(enc_tag or "") == "TE1" else "TE2"
-    _state["dummy_text_by_enc"][enc] = str(dummy_text or "")
 
-def get_rows(enc_tag: str) -> List[int]:
-    enc = "TE1" if str(enc_tag or "") == "TE1" else "TE2"
-    return list(_state["rows_by_enc"].get(enc, []) or [])
+# anchor + 設定指紋 → CutoffContext
+_contexts = LRU(max_items=64)
+metrics.register_source("contexts", _contexts.stats)
 
-def get_rows_victim(enc_tag: str) -> List[int]:
-    enc = "TE1" if str(enc_tag or "") == "TE1" else "TE2"
-    return list(_state["rows_victim_by_enc"].get(enc, []) or [])
+# (engine, prompt) → tokenize_line のチャンク（エンコード時に横取りしたもの；ダミーをトークン列から作るのに使う）
+_chunks = LRU(max_items=128)
 
-def get_dummy_text(enc_tag: str) -> str:
-    enc = "TE1" if str(enc_tag or "") == "TE1" else "TE2"
-    return str(_state["dummy_text_by_enc"].get(enc, "") or "")
-
-def get_targets_canon() -> str:
-    return str(_state.get("targets_canon", "") or "")
-
-def get_last_enc_tag() -> str:
-    return str(_state.get("last_enc_tag", "") or "")
-
-def clear():
-    _state["rows_by_enc"] = {"TE1": [], "TE2": []}
-    _state["rows_victim_by_enc"] = {"TE1": [], "TE2": []}
-    _state["targets_canon"] = ""
-    _state["dummy_text_by_enc"] = {"TE1": "", "TE2": ""}
-    _state["last_enc_tag"] = ""
-
-    # ランタイム設定はクリアしない（セッション継続中）。必要なら別APIで。
 
 # ---- runtime config (session-only) ----
 def set_runtime(d: Dict[str, object]):
     """部分更新: セッション限定設定を上書き（保存しない）。"""
-    rc = _state.get("runtime_cfg", {})
-    if not isinstance(rc, dict):
-        rc = {}
-    rc.update({k: v for k, v in (d or {}).items()})
-    _state["runtime_cfg"] = rc
+    with _lock:
+        rc = dict(_runtime["cfg"])
+        rc.update({k: v for k, v in (d or {}).items()})
+        _runtime["cfg"] = MappingProxyType(rc)
+        _runtime["rev"] = int(_runtime["rev"]) + 1
+
+def _snapshot() -> Tuple[Mapping[str, object], int, Tuple[Tuple[str, str], ...]]:
+    job = getattr(_tls, "job", None)
+    if job is not None:
+        return job
+    with _lock:
+        return _runtime["cfg"], int(_runtime["rev"]), ()
 
 def get_runtime(key: str, default=None):
-    rc = _state.get("runtime_cfg", {})
-    if not isinstance(rc, dict):
-        return default
-    return rc.get(key, default)
+    return _snapshot()[0].get(key, default)
+
+def get_runtime_rev() -> int:
+    return _snapshot()[1]
+
+def get_runtime_key() -> Tuple[object, ...]:
+    """メモのキーに混ぜる設定の版：セッション設定の rev と、このジョブの上書き（begin_job(overrides)）の指紋。"""
+    _cfg, rev, okey = _snapshot()
+    return (rev, okey)
+
+def begin_job(overrides: Optional[Dict[str, object]] = None) -> Mapping[str, object]:
+    """
+    このスレッドのジョブ開始。設定のスナップショットを取り、ジョブ中の get_runtime はそれを返す。
+    UI で値が変わっても実行中のジョブには影響しない。
+    """
+    with _lock:
+        cfg, rev = _runtime["cfg"], int(_runtime["rev"])
+    okey: Tuple[Tuple[str, str], ...] = ()
+    if overrides:
+        cfg = MappingProxyType(dict(cfg, **overrides))
+        okey = tuple(sorted((str(k), repr(v)) for k, v in overrides.items()))
+    _tls.job = (cfg, rev, okey)
+    return cfg
+
+def end_job():
+    _tls.job = None
+
+def current_job():
+    """このスレッドのジョブのスナップショット（無ければ None）。別スレッドで resume_job に渡して同じ設定で続ける。"""
+    return getattr(_tls, "job", None)
+
+def resume_job(job):
+    """current_job() で取ったスナップショットをこのスレッドのジョブにする（終わったら end_job）。"""
+    _tls.job = job
+
+
+# ---- 設定指紋 ----
+def _norm_csv(s) -> Tuple[str, ...]:
+    return tuple(w.strip().lower() for w in re.split(r"[,，\s]+", str(s or "")) if w.strip())
+
+def _norm_groups(s) -> Tuple[Tuple[str, ...], ...]:
+    """Target 欄："|" 区切りのグループごとに _norm_csv（空のグループは捨てる）。"""
+    return tuple(g for g in (_norm_csv(p) for p in re.split(r"[|｜]", str(s or ""))) if g)
+
+def encode_fingerprint() -> Tuple[object, ...]:
+    """
+    エンコード時（トークンマップ）に効く設定だけの指紋。
+    Forge の conditioning キャッシュキーに混ぜ、変更時に再エンコードさせる。
+    Strength / Interpolation / Sanity は process_cond 側で効くので含めない。
+    """
+    return (
+        _norm_groups(get_runtime("targets", "")),
+        _norm_csv(get_runtime("exclude_tokens", "")),
+        _norm_csv(get_runtime("processing_targets", "")),
+        int(get_runtime("source_expand_n", 1) or 1),
+        bool(get_runtime("apply_te1", False)),
+        bool(get_runtime("apply_te2", True)),
+    )
+
+
+# ---- コンテキスト（conditioning に紐づく行マップ） ----
+def anchor_keys(series) -> List[tuple]:
+    """
+    [B,S,H] テンソルから、サンプルごとの anchor（先頭 ANCHOR_COLS 列の値）を作る。
+    GPU→CPU 転送は1回。
+    """
+    probe = series[:, :, :ANCHOR_COLS].float().cpu().tolist()
+    return [tuple(v for row in sample for v in row) for sample in probe]
+
+RowSet = Union[np.ndarray, Sequence[int]]
+
+def _row_mask(rows: RowSet, S: int) -> np.ndarray:
+    """bool 配列（長さ S に揃える）か行番号の列を、書き換え不可の bool 配列 [S] にする。共有できるものはコピーしない。"""
+    a = np.asarray(rows if rows is not None else ())
+    if a.dtype != np.bool_ or a.shape != (S,):
+        m = np.zeros(S, dtype=bool)
+        if a.dtype == np.bool_:
+            k = min(S, int(a.shape[0]))
+            m[:k] = a[:k]
+        else:
+            idx = a.astype(np.int64).reshape(-1)
+            m[idx[(idx >= 0) & (idx < S)]] = True
+        a = m
+    elif a.flags.writeable:
+        a = a.copy()
+    a.flags.writeable = False
+    return a
+
+def make_context(enc: str, S: int, targets_canon: str, rows: RowSet, rows_victim: RowSet,
+                 text: str, dummy_positions: Sequence[int],
+                 groups: Sequence[Tuple[Sequence[int], RowSet]] = ()) -> CutoffContext:
+    return CutoffContext(
+        uid=next(_uid), enc=str(enc), S=int(S), targets_canon=str(targets_canon or ""),
+        rows=_row_mask(rows, int(S)), rows_victim=_row_mask(rows_victim, int(S)),
+        text=str(text or ""), dummy_positions=tuple(dummy_positions or ()),
+        fingerprint=encode_fingerprint(),
+        groups=tuple((tuple(int(p) for p in pos), _row_mask(rv, int(S))) for pos, rv in (groups or ())),
+    )
+
+def bind(anchor: tuple, ctx: CutoffContext):
+    """エンコード結果（anchor）にコンテキストを紐づける。"""
+    _contexts.put((anchor, ctx.fingerprint), ctx)
+
+def lookup(anchor: tuple) -> Optional[CutoffContext]:
+    """現在の設定で、この conditioning に対して計算されたコンテキストを返す。"""
+    return _contexts.get((anchor, encode_fingerprint()))
+
+def put_chunks(engine, text: str, chunks):
+    _chunks.put((id(engine), text), (weakref.ref(engine), chunks))
+
+def get_chunks(engine, text: str):
+    """engine が text をトークナイズしたチャンク（無ければ None）。"""
+    ent = _chunks.get((id(engine), text))
+    if ent is None or ent[0]() is not engine:
+        return None
+    return ent[1]
+
+def clear():
+    _contexts.clear()
+    _chunks.clear()
@@ -0,0 +1,268 @@
+# ダミーエンコードのディスクキャッシュ（メモリ LRU の下の段。ワーカ再起動後もテキストエンコーダを回さずに温まる）
+# ・形式: safetensors（1 ダミー = 1 ファイル）。safetensors が無ければ無効（メモリ LRU のみ）
+# ・配置: <dir>/<model hash>/<engine>/<sha256(トークン列, 倍率列, エンコーダ状態)>.safetensors
+#   （エンコーダ状態 = CLIP skip・強調の実装・TE の LoRA などのパッチの指紋）
+# ・キーのモデル部はチェックポイントの内容ハッシュ。ハッシュの無いモデル（id() / ファイル名しか無い）はこの段を使わない
+# ・読み込みは参照時に 1 ファイルだけ。起動時の走査はしない。遅延読み込みではなく、get_tensor がテンソル全体を
+#   CPU メモリへコピーする（1 ダミーは数百 KB〜数 MB で、どのみちデバイスへ送るので mmap のまま持つ利点が無い）
+# ・書き込みは一時ファイル → os.replace（同じホストの複数ワーカが同時に読んでも壊れたファイルは見えない）
+# ・容量上限（cutoff_forge_dummy_disk_mb）を超えたら mtime の古い順に削除。ヒットで mtime を更新（= LRU）
+# ・書き込みはバックグラウンドのスレッドで行う（生成の経路では CPU へのコピーだけ）
+
+import hashlib
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Dict
+
+try:
+    from scripts.forge_cutoff import metrics
+except Exception:
+    from forge_cutoff import metrics
+
+log = logging.getLogger("forge_cutoff")
+
+_FORMAT = "1"
+_EXT = ".safetensors"
+_DEFAULT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                            "cache", "dummies")
+# 上限超過時はここまで減らす（削除のたびに走査しないための余裕）
+_LOW_WATER = 0.9
+# 他プロセスの書き込み分を拾うため、この間隔で使用量を数え直す [s]
+_RESCAN_S = 60.0
+
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0, "errors": 0}
+# 使用量（バイト）。None = 未計測（初回の書き込み時に数える）
+_usage = {"bytes": None, "scanned": 0.0}
+_writer = {"thread": None, "queue": None}
+
+
+def _opts():
+    try:
+        from modules.shared import opts
+        return opts
+    except Exception:
+        return None
+
+
+def _available() -> bool:
+    try:
+        import safetensors.torch  # noqa: F401
+        return True
+    except Exception:
+        return False
+
+
+def enabled() -> bool:
+    o = _opts()
+    return bool(getattr(o, "cutoff_forge_dummy_disk_cache", False)) and _available()
+
+
+def root_dir() -> str:
+    o = _opts()
+    d = str(getattr(o, "cutoff_forge_dummy_disk_dir", "") or "").strip()
+    return os.path.abspath(os.path.expanduser(d)) if d else _DEFAULT_DIR
+
+
+def _cap_bytes() -> int:
+    o = _opts()
+    try:
+        mb = int(getattr(o, "cutoff_forge_dummy_disk_mb", 1024))
+    except Exception:
+        mb = 1024
+    return max(0, mb) << 20   # 0 = 無制限
+
+
+def _path(key) -> str:
+    """key = (model hash, engine 名, トークン列, 倍率列, エンコーダ状態)"""
+    mkey, name, tokens, mults, state = key
+    mdir = hashlib.sha1(str(mkey).encode("utf-8")).hexdigest()[:16]
+    h = hashlib.sha256(repr((_FORMAT, tuple(tokens), tuple(mults), state)).encode("utf-8")).hexdigest()
+    return os.path.join(root_dir(), mdir, str(name), h + _EXT)
+
+
+def _count(name: str, n: int = 1):
+    with _lock:
+        _stats[name] += n
+
+
+# ---- 読み込み ----
+def load(key):
+    """
+    ディスクにあれば [1,S,H] の CPU テンソルを返す（無ければ / 読めなければ None）。
+    safe_open は mmap で開くが、get_tensor の戻り値はファイルから切り離されたコピー（閉じた後も使える）。
+    """
+    if not enabled():
+        return None
+    path = _path(key)
+    try:
+        from safetensors import safe_open
+        with safe_open(path, framework="pt", device="cpu") as f:
+            ser = f.get_tensor("series")
+    except FileNotFoundError:
+        _count("misses")
+        return None
+    except Exception as e:
+        # 書き込み途中は os.replace 前なので見えない。ここに来るのは破損・他プロセスの削除直後など
+        log.debug("[cutoff:disk] read failed %s: %s", path, e)
+        _count("errors")
+        return None
+    if ser.dim() != 3 or int(ser.shape[1]) != len(key[2]):
+        _count("errors")
+        return None
+    try:
+        os.utime(path, None)   # LRU：使ったものを新しくする
+    except OSError:
+        pass
+    _count("hits")
+    return ser
+
+
+# ---- 書き込み ----
+def save(key, ser):
+    """ser を CPU にコピーしてバックグラウンドで書き出す（既にあれば何もしない）。"""
+    if not enabled():
+        return
+    try:
+        cpu = ser.detach().to("cpu", copy=True).contiguous()
+    except Exception:
+        return
+    try:
+        _ensure_writer().put_nowait((_path(key), str(key[0]), str(key[1]), cpu))
+    except queue.Full:
+        pass   # 書き込みが追いつかない間は諦める（次に同じダミーが外れた時に書く）
+
+
+def _ensure_writer() -> "queue.Queue":
+    with _lock:
+        q = _writer["queue"]
+        t = _writer["thread"]
+        if q is None or t is None or not t.is_alive():
+            q = queue.Queue(maxsize=256)
+            t = threading.Thread(target=_write_loop, args=(q,), name="cutoff-dummy-store", daemon=True)
+            _writer["queue"], _writer["thread"] = q, t
+            t.start()
+        return q
+
+
+def _write_loop(q: "queue.Queue"):
+    while True:
+        item = q.get()
+        try:
+            if item is None:
+                return
+            _write(*item)
+        except Exception as e:
+            log.debug("[cutoff:disk] write failed: %s", e)
+            _count("errors")
+        finally:
+            q.task_done()
+
+
+def _write(path: str, mkey: str, name: str, cpu):
+    if os.path.exists(path):
+        return
+    from safetensors.torch import save_file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+    try:
+        save_file({"series": cpu}, tmp, metadata={"format": _FORMAT, "model": mkey, "engine": name})
+        os.replace(tmp, path)
+    except Exception:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    _count("writes")
+    size = os.path.getsize(path)
+    with _lock:
+        if _usage["bytes"] is not None:
+            _usage["bytes"] += size
+    _maybe_evict()
+
+
+def flush(timeout: float = 10.0):
+    """書き込み待ちを掃き出す（終了時・ツール用）。"""
+    q = _writer["queue"]
+    if q is None:
+        return
+    end = time.monotonic() + timeout
+    while q.unfinished_tasks and time.monotonic() < end:
+        time.sleep(0.01)
+
+
+# ---- 容量管理 ----
+def _scan():
+    """[(mtime, size, path)] と合計バイト。他プロセスが同時に消したファイルは飛ばす。"""
+    files, total = [], 0
+    root = root_dir()
+    for dirpath, _dirs, names in os.walk(root):
+        for n in names:
+            if not n.endswith(_EXT):
+                continue
+            p = os.path.join(dirpath, n)
+            try:
+                st = os.stat(p)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, p))
+            total += st.st_size
+    return files, total
+
+
+def _maybe_evict():
+    cap = _cap_bytes()
+    if cap <= 0:
+        return
+    now = time.monotonic()
+    with _lock:
+        known = _usage["bytes"]
+        stale = now - _usage["scanned"] > _RESCAN_S
+    if known is not None and known <= cap and not stale:
+        return
+    files, total = _scan()
+    evicted = 0
+    if total > cap:
+        files.sort()
+        goal = int(cap * _LOW_WATER)
+        for _mt, size, p in files:
+            if total <= goal:
+                break
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue   # Windows で他プロセスが mmap 中など：次の候補へ
+            total -= size
+            evicted += 1
+    with _lock:
+        _usage["bytes"] = total
+        _usage["scanned"] = now
+        _stats["evictions"] += evicted
+
+
+def clear():
+    """このキャッシュディレクトリのファイルを全て消す。"""
+    files, _total = _scan()
+    for _mt, _size, p in files:
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+    with _lock:
+        _usage["bytes"] = None
+
+
+def stats() -> Dict[str, int]:
+    with _lock:
+        out = dict(_stats)
+        out["bytes"] = int(_usage["bytes"] or 0)
+    return out
+
+
+metrics.register_source("dummy_disk", stats)
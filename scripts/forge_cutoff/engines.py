@@ -0,0 +1,118 @@
+# テキストエンジンの登録簿：どの ClassicTextProcessingEngine インスタンスが TE1 / TE2 か、
+# crossattn の H 次元のどの列範囲を占めるかを、モデル読み込み時に記録する
+# ・SDXL: text_processing_engine_l = TE1（列 0..768）、text_processing_engine_g = TE2（続く 1280 列）
+# ・SD1.5 等: text_processing_engine = TE1（全列）
+# S（トークン長）からの推定はしない。BREAK や 75 トークン超の SD1.5 でも TE1 のまま
+
+import threading
+import weakref
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+# (属性名, エンコーダ, 名前)。crossattn はこの順に H 方向へ連結される
+_ATTRS = (
+    ("text_processing_engine_l", "TE1", "L"),
+    ("text_processing_engine_g", "TE2", "G"),
+    ("text_processing_engine", "TE1", "L"),
+)
+# 出力幅が未観測の間の既定値（CLIP-L / OpenCLIP-G）
+_DEFAULT_WIDTH = {"L": 768, "G": 1280}
+
+
+@dataclass(frozen=True)
+class EngineTag:
+    enc: str     # "TE1" / "TE2"
+    name: str    # "L" / "G"（ダミーキャッシュ等のキー）
+    index: int   # 連結順（0 = 先頭；cond の anchor を作るエンジン）
+
+
+_lock = threading.Lock()
+_tags: "weakref.WeakKeyDictionary[object, EngineTag]" = weakref.WeakKeyDictionary()
+_widths: "weakref.WeakKeyDictionary[object, int]" = weakref.WeakKeyDictionary()
+# 現在のモデル：(weakref(model), (weakref(engine), ...)) ※連結順
+_current = {"model": None, "engines": ()}
+
+
+def _model_engines(sd_model) -> List[Tuple[object, str, str]]:
+    found = []
+    for attr, enc, name in _ATTRS:
+        eng = getattr(sd_model, attr, None)
+        if eng is not None:
+            found.append((eng, enc, name))
+    # SDXL は _l / _g の2本だけ（互換で text_processing_engine を持っていても重ねない）
+    if len(found) > 2:
+        found = found[:2]
+    return found
+
+
+def register_model(sd_model, *_a, **_k):
+    """モデル読み込み時（script_callbacks.on_model_loaded）に呼ぶ。エンジンごとにタグを付ける。"""
+    if sd_model is None:
+        return
+    engines = _model_engines(sd_model)
+    with _lock:
+        for i, (eng, enc, name) in enumerate(engines):
+            try:
+                _tags[eng] = EngineTag(enc=enc, name=name, index=i)
+            except TypeError:
+                continue
+        try:
+            _current["model"] = weakref.ref(sd_model)
+        except TypeError:
+            _current["model"] = None
+        _current["engines"] = tuple(weakref.ref(e) for e, _enc, _name in engines)
+
+
+def _current_model():
+    ref = _current["model"]
+    return ref() if ref is not None else None
+
+
+def _ensure(sd_model=None):
+    """未登録（コールバック前に読み込まれたモデル等）なら、その場で登録する。"""
+    if sd_model is None:
+        try:
+            from modules import shared
+            sd_model = getattr(shared, "sd_model", None)
+        except Exception:
+            return None
+    if sd_model is not None and _current_model() is not sd_model:
+        register_model(sd_model)
+    return sd_model
+
+
+def tag_of(engine) -> Optional[EngineTag]:
+    try:
+        tag = _tags.get(engine)
+    except TypeError:
+        return None
+    if tag is None:
+        _ensure()
+        tag = _tags.get(engine)
+    return tag
+
+
+def note_width(engine, H: int):
+    """エンコード結果から出力幅を記録する（列範囲の計算に使う）。"""
+    try:
+        if _widths.get(engine) != int(H):
+            _widths[engine] = int(H)
+    except TypeError:
+        pass
+
+
+def spans(sd_model=None) -> List[Tuple[EngineTag, object, int, int]]:
+    """現在のモデルの [(tag, engine, col_start, col_end)]（連結順）。モデルが無ければ空。"""
+    if _ensure(sd_model) is None:
+        return []
+    out = []
+    c0 = 0
+    for ref in _current["engines"]:
+        eng = ref()
+        tag = _tags.get(eng) if eng is not None else None
+        if tag is None:
+            return []
+        w = _widths.get(eng) or _DEFAULT_WIDTH.get(tag.name, 768)
+        out.append((tag, eng, c0, c0 + int(w)))
+        c0 += int(w)
+    return out
@@ -0,0 +1,73 @@
+# 小さな LRU（件数上限＋バイト上限）。ヒット/ミス/追い出しを数える
+# テンソルは nbytes（numel * element_size）で計上し、それ以外は 0 バイト扱い
+
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable
+
+
+def _nbytes(v) -> int:
+    """テンソル / テンソルの tuple・list を再帰的に計上する。"""
+    try:
+        if isinstance(v, (tuple, list)):
+            return sum(_nbytes(x) for x in v)
+        numel = getattr(v, "numel", None)
+        esize = getattr(v, "element_size", None)
+        if callable(numel) and callable(esize):
+            return int(numel()) * int(esize())
+    except Exception:
+        pass
+    return 0
+
+
+class LRU:
+    def __init__(self, max_items: int = 64, max_bytes: int = 0):
+        self.max_items = int(max_items)
+        self.max_bytes = int(max_bytes)  # 0 = バイト上限なし
+        self._d: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key -> (value, nbytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default=None):
+        with self._lock:
+            ent = self._d.get(key)
+            if ent is None:
+                self.misses += 1
+                return default
+            self._d.move_to_end(key)
+            self.hits += 1
+            return ent[0]
+
+    def put(self, key: Hashable, value) -> None:
+        nb = _nbytes(value)
+        with self._lock:
+            old = self._d.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            # 単体で上限を超えるものは入れない
+            if self.max_bytes and nb > self.max_bytes:
+                return
+            self._d[key] = (value, nb)
+            self._bytes += nb
+            while self._d and (len(self._d) > self.max_items or (self.max_bytes and self._bytes > self.max_bytes)):
+                _, (_, ob) = self._d.popitem(last=False)
+                self._bytes -= ob
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._d.clear()
+            self._bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._d)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(
+                items=len(self._d), bytes=self._bytes,
+                hits=self.hits, misses=self.misses, evictions=self.evictions,
+            )
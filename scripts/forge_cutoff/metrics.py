@@ -0,0 +1,203 @@
+# 計測：ステージごとのタイマー／カウンタ／スキップ理由（プロセス内・永続化しない）
+# ・stage("blend") で囲んだ区間の回数・合計・最大を記録（CPU 側の壁時計。GPU 側の実時間は profiler で見る）
+# ・profiler=True なら torch.profiler.record_function("cutoff::<stage>") の範囲も張る
+# ・snapshot() / to_json() / to_prometheus() / export(path) で取り出す
+# ・ログの詳細度は set_log_level() で切り替える（既定 WARNING；毎ステップの行は DEBUG）
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+_lock = threading.Lock()
+
+_cfg = {"enabled": True, "profiler": False}
+
+# stage -> [count, total_s, max_s]
+_timers: Dict[str, list] = {}
+_counters: Dict[str, int] = {}
+_skips: Dict[str, int] = {}
+# name -> stats() を返す関数（キャッシュの hits/misses など）
+_sources: Dict[str, Callable[[], Dict[str, int]]] = {}
+
+_LOG_LEVELS = {"WARNING": logging.WARNING, "INFO": logging.INFO, "DEBUG": logging.DEBUG}
+
+
+def configure(enabled: Optional[bool] = None, profiler: Optional[bool] = None):
+    if enabled is not None:
+        _cfg["enabled"] = bool(enabled)
+    if profiler is not None:
+        _cfg["profiler"] = bool(profiler)
+
+def configure_from_opts():
+    """Settings（cutoff_forge_metrics / _profiler_ranges / _log_level）を反映する。"""
+    try:
+        from modules.shared import opts
+    except Exception:
+        return
+    configure(enabled=getattr(opts, "cutoff_forge_metrics", True),
+              profiler=getattr(opts, "cutoff_forge_profiler_ranges", False))
+    set_log_level(getattr(opts, "cutoff_forge_log_level", "WARNING"))
+
+def set_log_level(name: str):
+    level = _LOG_LEVELS.get(str(name or "").upper(), logging.WARNING)
+    logging.getLogger("forge_cutoff").setLevel(level)
+
+
+# ---- 記録 ----
+class _Stage:
+    __slots__ = ("name", "t0", "rf")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.rf = None
+
+    def __enter__(self):
+        if _cfg["profiler"]:
+            try:
+                from torch.profiler import record_function
+                self.rf = record_function("cutoff::" + self.name)
+                self.rf.__enter__()
+            except Exception:
+                self.rf = None
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        dt = time.perf_counter() - self.t0
+        if self.rf is not None:
+            try:
+                self.rf.__exit__(*exc)
+            except Exception:
+                pass
+        with _lock:
+            ent = _timers.get(self.name)
+            if ent is None:
+                _timers[self.name] = [1, dt, dt]
+            else:
+                ent[0] += 1
+                ent[1] += dt
+                if dt > ent[2]:
+                    ent[2] = dt
+        return False
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL = _NullStage()
+
+
+def stage(name: str):
+    """with metrics.stage("blend"): ... の区間を計測する。"""
+    if not _cfg["enabled"]:
+        return _NULL
+    return _Stage(name)
+
+def incr(name: str, n: int = 1):
+    if not _cfg["enabled"]:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + int(n)
+
+def skip(reason: str):
+    """適用を見送った理由を数える（not_3d / enc_disabled / no_context など）。"""
+    if not _cfg["enabled"]:
+        return
+    with _lock:
+        _skips[reason] = _skips.get(reason, 0) + 1
+
+def register_source(name: str, fn: Callable[[], Dict[str, int]]):
+    _sources[name] = fn
+
+def reset():
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+        _skips.clear()
+
+
+# ---- 取り出し ----
+def snapshot() -> Dict[str, object]:
+    with _lock:
+        timers = {
+            k: dict(count=c, total_ms=round(t * 1000.0, 3), max_ms=round(m * 1000.0, 3),
+                    mean_ms=round(t * 1000.0 / c, 4) if c else 0.0)
+            for k, (c, t, m) in _timers.items()
+        }
+        counters = dict(_counters)
+        skips = dict(_skips)
+    caches = {}
+    for name, fn in list(_sources.items()):
+        try:
+            caches[name] = dict(fn())
+        except Exception:
+            pass
+    return dict(time=time.time(), timers=timers, counters=counters, skips=skips, caches=caches)
+
+def to_json(snap: Optional[dict] = None) -> str:
+    return json.dumps(snap if snap is not None else snapshot(), indent=1, sort_keys=True)
+
+def to_prometheus(snap: Optional[dict] = None) -> str:
+    s = snap if snap is not None else snapshot()
+    lines = [
+        "# TYPE cutoff_stage_seconds_total counter",
+        "# TYPE cutoff_stage_calls_total counter",
+        "# TYPE cutoff_stage_max_seconds gauge",
+    ]
+    for k, v in sorted(s["timers"].items()):
+        lines.append('cutoff_stage_seconds_total{stage="%s"} %.6f' % (k, v["total_ms"] / 1000.0))
+        lines.append('cutoff_stage_calls_total{stage="%s"} %d' % (k, v["count"]))
+        lines.append('cutoff_stage_max_seconds{stage="%s"} %.6f' % (k, v["max_ms"] / 1000.0))
+    lines.append("# TYPE cutoff_events_total counter")
+    for k, v in sorted(s["counters"].items()):
+        lines.append('cutoff_events_total{event="%s"} %d' % (k, v))
+    lines.append("# TYPE cutoff_skips_total counter")
+    for k, v in sorted(s["skips"].items()):
+        lines.append('cutoff_skips_total{reason="%s"} %d' % (k, v))
+    lines.append("# TYPE cutoff_cache gauge")
+    for name, st in sorted(s["caches"].items()):
+        for k, v in sorted(st.items()):
+            lines.append('cutoff_cache{cache="%s",field="%s"} %s' % (name, k, v))
+    return "\n".join(lines) + "\n"
+
+def export(path: str, fmt: str = "") -> bool:
+    """
+    スナップショットをファイルへ書き出す（一時ファイル→os.replace で置き換え）。
+    fmt 未指定なら拡張子で決める：.prom / .txt → Prometheus テキスト、それ以外 → JSON。
+    """
+    if not path:
+        return False
+    fmt = (fmt or ("prometheus" if os.path.splitext(path)[1].lower() in (".prom", ".txt") else "json")).lower()
+    body = to_prometheus() if fmt.startswith("prom") else to_json()
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        d = os.path.dirname(os.path.abspath(path))
+        os.makedirs(d, exist_ok=True)
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(body)
+        os.replace(tmp, path)
+        return True
+    except Exception:
+        try:
+            os.remove(tmp)
+        except Exception:
+            pass
+        return False
+
+def export_from_opts() -> bool:
+    """Settings の cutoff_forge_metrics_file が設定されていれば書き出す。"""
+    try:
+        from modules.shared import opts
+        path = str(getattr(opts, "cutoff_forge_metrics_file", "") or "").strip()
+    except Exception:
+        return False
+    return export(path) if path else False
@@ -0,0 +1,64 @@
+# パッチの取り付け／取り外しを Enable（cutoff_forge_enable）に連動させる
+# ・各モジュールは import 時に register(name, install, uninstall) で自分のパッチを登録する
+# ・apply(True) で全パッチを取り付け、apply(False) で Forge の元の関数へ戻す
+# ・Enable OFF のインスタンスではラッパ自体が存在しないので、ステップごとのコストはゼロ
+
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, Tuple
+
+log = logging.getLogger("forge_cutoff")
+
+_lock = threading.RLock()
+_registry: "OrderedDict[str, Tuple[Callable[[], object], Callable[[], object]]]" = OrderedDict()
+_state = {"enabled": False}
+
+
+def _call(name: str, fn: Callable[[], object]):
+    try:
+        fn()
+    except Exception as e:
+        log.warning("[cutoff] patch %s failed: %s", name, e)
+
+
+def register(name: str, install: Callable[[], object], uninstall: Callable[[], object]):
+    """パッチを登録する。既に有効なら即座に取り付ける（同名は後勝ち）。"""
+    with _lock:
+        _registry[name] = (install, uninstall)
+        if _state["enabled"]:
+            _call(name, install)
+
+
+def apply(enabled: bool):
+    """全パッチを取り付け（True）／取り外し（False）る。取り外しは登録の逆順。"""
+    with _lock:
+        _state["enabled"] = bool(enabled)
+        items = list(_registry.items())
+        if enabled:
+            for name, (install, _un) in items:
+                _call(name, install)
+        else:
+            for name, (_in, uninstall) in reversed(items):
+                _call(name, uninstall)
+    log.debug("[cutoff] patches %s", "installed" if enabled else "removed")
+
+
+def is_enabled() -> bool:
+    return bool(_state["enabled"])
+
+
+def sync_from_opts():
+    """
+    Settings の cutoff_forge_enable に合わせる（opts.onchange と、ジョブ開始時の Script.process から呼ばれる）。
+    override_settings は onchange を呼ばないので、ジョブごとにここで合わせ直す。状態が同じなら何もしない。
+    """
+    try:
+        from modules.shared import opts
+        enabled = bool(getattr(opts, "cutoff_forge_enable", False))
+    except Exception:
+        enabled = False
+    with _lock:
+        if enabled == _state["enabled"]:
+            return
+        apply(enabled)
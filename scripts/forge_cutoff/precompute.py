@@ -0,0 +1,202 @@
+# UI の編集（プロンプト／Target / Exclude / Processing / Source expansion）を受けて、
+# 生成前にトークンマップとダミーエンコードをバックグラウンドで作っておく
+# ・schedule() は最後の入力から delay 経ってから 1 回だけ走る（入力中は走らない＝デバウンス）
+# ・結果は生成経路が最初に見るキャッシュ（tokenmap の prompt cache / ダミー LRU）にそのまま載る
+# ・トークンマップ（CPU のみ）はワーカスレッドで作る
+# ・ダミーのエンコード（テキストエンコーダ・GPU への載せ替え）は生成と同じメインスレッドのキューに 1 行ずつ積み、
+#   実行時に生成中でないことを確かめてから行う（エンジンの fixes / emphasis を生成と取り合わない）
+
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+try:
+    from scripts.forge_cutoff import context_volatile as vctx
+except Exception:
+    from forge_cutoff import context_volatile as vctx
+try:
+    from scripts.forge_cutoff import engines
+except Exception:
+    from forge_cutoff import engines
+try:
+    from scripts.forge_cutoff import metrics
+except Exception:
+    from forge_cutoff import metrics
+try:
+    from scripts.forge_cutoff import patches
+except Exception:
+    from forge_cutoff import patches
+
+log = logging.getLogger("forge_cutoff")
+
+_DEFAULT_DELAY_S = 0.6
+
+_lock = threading.Lock()
+_cv = threading.Condition(_lock)
+# タブ（"txt2img" / "img2img"）ごとの最新プロンプトと、次に走らせる時刻
+_prompts: Dict[str, str] = {}
+_pending = {"due": None}
+# プロンプト編集の展開に使うステップ数（直近のジョブの値；未実行なら既定）
+_steps = {"n": 20}
+_worker = {"thread": None}
+# tokenmap（scripts/030_*）が登録する：mapper(engine, lines) -> {line: (rows, victim, dummy_positions, hits, groups)}
+_hooks: Dict[str, Optional[Callable]] = {"map": None}
+
+
+def set_mapper(fn: Callable):
+    _hooks["map"] = fn
+
+
+def _opt(key: str, default):
+    try:
+        from modules.shared import opts
+        return getattr(opts, key, default)
+    except Exception:
+        return default
+
+
+def enabled() -> bool:
+    return patches.is_enabled() and bool(_opt("cutoff_forge_precompute", True))
+
+
+def _on_main_thread(fn: Callable[[], object]):
+    """Forge のメインスレッド（生成と同じキュー）で fn を実行して結果を待つ。Forge 外（ツール）ではその場で呼ぶ。"""
+    try:
+        from modules_forge import main_thread
+    except Exception:
+        return fn()
+    return main_thread.run_and_wait_result(fn)
+
+
+def busy() -> bool:
+    """生成中（Forge の shared.state にジョブがある）なら True。"""
+    try:
+        from modules import shared
+        st = shared.state
+        return bool(getattr(st, "job", "")) or int(getattr(st, "job_count", 0) or 0) > 0
+    except Exception:
+        return False
+
+
+# ---- 受付 ----
+def schedule(prompt: Optional[str] = None, tab: str = "txt2img"):
+    """
+    プロンプトの変更（prompt を渡す）・Cutoff 設定の変更（None）で呼ぶ。
+    最後の呼び出しから delay 後にワーカが全タブの最新プロンプトを処理する。
+    """
+    if not enabled():
+        return
+    delay = max(0.0, float(_opt("cutoff_forge_precompute_delay_ms", int(_DEFAULT_DELAY_S * 1000))) / 1000.0)
+    with _cv:
+        if prompt is not None:
+            _prompts[tab] = str(prompt)
+        if not any(_prompts.values()):
+            return
+        _pending["due"] = time.monotonic() + delay
+        _ensure_worker()
+        _cv.notify()
+
+
+def note_steps(steps):
+    """ジョブ開始時に p.steps を記録する（[a:b:n] の切り替え位置を生成時と揃えるため）。"""
+    try:
+        _steps["n"] = max(1, int(steps))
+    except Exception:
+        pass
+
+
+def _ensure_worker():
+    t = _worker["thread"]
+    if t is None or not t.is_alive():
+        t = threading.Thread(target=_loop, name="cutoff-precompute", daemon=True)
+        _worker["thread"] = t
+        t.start()
+
+
+def _loop():
+    while True:
+        with _cv:
+            while True:
+                due = _pending["due"]
+                if due is None:
+                    _cv.wait()
+                    continue
+                wait = due - time.monotonic()
+                if wait <= 0:
+                    break
+                _cv.wait(wait)
+            _pending["due"] = None
+            prompts = [p for p in dict.fromkeys(_prompts.values()) if p]
+        try:
+            run(prompts)
+        except Exception as e:
+            log.debug("[cutoff:pre] failed: %s", e)
+            metrics.incr("precompute_failed")
+
+
+# ---- 本体 ----
+def _prompt_lines(prompt: str) -> List[str]:
+    """AND / プロンプト編集（[a:b:n]）を展開した、エンコードされる各テキスト。"""
+    try:
+        from modules import prompt_parser
+        _res, flat, _w = prompt_parser.get_multicond_prompt_list([prompt])
+        scheds = prompt_parser.get_learned_conditioning_prompt_schedules(flat, _steps["n"])
+        lines = [text for sched in scheds for _end, text in sched]
+    except Exception:
+        lines = [prompt]
+    return [l for l in dict.fromkeys(lines) if l]
+
+
+def run(prompts: List[str]):
+    """prompts のトークンマップを作り、生成中でなければダミーもエンコードしてキャッシュに載せる。"""
+    mapper = _hooks["map"]
+    if mapper is None or not enabled():
+        return
+    if busy():
+        # 生成中は何もしない（生成側が同じキャッシュを作る）
+        metrics.skip("precompute_busy")
+        return
+    spans = engines.spans()
+    if not spans:
+        return
+    lines = [l for p in prompts for l in _prompt_lines(p)]
+    if not lines:
+        return
+    # ジョブと同じく設定をスナップショットして使う（途中で UI が変わっても混ざらない）
+    vctx.begin_job()
+    try:
+        with metrics.stage("precompute_map"):
+            maps = mapper(spans[0][1], lines)
+        metrics.incr("precompute_lines", len(lines))
+        if not bool(_opt("cutoff_forge_precompute_dummies", True)):
+            return
+        try:
+            from scripts.forge_cutoff import adapter_finalcond as afc
+        except Exception:
+            from forge_cutoff import adapter_finalcond as afc
+        job = vctx.current_job()
+
+        def _warm(line, m):
+            # メインスレッドで実行される。積んでから実行までの間に生成が始まっていたら何もしない
+            if busy():
+                metrics.skip("precompute_busy")
+                return False
+            vctx.resume_job(job)
+            try:
+                with metrics.stage("precompute_dummy"):
+                    afc.warm_dummies(line, m[2], m[4])
+            finally:
+                vctx.end_job()
+            return True
+
+        for line, m in maps.items():
+            if m is None or m[3] <= 0 or not (m[1].any() or m[4]):
+                continue
+            if busy():
+                metrics.skip("precompute_busy")
+                return
+            if not _on_main_thread(lambda line=line, m=m: _warm(line, m)):
+                return
+    finally:
+        vctx.end_job()
@@ -0,0 +1,76 @@
+# トークン ID 列に対する Aho–Corasick（多パターン一括照合）
+# Target / Exclude / Processing / 句境界セパレータの全バリアントを一つのオートマトンに載せ、
+# ids_text を一度なめるだけで全カテゴリのヒット [st, ed) を得る
+
+from collections import deque
+from typing import Dict, Hashable, List, Sequence, Tuple
+
+
+class TokenAutomaton:
+    def __init__(self):
+        self._goto: List[Dict[int, int]] = [{}]
+        self._fail: List[int] = [0]
+        # ノードごとの出力：(パターン長, ラベル)
+        self._out: List[List[Tuple[int, Hashable]]] = [[]]
+        self._built = False
+
+    def add(self, ids: Sequence[int], label: Hashable) -> None:
+        if not ids:
+            return
+        node = 0
+        for t in ids:
+            nxt = self._goto[node].get(int(t))
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][int(t)] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            node = nxt
+        ent = (len(ids), label)
+        if ent not in self._out[node]:
+            self._out[node].append(ent)
+        self._built = False
+
+    def build(self) -> "TokenAutomaton":
+        q = deque()
+        for nxt in self._goto[0].values():
+            self._fail[nxt] = 0
+            q.append(nxt)
+        while q:
+            node = q.popleft()
+            for t, nxt in self._goto[node].items():
+                q.append(nxt)
+                f = self._fail[node]
+                while f and t not in self._goto[f]:
+                    f = self._fail[f]
+                cand = self._goto[f].get(t, 0)
+                self._fail[nxt] = cand if cand != nxt else 0
+                # 接尾辞側の出力を継承
+                self._out[nxt] = self._out[nxt] + [e for e in self._out[self._fail[nxt]] if e not in self._out[nxt]]
+        self._built = True
+        return self
+
+    def search(self, hay: Sequence[int]) -> List[Tuple[int, int, Hashable]]:
+        """全ヒット (st, ed, label) を返す（重なりも含む。_find_subseq_all と同じ集合）。"""
+        if not self._built:
+            self.build()
+        goto, fail, out = self._goto, self._fail, self._out
+        hits: List[Tuple[int, int, Hashable]] = []
+        node = 0
+        for i, t in enumerate(hay):
+            while node and t not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(t, 0)
+            if out[node]:
+                ed = i + 1
+                for n, label in out[node]:
+                    hits.append((ed - n, ed, label))
+        return hits
+
+    def search_grouped(self, hay: Sequence[int]) -> Dict[Hashable, List[Tuple[int, int]]]:
+        """ラベルごとに (st, ed) をまとめて返す。"""
+        grouped: Dict[Hashable, List[Tuple[int, int]]] = {}
+        for st, ed, label in self.search(hay):
+            grouped.setdefault(label, []).append((st, ed))
+        return grouped
@@ -0,0 +1,356 @@
+# sd-forge-cutoff CPU ベンチマーク（Forge 不要；tools/forge_stubs.py のスタンドインで動かす）
+#
+#   python tools/bench_cutoff.py                      # 計測して表示（ベースラインがあれば比較／無ければ記録）
+#   python tools/bench_cutoff.py --save-baseline      # 今回の結果をベースラインとして保存（上書き）
+#   python tools/bench_cutoff.py --quick --fail-on-regression
+#   python tools/bench_cutoff.py --quality            # 補間方式ごとの誤差（fp64 の Slerp 基準）も表示
+#
+# 計測ステージ（ケース = プロンプト長 × ターゲット数 × バッチ）
+#   tokenmap_l2   : _token_map（照合＋Source拡張＋Victim 算出；照合器はウォーム）
+#   encode        : ラップ済み engine.__call__（プロンプトキャッシュ冷）※スタブエンコーダ込み
+#   apply_lerp    : _apply_mask_inplace（Lerp；マスクと pad 行は計測外で作る）
+#   apply_nlerp   : _apply_mask_inplace（Nlerp）
+#   apply_slerp   : _apply_mask_inplace（Slerp）
+#   pc_cold       : _pc_wrapped 初回（メモ・ダミーキャッシュ冷；ダミーのエンコード込み）
+#   pc_step       : _pc_wrapped 2ステップ目以降（毎ステップ新しい cond テンソル）
+#   pc_step_decay : pc_step を Distance decay（cosine）で
+# 値はいずれも 1 呼び出しあたりの中央値 [ms]。
+# ベースライン（tools/bench_baseline.json）はそのマシン専用でリポジトリには含めない（.gitignore）。
+#   初回の実行で記録し、以後は記録時とホスト・CPU 数・Python・torch・スレッド数が同じ時だけ比較する
+#   （違えば警告して比較しない；ハードウェアの差を退行と誤報しないため）。
+# --quality：Victim 行相当のランダム行（cos ω を 0〜1 に散らす）で、各方式の出力を fp64 の Slerp と比べる
+#   （rel_err = |out-ref|/|ref| の平均・最大、norm_err = ||out|/|sel|-1| の平均）。
+#   "Slerp(where,fp16)" は以前の経路（両枝を全行で計算・cond の dtype のまま）。
+
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import forge_stubs  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+_COLORS = ["red", "blue", "green", "yellow", "white", "black", "purple", "orange",
+           "pink", "silver", "golden", "brown", "cyan", "magenta", "crimson", "teal",
+           "violet", "beige", "ivory", "navy"]
+_NOUNS = ["hair", "eyes", "dress", "ribbon", "shoes", "hat", "scarf", "gloves",
+          "jacket", "skirt", "boots", "belt", "cape", "necklace", "flower", "umbrella"]
+_FILLER = ["masterpiece", "best quality", "1girl", "standing", "outdoors", "sky",
+           "looking at viewer", "smile", "detailed background", "soft lighting"]
+
+
+# ---------- 入力生成 ----------
+def make_prompt(n_tokens: int, n_targets: int, variant: int = 0) -> Tuple[str, List[str]]:
+    """おおよそ n_tokens トークンのプロンプトと、その中に現れるターゲット（色）n_targets 個。"""
+    tok = forge_stubs.StubTokenizer()
+    targets = _COLORS[:max(1, n_targets)]
+    parts: List[str] = []
+    i = 0
+    while True:
+        if i < len(targets):
+            parts.append("%s %s" % (targets[i], _NOUNS[(i + variant) % len(_NOUNS)]))
+        else:
+            parts.append(_FILLER[(i + variant) % len(_FILLER)])
+        i += 1
+        text = ", ".join(parts)
+        if i >= len(targets) and len(tok.encode(text)) >= n_tokens:
+            return text, targets
+
+
+def _measure(fn: Callable, setup: Optional[Callable] = None, repeat: int = 7, number: int = 5) -> float:
+    """fn(setup()) の 1 回あたり中央値 [ms]。setup は計測外で実行する。"""
+    samples = []
+    for _ in range(repeat):
+        args = [setup() if setup is not None else None for _ in range(number)]
+        t0 = time.perf_counter()
+        for a in args:
+            fn(a)
+        samples.append((time.perf_counter() - t0) * 1000.0 / number)
+    return statistics.median(samples)
+
+
+# ---------- 各ステージ ----------
+def bench_case(env, n_tokens: int, n_targets: int, batch: int, repeat: int, number: int) -> Dict[str, float]:
+    import torch
+    vctx, afc, tm = env["vctx"], env["afc"], env["tokenmap"]
+    model = env["shared"].sd_model
+    eng = model.text_processing_engine_g
+
+    prompts, targets = [], []
+    for b in range(batch):
+        p, targets = make_prompt(n_tokens, n_targets, variant=b)
+        prompts.append(p)
+    vctx.set_runtime({"targets": ", ".join(targets), "apply_te1": True, "apply_te2": True})
+    words = tm._target_words(tm._canon_targets(", ".join(targets)))
+
+    out: Dict[str, float] = {}
+
+    # tokenmap L2
+    chunks, _tc = eng.tokenize_line(prompts[0])
+    ids_text, S_total = tm._flat_chunks(chunks)
+    tm._token_map(eng.tokenizer, ids_text, S_total, words, [], [], 1)   # 照合器ウォーム
+    out["tokenmap_l2"] = _measure(
+        lambda _a: tm._token_map(eng.tokenizer, ids_text, S_total, words, [], [], 1),
+        repeat=repeat, number=number)
+
+    # encode（ラップ込み）
+    def _encode(_a):
+        tm._prompt_cache.clear()
+        forge_stubs.encode(prompts)
+    out["encode"] = _measure(_encode, repeat=repeat, number=max(1, number // 2))
+
+    # blend 本体（_pc_wrapped と同じく、マスク [B,S] と pad 行 [K,H] はメモ済みの前提で補間だけを測る）
+    rows_src, rows_victim, _hits, _groups = tm._token_map(eng.tokenizer, ids_text, S_total, words, [], [], 1)
+    H = 2048
+    base = torch.randn(batch, S_total, H)
+    mask = torch.from_numpy(rows_victim).view(1, -1).expand(batch, -1).contiguous()
+    pad_rows = torch.randn(int(mask.sum()), H)
+    for method in ("Lerp", "Nlerp", "Slerp"):
+        out["apply_%s" % method.lower()] = _measure(
+            lambda s, m=method: afc._apply_mask_inplace(s, mask, m, 0.5, pad_rows),
+            setup=base.clone, repeat=repeat, number=number)
+
+    # _pc_wrapped 全体
+    cond = forge_stubs.encode(prompts)
+
+    def _cold(_a):
+        afc.reset_memo()
+        afc._dummy_cache.clear()
+        forge_stubs.process_cond(cond)
+    out["pc_cold"] = _measure(_cold, repeat=repeat, number=max(1, number // 2))
+
+    afc.reset_memo()
+    forge_stubs.process_cond(cond)
+    out["pc_step"] = _measure(lambda _a: forge_stubs.process_cond(cond), repeat=repeat, number=number)
+
+    vctx.set_runtime({"decay_mode": "cosine", "decay_strength": 0.8})
+    afc.reset_memo()
+    forge_stubs.process_cond(cond)
+    out["pc_step_decay"] = _measure(lambda _a: forge_stubs.process_cond(cond), repeat=repeat, number=number)
+    vctx.set_runtime({"decay_mode": "off"})
+    afc.reset_memo()
+    return out
+
+
+# ---------- 補間の品質 ----------
+def _slerp_reference(sel, pad, a: float):
+    """fp64 の素直な Slerp（単位ベクトルで補間して |sel| を掛ける；ほぼ平行の行は Lerp）。"""
+    import torch
+    sel, pad = sel.double(), pad.double()
+    ns = sel.norm(dim=-1, keepdim=True)
+    o, p = sel / ns, pad / pad.norm(dim=-1, keepdim=True)
+    w = torch.acos((o * p).sum(-1, keepdim=True).clamp(-1.0, 1.0))
+    s = torch.sin(w)
+    out = (torch.sin((1.0 - a) * w) / s * o + torch.sin(a * w) / s * p) * ns
+    return torch.where(s < 1e-4, torch.lerp(sel, pad, a), out)
+
+def _quality_rows(K: int, H: int):
+    """sel / pad [K,H]：行ごとに pad = sel と独立ノイズの混合で cos ω を 0〜1 に散らし、末尾は平行に近い行。"""
+    import torch
+    g = torch.Generator().manual_seed(0)
+    sel = torch.randn(K, H, generator=g) * (1.0 + torch.rand(K, 1, generator=g))
+    w = torch.linspace(0.0, 1.0, K).view(-1, 1) ** 3
+    pad = (1.0 - w) * torch.randn(K, H, generator=g) + w * sel * 1.3
+    pad[-8:] = sel[-8:] * 0.9 + 1e-4 * torch.randn(8, H, generator=g)
+    return sel, pad
+
+def blend_quality(afc, K: int = 512, H: int = 2048, alphas=(0.3, 0.6, 0.9), repeat: int = 7,
+                  number: int = 5) -> Dict[str, Dict[str, float]]:
+    """方式×入力 dtype ごとの誤差と時間（_blend_rows 単体；[K,H]）。"""
+    import torch
+    sel, pad = _quality_rows(K, H)
+    ns = sel.double().norm(dim=-1)
+    cases = [("Lerp", torch.float32), ("Nlerp", torch.float32), ("Slerp", torch.float32),
+             ("Lerp", torch.float16), ("Nlerp", torch.float16), ("Slerp", torch.float16)]
+    out: Dict[str, Dict[str, float]] = {}
+
+    def _run(method, dtype, a):
+        s, p = sel.to(dtype), pad.to(dtype)
+        if method == "Slerp(where,fp16)":
+            c1, c2 = afc._slerp_coeffs_where(s, p, torch.tensor([[a]], dtype=dtype))
+            return c1 * s + c2 * p
+        series, mask = s.unsqueeze(0).clone(), torch.ones(1, K, dtype=torch.bool)
+        afc._apply_mask_inplace(series, mask, method, a, p)
+        return series[0]
+
+    for method, dtype in cases + [("Slerp(where,fp16)", torch.float16)]:
+        name = method if "(" in method else "%s/%s" % (method, str(dtype).replace("torch.", ""))
+        errs, nerr = [], []
+        try:
+            for a in alphas:
+                res = _run(method, dtype, a).double()
+                ref = _slerp_reference(sel, pad, a)
+                errs.append(((res - ref).norm(dim=-1) / ref.norm(dim=-1).clamp(min=1e-12)))
+                nerr.append((res.norm(dim=-1) / ns - 1.0).abs())
+            e, n = torch.cat(errs), torch.cat(nerr)
+            ms = _measure(lambda _a: _run(method, dtype, 0.6), repeat=repeat, number=number)
+            out[name] = dict(rel_err_mean=float(e.mean()), rel_err_max=float(e.max()),
+                             norm_err_mean=float(n.mean()), ms=round(ms, 4))
+        except RuntimeError as ex:
+            # CPU の fp16 で未対応の演算など
+            out[name] = dict(error=str(ex).splitlines()[0][:80])
+    return out
+
+def _print_quality(q: Dict[str, Dict[str, float]]):
+    print("%-20s %12s %12s %12s %10s" % ("method/dtype", "rel_err_mean", "rel_err_max", "norm_err", "ms"))
+    for k, v in q.items():
+        if "error" in v:
+            print("%-20s  %s" % (k, v["error"]))
+            continue
+        print("%-20s %12.2e %12.2e %12.2e %10.3f"
+              % (k, v["rel_err_mean"], v["rel_err_max"], v["norm_err_mean"], v["ms"]))
+
+
+def run(grid_tokens, grid_targets, grid_batch, repeat: int, number: int) -> Dict[str, float]:
+    env = forge_stubs.install()
+    results: Dict[str, float] = {}
+    for n_tok in grid_tokens:
+        for n_tg in grid_targets:
+            for bs in grid_batch:
+                case = "tok%d/tg%d/b%d" % (n_tok, n_tg, bs)
+                for stage, ms in bench_case(env, n_tok, n_tg, bs, repeat, number).items():
+                    results["%s/%s" % (stage, case)] = round(ms, 4)
+    return results
+
+
+# ---------- ベースライン ----------
+def _meta() -> Dict[str, object]:
+    import torch
+    return dict(host=platform.node(), cpus=int(os.cpu_count() or 0), python=platform.python_version(),
+                torch=str(torch.__version__), threads=int(torch.get_num_threads()), machine=platform.machine())
+
+def _meta_mismatch(baseline: dict) -> List[str]:
+    """ベースラインの記録環境と今の環境で違う項目（空なら比較して良い）。"""
+    ref = dict(baseline.get("meta") or {})
+    cur = _meta()
+    return ["%s: %s -> %s" % (k, ref.get(k), v) for k, v in sorted(cur.items()) if ref.get(k) != v]
+
+def load_baseline(path: str) -> Optional[dict]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def save_baseline(path: str, results: Dict[str, float]):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"meta": _meta(), "results": results}, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+def compare(results: Dict[str, float], baseline: dict, tolerance: float, min_ms: float) -> List[str]:
+    """ベースラインより (1+tolerance) 倍以上かつ min_ms 以上遅くなった項目を返す。"""
+    base = dict(baseline.get("results") or {})
+    bad = []
+    for k, cur in sorted(results.items()):
+        ref = base.get(k)
+        if ref is None or ref <= 0:
+            continue
+        if cur > ref * (1.0 + tolerance) and (cur - ref) >= min_ms:
+            bad.append(k)
+    return bad
+
+
+def _print_table(results: Dict[str, float], baseline: Optional[dict]):
+    base = dict((baseline or {}).get("results") or {})
+    w = max(len(k) for k in results) if results else 10
+    print("%-*s %10s %10s %8s" % (w, "stage/case", "ms", "base", "ratio"))
+    for k in sorted(results):
+        cur = results[k]
+        ref = base.get(k)
+        if ref:
+            print("%-*s %10.3f %10.3f %7.2fx" % (w, k, cur, ref, cur / ref))
+        else:
+            print("%-*s %10.3f %10s %8s" % (w, k, cur, "-", "-"))
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="sd-forge-cutoff CPU benchmark (stubbed Forge)")
+    ap.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline JSON path")
+    ap.add_argument("--save-baseline", action="store_true", help="write results as the new baseline")
+    ap.add_argument("--tolerance", type=float, default=0.15, help="allowed slowdown ratio (0.15 = +15%%)")
+    ap.add_argument("--min-ms", type=float, default=0.05, help="ignore slowdowns smaller than this [ms]")
+    ap.add_argument("--fail-on-regression", action="store_true", help="exit 1 when a regression is found")
+    ap.add_argument("--tokens", default="32,150,300", help="prompt lengths (tokens)")
+    ap.add_argument("--targets", default="1,4,16", help="target counts")
+    ap.add_argument("--batch", default="1,4", help="batch sizes")
+    ap.add_argument("--repeat", type=int, default=7)
+    ap.add_argument("--number", type=int, default=5)
+    ap.add_argument("--threads", type=int, default=0, help="torch.set_num_threads (0 = leave as is)")
+    ap.add_argument("--quick", action="store_true", help="small grid, fewer repeats")
+    ap.add_argument("--json", default="", help="also write results to this JSON file")
+    ap.add_argument("--metrics", action="store_true", help="print the extension's per-stage metrics snapshot")
+    ap.add_argument("--quality", action="store_true", help="compare Lerp/Nlerp/Slerp against an fp64 Slerp reference")
+    args = ap.parse_args(argv)
+
+    logging.getLogger("forge_cutoff").setLevel(logging.WARNING)
+
+    import torch
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    ints = lambda s: [int(x) for x in str(s).split(",") if x.strip()]
+    grid_tokens, grid_targets, grid_batch = ints(args.tokens), ints(args.targets), ints(args.batch)
+    repeat, number = args.repeat, args.number
+    if args.quick:
+        grid_tokens, grid_targets, grid_batch = grid_tokens[:2], grid_targets[:2], grid_batch[:1]
+        repeat, number = 3, 3
+
+    results = run(grid_tokens, grid_targets, grid_batch, repeat, number)
+    baseline = load_baseline(args.baseline)
+    if baseline is not None and not args.save_baseline:
+        diff = _meta_mismatch(baseline)
+        if diff:
+            print("WARNING: baseline %s was recorded on a different setup; not comparing (%s)."
+                  " Re-record with --save-baseline." % (args.baseline, "; ".join(diff)))
+            baseline = None
+    elif baseline is None and not args.save_baseline:
+        # 初回：このマシンのベースラインとして記録する（比較は次回から）
+        save_baseline(args.baseline, results)
+        print("no baseline yet; recorded %s for this machine" % args.baseline)
+    _print_table(results, baseline)
+
+    if args.metrics:
+        print()
+        print(sys.modules["forge_cutoff.metrics"].to_json())
+
+    quality = None
+    if args.quality:
+        print()
+        quality = blend_quality(sys.modules["forge_cutoff.adapter_finalcond"], repeat=repeat, number=number)
+        _print_quality(quality)
+
+    if args.json:
+        doc = {"meta": _meta(), "results": results}
+        if quality is not None:
+            doc["quality"] = quality
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(doc, f, indent=1, sort_keys=True)
+
+    rc = 0
+    if baseline is not None and not args.save_baseline:
+        bad = compare(results, baseline, args.tolerance, args.min_ms)
+        if bad:
+            print("\nREGRESSION (> +%d%%):" % int(args.tolerance * 100))
+            for k in bad:
+                print("  %s: %.3f ms (base %.3f ms)" % (k, results[k], baseline["results"][k]))
+            rc = 1 if args.fail_on_regression else 0
+        else:
+            print("\nno regression against %s" % args.baseline)
+
+    if args.save_baseline:
+        save_baseline(args.baseline, results)
+        print("\nbaseline saved: %s" % args.baseline)
+    return rc
+
+
+if __name__ == "__main__":
+    sys.exit(main())
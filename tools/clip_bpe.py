@@ -0,0 +1,121 @@
+# CLIP BPE トークナイザ（純 Python。transformers / ftfy 不要）
+# ・HF 形式: vocab.json + merges.txt
+# ・OpenAI 形式: bpe_simple_vocab_16e6.txt.gz（merges のみ；vocab はそこから組み立てる）
+# encode(text, add_special_tokens=False) / __call__(texts) は HF の CLIPTokenizer と同じ ID を返す
+# （ftfy による修正だけは省略：html.unescape と空白の正規化のみ）
+
+import gzip
+import html
+import json
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import regex as _re_mod
+    _PAT = _re_mod.compile(
+        r"""<\|startoftext\|>|<\|endoftext\|>|'s|'t|'re|'ve|'m|'ll|'d|[\p{L}]+|[\p{N}]|[^\s\p{L}\p{N}]+""",
+        _re_mod.IGNORECASE)
+except Exception:
+    # regex が無い環境向けの近似（\p{L} → [^\W\d_]）
+    _PAT = re.compile(
+        r"""<\|startoftext\|>|<\|endoftext\|>|'s|'t|'re|'ve|'m|'ll|'d|[^\W\d_]+|\d|(?:[^\s\w]|_)+""",
+        re.IGNORECASE)
+
+
+@lru_cache()
+def bytes_to_unicode() -> Dict[int, str]:
+    bs = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    cs = bs[:]
+    n = 0
+    for b in range(2 ** 8):
+        if b not in bs:
+            bs.append(b)
+            cs.append(2 ** 8 + n)
+            n += 1
+    return dict(zip(bs, [chr(c) for c in cs]))
+
+
+def _pairs(word: Tuple[str, ...]):
+    return {(a, b) for a, b in zip(word, word[1:])}
+
+
+def _clean(text: str) -> str:
+    text = html.unescape(html.unescape(text))
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+class ClipBPETokenizer:
+    def __init__(self, merges_path: str, vocab_path: Optional[str] = None):
+        self.byte_encoder = bytes_to_unicode()
+        opener = gzip.open if merges_path.endswith(".gz") else open
+        with opener(merges_path, "rt", encoding="utf-8") as f:
+            lines = f.read().split("\n")
+        if lines and lines[0].startswith("#"):
+            lines = lines[1:]
+        merges = [tuple(l.split()) for l in lines if len(l.split()) == 2]
+        if vocab_path:
+            with open(vocab_path, "r", encoding="utf-8") as f:
+                self.encoder: Dict[str, int] = json.load(f)
+        else:
+            # OpenAI SimpleTokenizer と同じ組み立て（49152 - 256 - 2 + 1 本の merges）
+            merges = merges[:49152 - 256 - 2 + 1]
+            vocab = list(self.byte_encoder.values())
+            vocab = vocab + [v + "</w>" for v in vocab]
+            vocab.extend("".join(m) for m in merges)
+            vocab.extend(["<|startoftext|>", "<|endoftext|>"])
+            self.encoder = {v: i for i, v in enumerate(vocab)}
+        self.bpe_ranks = {m: i for i, m in enumerate(merges)}
+        self.bos_token_id = self.encoder["<|startoftext|>"]
+        self.eos_token_id = self.encoder["<|endoftext|>"]
+        self.pad_token_id = self.eos_token_id
+        self._cache: Dict[str, str] = {"<|startoftext|>": "<|startoftext|>", "<|endoftext|>": "<|endoftext|>"}
+
+    def _bpe(self, token: str) -> str:
+        hit = self._cache.get(token)
+        if hit is not None:
+            return hit
+        word = tuple(token[:-1]) + (token[-1] + "</w>",)
+        pairs = _pairs(word)
+        if not pairs:
+            return token + "</w>"
+        while True:
+            bigram = min(pairs, key=lambda p: self.bpe_ranks.get(p, float("inf")))
+            if bigram not in self.bpe_ranks:
+                break
+            first, second = bigram
+            new_word: List[str] = []
+            i = 0
+            while i < len(word):
+                try:
+                    j = word.index(first, i)
+                except ValueError:
+                    new_word.extend(word[i:])
+                    break
+                new_word.extend(word[i:j])
+                i = j
+                if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
+                    new_word.append(first + second)
+                    i += 2
+                else:
+                    new_word.append(word[i])
+                    i += 1
+            word = tuple(new_word)
+            if len(word) == 1:
+                break
+            pairs = _pairs(word)
+        out = " ".join(word)
+        self._cache[token] = out
+        return out
+
+    def encode(self, text: str, add_special_tokens: bool = False) -> List[int]:
+        ids: List[int] = []
+        for token in _PAT.findall(_clean(str(text or ""))):
+            token = "".join(self.byte_encoder[b] for b in token.encode("utf-8"))
+            ids.extend(self.encoder[t] for t in self._bpe(token).split(" ") if t in self.encoder)
+        if add_special_tokens:
+            ids = [self.bos_token_id] + ids + [self.eos_token_id]
+        return ids
+
+    def __call__(self, texts, truncation=False, add_special_tokens=False):
+        return {"input_ids": [self.encode(t, add_special_tokens=add_special_tokens) for t in texts]}
@@ -0,0 +1,392 @@
+# Forge 本体なしで sd-forge-cutoff のホットパスを動かすための軽量スタンドイン
+# ・backend.text_processing.classic_engine（ClassicTextProcessingEngine / PromptChunk）
+# ・backend.sampling.condition（Condition / ConditionCrossAttn）
+# ・modules.shared（opts / sd_model）
+# ・CLIP 風トークナイザ（単語→ID を決定的に割り当てる）
+# ベンチマーク・オフライン解析専用。実モデルの数値とは無関係。
+
+import os
+import re
+import sys
+import types
+import zlib
+from importlib import import_module
+from typing import Dict, List, Optional
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS_DIR = os.path.join(REPO_ROOT, "scripts")
+
+BOS_ID = 49406
+EOS_ID = 49407
+_VOCAB = 49152
+
+
+# ---------- tokenizer ----------
+class StubTokenizer:
+    """
+    CLIP BPE の代わり。空白は区切りとして捨て（CLIP と同じく " red" と "red" は同じ ID）、
+    単語と記号をそれぞれ1トークンにする。長い単語は 6 文字ごとに分割して BPE の複数トークンを模す。
+    """
+    _pat = re.compile(r"[A-Za-z]+|\d|[^\sA-Za-z\d]")
+
+    bos_token_id = BOS_ID
+    eos_token_id = EOS_ID
+    pad_token_id = EOS_ID
+
+    def _pieces(self, text: str) -> List[str]:
+        out = []
+        for m in self._pat.findall(str(text or "").lower()):
+            if m.isalpha() and len(m) > 6:
+                out.extend(m[i:i + 6] for i in range(0, len(m), 6))
+            else:
+                out.append(m)
+        return out
+
+    def encode(self, text: str, add_special_tokens: bool = False) -> List[int]:
+        ids = [zlib.crc32(p.encode("utf-8")) % (_VOCAB - 256) + 256 for p in self._pieces(text)]
+        if add_special_tokens:
+            ids = [BOS_ID] + ids + [EOS_ID]
+        return ids
+
+    def __call__(self, texts, truncation=False, add_special_tokens=False):
+        return {"input_ids": [self.encode(t, add_special_tokens=add_special_tokens) for t in texts]}
+
+
+# ---------- prompt parsing（A1111 / Forge の parse_prompt_attention と同じ規則） ----------
+_re_attention = re.compile(r"""
+\\\(|\\\)|\\\[|\\]|\\\\|\\|\(|\[|:\s*([+-]?[.\d]+)\s*\)|\)|]|[^\\()\[\]:]+|:
+""", re.X)
+_re_break = re.compile(r"\s*\bBREAK\b\s*", re.S)
+
+
+def parse_prompt_attention(text: str):
+    """強調構文 (a:1.2) / (a) / [a] / BREAK を [[text, weight], ...] に分解する（BREAK は weight=-1）。"""
+    res = []
+    round_brackets = []
+    square_brackets = []
+
+    def multiply_range(start, mult):
+        for p in range(start, len(res)):
+            res[p][1] *= mult
+
+    for m in _re_attention.finditer(text):
+        t = m.group(0)
+        weight = m.group(1)
+        if t.startswith("\\"):
+            res.append([t[1:], 1.0])
+        elif t == "(":
+            round_brackets.append(len(res))
+        elif t == "[":
+            square_brackets.append(len(res))
+        elif weight is not None and round_brackets:
+            multiply_range(round_brackets.pop(), float(weight))
+        elif t == ")" and round_brackets:
+            multiply_range(round_brackets.pop(), 1.1)
+        elif t == "]" and square_brackets:
+            multiply_range(square_brackets.pop(), 1 / 1.1)
+        else:
+            for i, part in enumerate(re.split(_re_break, t)):
+                if i > 0:
+                    res.append(["BREAK", -1])
+                res.append([part, 1.0])
+    for pos in round_brackets:
+        multiply_range(pos, 1.1)
+    for pos in square_brackets:
+        multiply_range(pos, 1 / 1.1)
+    if not res:
+        res = [["", 1.0]]
+    i = 0
+    while i + 1 < len(res):
+        if res[i][1] == res[i + 1][1]:
+            res[i][0] += res[i + 1][0]
+            res.pop(i + 1)
+        else:
+            i += 1
+    return res
+
+
+# ---------- classic_engine ----------
+class PromptChunk:
+    def __init__(self):
+        self.tokens: List[int] = []
+        self.multipliers: List[float] = []
+        self.fixes: list = []
+
+
+class _Emphasis:
+    """Forge の EmphasisOriginal：倍率を掛けたあと、平均を（バッチ全体で）元に戻す。"""
+    name = "Original"
+
+    def __init__(self):
+        self.tokens = None
+        self.multipliers = None
+        self.z = None
+
+    def after_transformers(self):
+        original_mean = self.z.mean()
+        self.z = self.z * self.multipliers.reshape(self.multipliers.shape + (1,)).expand(self.z.shape)
+        new_mean = self.z.mean()
+        self.z = self.z * (original_mean / new_mean)
+
+
+class _Embeddings:
+    fixes = None
+
+
+class ClassicTextProcessingEngine:
+    """
+    Forge の CTPE と同じ入出力形：tokenize_line → 75 トークンのチャンク（BOS/EOS 付き 77 行）、
+    __call__(texts) → [B, 77*chunks, H]（return_pooled なら (series, pooled)）。
+    エンコーダは「埋め込み＋チャンク内の因果平均」で、前後のトークンに依存する出力を作る。
+    """
+
+    def __init__(self, hidden: int = 768, return_pooled: bool = False, chunk_length: int = 75, seed: int = 0,
+                 tokenizer=None, comma_padding_backtrack: int = 20):
+        self.tokenizer = tokenizer if tokenizer is not None else StubTokenizer()
+        self.chunk_length = chunk_length
+        self.id_start = int(getattr(self.tokenizer, "bos_token_id", BOS_ID))
+        self.id_end = int(getattr(self.tokenizer, "eos_token_id", EOS_ID))
+        self.id_pad = self.id_end
+        self.comma_token = (self.tokenizer.encode(",", add_special_tokens=False) or [None])[0]
+        self.comma_padding_backtrack = comma_padding_backtrack
+        self.return_pooled = return_pooled
+        self.emphasis = _Emphasis()
+        self.embeddings = _Embeddings()
+        self.hidden = hidden
+        self.seed = seed
+        self._table = None   # 埋め込み表は初回エンコード時に作る（トークナイズだけなら torch 不要）
+        self.encoder_calls = 0
+
+    def empty_chunk(self):
+        chunk = PromptChunk()
+        chunk.tokens = [self.id_start] + [self.id_end] * (self.chunk_length + 1)
+        chunk.multipliers = [1.0] * (self.chunk_length + 2)
+        return chunk
+
+    def tokenize(self, texts):
+        return self.tokenizer(texts, truncation=False, add_special_tokens=False)["input_ids"]
+
+    def tokenize_line(self, line: str):
+        """Forge の tokenize_line と同じチャンク分割（強調の倍率・BREAK・カンマ位置での折り返し）。埋め込みは扱わない。"""
+        parsed = parse_prompt_attention(line or "")
+        tokenized = self.tokenize([text for text, _ in parsed])
+        chunks: List[PromptChunk] = []
+        state = {"chunk": PromptChunk(), "token_count": 0, "last_comma": -1}
+
+        def next_chunk(is_last=False):
+            chunk = state["chunk"]
+            state["token_count"] += len(chunk.tokens) if is_last else self.chunk_length
+            to_add = self.chunk_length - len(chunk.tokens)
+            if to_add > 0:
+                chunk.tokens += [self.id_end] * to_add
+                chunk.multipliers += [1.0] * to_add
+            chunk.tokens = [self.id_start] + chunk.tokens + [self.id_end]
+            chunk.multipliers = [1.0] + chunk.multipliers + [1.0]
+            state["last_comma"] = -1
+            chunks.append(chunk)
+            state["chunk"] = PromptChunk()
+
+        for tokens, (text, weight) in zip(tokenized, parsed):
+            if text == "BREAK" and weight == -1:
+                next_chunk()
+                continue
+            for token in tokens:
+                chunk = state["chunk"]
+                if token == self.comma_token:
+                    state["last_comma"] = len(chunk.tokens)
+                elif (self.comma_padding_backtrack != 0 and len(chunk.tokens) == self.chunk_length
+                      and state["last_comma"] != -1
+                      and len(chunk.tokens) - state["last_comma"] <= self.comma_padding_backtrack):
+                    brk = state["last_comma"] + 1
+                    reloc_tokens, reloc_mults = chunk.tokens[brk:], chunk.multipliers[brk:]
+                    chunk.tokens, chunk.multipliers = chunk.tokens[:brk], chunk.multipliers[:brk]
+                    next_chunk()
+                    state["chunk"].tokens, state["chunk"].multipliers = reloc_tokens, reloc_mults
+                if len(state["chunk"].tokens) == self.chunk_length:
+                    next_chunk()
+                state["chunk"].tokens.append(token)
+                state["chunk"].multipliers.append(weight)
+
+        if state["chunk"].tokens or not chunks:
+            next_chunk(is_last=True)
+        return chunks, state["token_count"]
+
+    def process_texts(self, texts):
+        token_count = 0
+        cache: Dict[str, list] = {}
+        batch_chunks = []
+        for line in texts:
+            if line in cache:
+                chunks = cache[line]
+            else:
+                chunks, current = self.tokenize_line(line)
+                token_count = max(current, token_count)
+                cache[line] = chunks
+            batch_chunks.append(chunks)
+        return batch_chunks, token_count
+
+    def encode_with_transformers(self, tokens):
+        import torch
+        if self._table is None:
+            g = torch.Generator().manual_seed(self.seed)
+            self._table = torch.randn(4096, self.hidden, generator=g) / self.hidden ** 0.5
+        self.encoder_calls += 1
+        emb = self._table[tokens % self._table.shape[0]]                       # [B,77,H]
+        steps = torch.arange(1, emb.shape[1] + 1, dtype=emb.dtype).view(1, -1, 1)
+        return emb + 0.5 * emb.cumsum(dim=1) / steps
+
+    def process_tokens(self, remade_batch_tokens, batch_multipliers):
+        import torch
+        tokens = torch.asarray(remade_batch_tokens)
+        if self.id_end != self.id_pad:
+            for batch_pos in range(len(remade_batch_tokens)):
+                index = remade_batch_tokens[batch_pos].index(self.id_end)
+                tokens[batch_pos, index + 1:tokens.shape[1]] = self.id_pad
+        z = self.encode_with_transformers(tokens)
+        self.emphasis.tokens = remade_batch_tokens
+        self.emphasis.multipliers = torch.asarray(batch_multipliers).to(z)
+        self.emphasis.z = z
+        self.emphasis.after_transformers()
+        return self.emphasis.z
+
+    def __call__(self, texts):
+        import torch
+        batch_chunks, _token_count = self.process_texts(texts)
+        chunk_count = max(len(x) for x in batch_chunks)
+        zs = []
+        for i in range(chunk_count):
+            batch_chunk = [chunks[i] if i < len(chunks) else self.empty_chunk() for chunks in batch_chunks]
+            tokens = [x.tokens for x in batch_chunk]
+            multipliers = [x.multipliers for x in batch_chunk]
+            self.embeddings.fixes = [x.fixes for x in batch_chunk]
+            zs.append(self.process_tokens(tokens, multipliers))
+        series = torch.hstack(zs)
+        if self.return_pooled:
+            return series, series[:, 0, :]
+        return series
+
+
+# ---------- condition ----------
+class Condition:
+    def __init__(self, cond):
+        self.cond = cond
+
+    def _copy_with(self, cond):
+        return self.__class__(cond)
+
+    def process_cond(self, batch_size, device, **kwargs):
+        cond = self.cond
+        if int(cond.shape[0]) != int(batch_size):
+            cond = cond.repeat(int(batch_size) // int(cond.shape[0]), *([1] * (cond.dim() - 1)))
+        return self._copy_with(cond.to(device))
+
+
+class ConditionCrossAttn(Condition):
+    pass
+
+
+# ---------- model / shared ----------
+class _CheckpointInfo:
+    def __init__(self, name: str):
+        self.sha256 = name
+        self.filename = name + ".safetensors"
+
+
+class StubSDXL:
+    """text_processing_engine_l / _g を持つ SDXL 風モデル（crossattn = L と G の連結）。"""
+
+    def __init__(self, name: str = "stub-sdxl"):
+        self.text_processing_engine_l = ClassicTextProcessingEngine(hidden=768, seed=1)
+        self.text_processing_engine_g = ClassicTextProcessingEngine(hidden=1280, return_pooled=True, seed=2)
+        self.sd_checkpoint_info = _CheckpointInfo(name)
+
+    def get_learned_conditioning(self, prompts: List[str]):
+        import torch
+        cond_l = self.text_processing_engine_l(prompts)
+        cond_g, _pooled = self.text_processing_engine_g(prompts)
+        return torch.cat([cond_l, cond_g], dim=2)
+
+
+class StubSD15:
+    def __init__(self, name: str = "stub-sd15"):
+        self.text_processing_engine = ClassicTextProcessingEngine(hidden=768, seed=3)
+        self.sd_checkpoint_info = _CheckpointInfo(name)
+
+    def get_learned_conditioning(self, prompts: List[str]):
+        return self.text_processing_engine(prompts)
+
+
+class _Opts:
+    def __init__(self, **kw):
+        self.cutoff_forge_enable = True
+        self.cutoff_forge_dummy_cache_mb = 256
+        self.cutoff_forge_torch_compile = False
+        self.__dict__.update(kw)
+
+
+def _module(name: str) -> types.ModuleType:
+    m = sys.modules.get(name)
+    if m is None:
+        m = types.ModuleType(name)
+        sys.modules[name] = m
+        parent, _, child = name.rpartition(".")
+        if parent:
+            setattr(_module(parent), child, m)
+    return m
+
+
+def install(model=None, **opts):
+    """
+    sys.modules にスタンドインを差し込み、拡張のパッチ（tokenmap / process_cond）を当てる。
+    opts に cutoff_forge_enable=False を渡すと、パッチを外した素の Forge 相当になる。
+    戻り値: dict(shared, vctx, afc, tokenmap, condition, classic_engine)
+    """
+    ce = _module("backend.text_processing.classic_engine")
+    ce.ClassicTextProcessingEngine = ClassicTextProcessingEngine
+    ce.PromptChunk = PromptChunk
+    cm = _module("backend.sampling.condition")
+    cm.Condition = Condition
+    cm.ConditionCrossAttn = ConditionCrossAttn
+
+    shared = _module("modules.shared")
+    shared.opts = _Opts(**opts)
+    shared.sd_model = model if model is not None else StubSDXL()
+
+    if SCRIPTS_DIR not in sys.path:
+        sys.path.insert(0, SCRIPTS_DIR)
+    vctx = import_module("forge_cutoff.context_volatile")
+    afc = import_module("forge_cutoff.adapter_finalcond")
+    tokenmap = load_tokenmap()
+    # Enable に合わせて付け外し（本番では bootstrap / Settings の onchange が呼ぶ）
+    import_module("forge_cutoff.patches").sync_from_opts()
+    return dict(shared=shared, vctx=vctx, afc=afc, tokenmap=tokenmap, condition=cm, classic_engine=ce)
+
+
+def load_tokenmap(name: str = "forge_cutoff_tokenmap"):
+    """scripts/030_forge_cutoff_tokenmap.py を通常モジュールとして読み込む（import 時にパッチが当たる）。"""
+    mod = sys.modules.get(name)
+    if mod is not None:
+        return mod
+    import importlib.util
+    if SCRIPTS_DIR not in sys.path:
+        sys.path.insert(0, SCRIPTS_DIR)
+    spec = importlib.util.spec_from_file_location(name, os.path.join(SCRIPTS_DIR, "030_forge_cutoff_tokenmap.py"))
+    mod = importlib.util.module_from_spec(spec)
+    sys.modules[name] = mod
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def set_model(model):
+    sys.modules["modules.shared"].sd_model = model
+
+
+def encode(prompts: List[str], model=None):
+    m = model if model is not None else sys.modules["modules.shared"].sd_model
+    return m.get_learned_conditioning(list(prompts))
+
+
+def process_cond(cond, batch_size: Optional[int] = None, device: str = "cpu"):
+    """Forge の 1 ステップ分：毎回新しい cond テンソルから ConditionCrossAttn を作り process_cond を呼ぶ。"""
+    c = ConditionCrossAttn(cond.clone())
+    return c.process_cond(batch_size=int(batch_size or cond.shape[0]), device=device).cond
@@ -0,0 +1,296 @@
+# sd-forge-cutoff コーパス監査（Forge・GPU 不要；tokenmap の L2 をそのまま回す）
+#
+#   python tools/profile_corpus.py corpus.jsonl                                  # スタブトークナイザ
+#   python tools/profile_corpus.py corpus.jsonl --vocab vocab.json --merges merges.txt -j 8
+#   python tools/profile_corpus.py corpus.jsonl --merges bpe_simple_vocab_16e6.txt.gz --per-prompt out.jsonl
+#
+# 入力（1 行 1 JSON）: {"prompt": "...", "targets": "red, blue", "exclude_tokens": "", "processing_targets": "",
+#                       "source_expand_n": 1}
+#   ・"text" / "exclude" / "processing" / "expand_n" の別名も可。欠けた項目は --targets 等の既定値
+# 1 プロンプトごとに tokenize_line → _token_map（照合・句境界・Source 拡張・Victim）を実行し、
+#   status       : no_targets / no_hits / no_victims / applied（本番で cutoff が効くのは applied だけ）
+#   source/victim: 行数、S（トークン長）、変更チャンク数 / 全チャンク数
+#   groups       : Target を "|" で区切った時の、グループ用ダミーの数と補間する行数
+#   dummy        : トークン列ダミーの長さ一致（常に一致するはず）と、
+#                  旧方式（文字列置換→再トークナイズ）なら起きていた長さ不一致
+# を集計し、スループット（prompts/s, tokens/s）と合わせて表示する。
+# --blend を付けると（torch があれば）Victim 行の Lerp/Nlerp/Slerp も [1,S,2048] で回して時間を測る。
+# SDXL の L / G は同じ CLIP BPE なので、行マップは L のトークナイザ 1 本で求まる。
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import re
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+STATUSES = ("no_targets", "no_hits", "no_victims", "applied", "error")
+
+_W: Dict[str, object] = {}   # ワーカごとの状態（initializer で作る）
+
+
+# ---------- ワーカ ----------
+def _init_worker(vocab: str, merges: str, blend: Optional[Tuple[str, float]], check_reference: bool):
+    import forge_stubs
+    logging.getLogger("forge_cutoff").setLevel(logging.WARNING)
+    env = forge_stubs.install(cutoff_forge_enable=False)   # パッチは当てない（関数を直接呼ぶ）
+    if merges:
+        from clip_bpe import ClipBPETokenizer
+        tokenizer = ClipBPETokenizer(merges, vocab or None)
+    else:
+        tokenizer = forge_stubs.StubTokenizer()
+    _W.update(env)
+    _W["engine"] = forge_stubs.ClassicTextProcessingEngine(tokenizer=tokenizer)
+    _W["blend"] = blend
+    _W["check_reference"] = check_reference
+
+
+def _field(rec: dict, keys, default):
+    for k in keys:
+        if k in rec and rec[k] is not None:
+            return rec[k]
+    return default
+
+
+def _legacy_dummy_text(text: str, words: List[str]) -> str:
+    # 旧方式のダミー（ターゲット語を "_" へ文字列置換）。長さ不一致の監査用
+    s = text or ""
+    for w in words:
+        if w:
+            s = re.sub(r"(?i)\b" + re.escape(w) + r"\b", "_", s)
+    return s
+
+
+def _reference_hits(tm, tokenizer, ids_text: List[int], words: List[str]) -> List[Tuple[int, int]]:
+    hits = set()
+    for w in words:
+        for ids in tm._encode_variants(tokenizer, w):
+            hits.update(tm._find_subseq_all(ids_text, ids))
+    return sorted(hits)
+
+
+def _blend_ms(afc, S: int, rows_victim, method: str, strength: float) -> float:
+    import torch
+    cond = torch.randn(1, S, 2048)
+    pad = torch.randn(1, int(rows_victim.sum()), 2048)
+    t0 = time.perf_counter()
+    afc._apply_rows_inplace(cond, rows_victim, method, strength, pad)
+    return (time.perf_counter() - t0) * 1000.0
+
+
+def process_record(item: Tuple[int, dict, dict]) -> dict:
+    idx, rec, defaults = item
+    tm, afc, vctx = _W["tokenmap"], _W["afc"], _W["vctx"]
+    eng = _W["engine"]
+    text = str(_field(rec, ("prompt", "text"), ""))
+    # 正規化は本番（tokenmap._map_settings）と同じ：小文字化・"|" は Target だけ・±N は int(値 or 1)
+    canon, words, excl, ponly, expand_n = tm._map_settings(
+        _field(rec, ("targets",), defaults["targets"]),
+        _field(rec, ("exclude_tokens", "exclude"), defaults["exclude"]),
+        _field(rec, ("processing_targets", "processing"), defaults["processing"]),
+        _field(rec, ("source_expand_n", "expand_n"), defaults["expand_n"]))
+    out = dict(index=idx, id=rec.get("id", idx), status="error", S=0, chunks=0, changed_chunks=0,
+               hits=0, source_rows=0, victim_rows=0, groups=0, group_rows=0, dummy_len_ok=True,
+               legacy_len_mismatch=False)
+    t0 = time.perf_counter()
+    try:
+        chunks, _tc = eng.tokenize_line(text)
+        ids_text, S = tm._flat_chunks(chunks)
+        out.update(S=S, chunks=len(chunks))
+        if not words:
+            out["status"] = "no_targets"
+            return out
+        rows_src, rows_victim, hits, groups = tm._token_map(
+            eng.tokenizer, ids_text, S, words,
+            excl, ponly, expand_n, tm._target_groups(canon))
+        out.update(hits=len(hits), source_rows=int(rows_src.sum()), victim_rows=int(rows_victim.sum()),
+                   groups=len(groups), group_rows=sum(int(g[1].sum()) for g in groups))
+        if _W["check_reference"]:
+            out["reference_mismatch"] = _reference_hits(tm, eng.tokenizer, ids_text, words) != sorted(set(hits))
+        if not hits:
+            out["status"] = "no_hits"
+            return out
+        if not rows_victim.any() and not groups:
+            out["status"] = "no_victims"
+            return out
+        out["status"] = "applied"
+
+        # 本番のダミー（トークン列で PAD 差し替え）：長さと変更チャンク
+        positions = tuple(int(p) for p in np.flatnonzero(tm._rows_from_hits(hits, S)))
+        ctx = SimpleNamespace(text=text, dummy_positions=positions)
+        vctx.put_chunks(eng, text, chunks)
+        dummy = afc._dummy_chunks(eng, ctx)
+        out["dummy_len_ok"] = sum(len(c.tokens) for c in dummy) == S
+        n = len(chunks[0].tokens) if chunks else 77
+        out["changed_chunks"] = len(afc._changed_chunks(ctx, n))
+
+        # 旧方式なら：文字列置換したダミーを再トークナイズして長さを比べる
+        legacy_chunks, _ = eng.tokenize_line(_legacy_dummy_text(text, words))
+        out["legacy_len_mismatch"] = tm._flat_chunks(legacy_chunks)[1] != S
+
+        if _W["blend"]:
+            method, strength = _W["blend"]
+            out["blend_ms"] = round(_blend_ms(afc, S, rows_victim, method, strength), 4)
+    except Exception as e:
+        out["status"] = "error"
+        out["error"] = "%s: %s" % (type(e).__name__, e)
+    finally:
+        out["ms"] = round((time.perf_counter() - t0) * 1000.0, 4)
+    return out
+
+
+# ---------- 入力 ----------
+def read_corpus(path: str, limit: int = 0) -> Iterator[Tuple[int, dict]]:
+    opener = open
+    if path.endswith(".gz"):
+        import gzip
+        opener = gzip.open
+    n = 0
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(rec, str):
+                rec = {"prompt": rec}
+            if not isinstance(rec, dict):
+                continue
+            yield n, rec
+            n += 1
+            if limit and n >= limit:
+                return
+
+
+# ---------- 集計 ----------
+def _pct(vals: List[float], q: float) -> float:
+    if not vals:
+        return 0.0
+    vals = sorted(vals)
+    return vals[min(len(vals) - 1, int(round(q * (len(vals) - 1))))]
+
+
+def summarize(results: List[dict], wall_s: float) -> dict:
+    counts = {s: 0 for s in STATUSES}
+    for r in results:
+        counts[r["status"]] = counts.get(r["status"], 0) + 1
+    applied = [r for r in results if r["status"] == "applied"]
+    tokens = sum(r["S"] for r in results)
+
+    def dist(key, rows):
+        vals = [float(r[key]) for r in rows if key in r]
+        if not vals:
+            return {}
+        return dict(mean=round(statistics.mean(vals), 3), p50=_pct(vals, 0.5), p90=_pct(vals, 0.9),
+                    p99=_pct(vals, 0.99), max=max(vals))
+
+    summary = dict(
+        prompts=len(results),
+        status=counts,
+        S=dist("S", results),
+        source_rows=dist("source_rows", applied),
+        victim_rows=dist("victim_rows", applied),
+        group_rows=dist("group_rows", [r for r in applied if r["groups"]]),
+        changed_chunk_ratio=round(sum(r["changed_chunks"] for r in applied)
+                                  / max(1, sum(r["chunks"] for r in applied)), 4),
+        dummy_len_mismatch=sum(1 for r in applied if not r["dummy_len_ok"]),
+        legacy_len_mismatch=sum(1 for r in applied if r["legacy_len_mismatch"]),
+        ms_per_prompt=dist("ms", results),
+        wall_s=round(wall_s, 3),
+        prompts_per_s=round(len(results) / wall_s, 1) if wall_s > 0 else 0.0,
+        tokens_per_s=round(tokens / wall_s, 1) if wall_s > 0 else 0.0,
+    )
+    if any("reference_mismatch" in r for r in results):
+        summary["reference_mismatch"] = sum(1 for r in results if r.get("reference_mismatch"))
+    if any("blend_ms" in r for r in applied):
+        summary["blend_ms"] = dist("blend_ms", applied)
+    errors = [r for r in results if r["status"] == "error"]
+    if errors:
+        summary["errors"] = [dict(index=r["index"], error=r.get("error", "")) for r in errors[:10]]
+    return summary
+
+
+def _print_summary(s: dict):
+    n = max(1, s["prompts"])
+    print("prompts: %d   wall: %.3f s   %.1f prompts/s   %.1f tokens/s"
+          % (s["prompts"], s["wall_s"], s["prompts_per_s"], s["tokens_per_s"]))
+    print("status:")
+    for k, v in s["status"].items():
+        print("  %-11s %8d  %6.2f%%" % (k, v, 100.0 * v / n))
+    for key in ("S", "source_rows", "victim_rows", "group_rows", "ms_per_prompt", "blend_ms"):
+        d = s.get(key)
+        if d:
+            print("%-14s mean %9.3f  p50 %8.3f  p90 %8.3f  p99 %8.3f  max %8.3f"
+                  % (key, d["mean"], d["p50"], d["p90"], d["p99"], d["max"]))
+    print("changed chunks / chunks (applied): %.4f" % s["changed_chunk_ratio"])
+    print("dummy length mismatch: %d   legacy (string rewrite) mismatch: %d"
+          % (s["dummy_len_mismatch"], s["legacy_len_mismatch"]))
+    if "reference_mismatch" in s:
+        print("automaton vs _find_subseq_all mismatch: %d" % s["reference_mismatch"])
+    for e in s.get("errors", []):
+        print("  error #%d: %s" % (e["index"], e["error"]))
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="sd-forge-cutoff offline token-map profiler (JSONL corpus)")
+    ap.add_argument("corpus", help="JSONL file (.gz ok); one {prompt, targets, ...} object per line")
+    ap.add_argument("--merges", default="", help="CLIP BPE merges.txt or bpe_simple_vocab_16e6.txt.gz (default: stub tokenizer)")
+    ap.add_argument("--vocab", default="", help="CLIP vocab.json (HF layout; omit for the OpenAI .gz)")
+    ap.add_argument("--targets", default="", help="default targets when a record has none")
+    ap.add_argument("--exclude", default="", help="default exclude tokens")
+    ap.add_argument("--processing", default="", help="default processing targets")
+    ap.add_argument("--expand-n", type=int, default=1, help="default source expand N")
+    ap.add_argument("-j", "--jobs", type=int, default=0, help="worker processes (0 = cpu count, 1 = in-process)")
+    ap.add_argument("--chunksize", type=int, default=64)
+    ap.add_argument("--limit", type=int, default=0, help="stop after N records")
+    ap.add_argument("--check-reference", action="store_true",
+                    help="also match targets with _find_subseq_all and count disagreements")
+    ap.add_argument("--blend", default="", choices=["", "Lerp", "Nlerp", "Slerp"], help="time the row blend (needs torch)")
+    ap.add_argument("--strength", type=float, default=0.5)
+    ap.add_argument("--per-prompt", default="", help="write per-prompt results to this JSONL file")
+    ap.add_argument("--json", default="", help="write the summary to this JSON file")
+    args = ap.parse_args(argv)
+
+    if args.vocab and not args.merges:
+        ap.error("--vocab needs --merges")
+    defaults = dict(targets=args.targets, exclude=args.exclude, processing=args.processing, expand_n=args.expand_n)
+    initargs = (args.vocab, args.merges, (args.blend, args.strength) if args.blend else None, args.check_reference)
+    items = ((i, rec, defaults) for i, rec in read_corpus(args.corpus, args.limit))
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+
+    results: List[dict] = []
+    t0 = time.perf_counter()
+    if jobs == 1:
+        _init_worker(*initargs)
+        results = [process_record(it) for it in items]
+    else:
+        with multiprocessing.Pool(jobs, initializer=_init_worker, initargs=initargs) as pool:
+            results = list(pool.imap(process_record, items, chunksize=max(1, args.chunksize)))
+    wall = time.perf_counter() - t0
+
+    if args.per_prompt:
+        with open(args.per_prompt, "w", encoding="utf-8") as f:
+            for r in results:
+                f.write(json.dumps(r, ensure_ascii=False) + "\n")
+    summary = summarize(results, wall)
+    _print_summary(summary)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=1, sort_keys=True)
+    return 1 if summary["status"].get("error") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())